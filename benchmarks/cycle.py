@@ -0,0 +1,234 @@
+"""
+Update cycle benchmark
+
+Starts a fake registry and one fake Docker Engine per socket in a child process, then runs `Container.update`
+(or `Service.update` with --swarm) for every socket, end to end, for a number of cycles. Each cycle reports its
+wall time, the Engine and registry API calls it made and how many containers were updated. The peak RSS of the
+ouroboros process is reported at the end. With --trace-memory, the Python memory still allocated after the
+cycles, e.g. the monitored containers kept between cycles, is reported as well.
+
+Any ouroboros option can be passed with --env, e.g. --env LABEL_ENABLE=true --env CLEANUP=true
+With --env CHECK_ENGINE=async, every cycle is one run of the async check engine over all sockets.
+
+With --replay, no fakes are started and the cycles are served from a trace recorded with `ouroboros --record`.
+
+EXAMPLE: python -m benchmarks.cycle --sockets 4 --containers 200 --images 40 --updates 0.1 --latency 0.002
+"""
+import gc
+import json
+import resource
+import tracemalloc
+
+from os.path import join
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import perf_counter
+from collections import Counter
+from argparse import ArgumentParser, Namespace
+from multiprocessing import get_context
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakes import FakeEngine, FakeRegistry, bench_request
+
+
+def labels_for(share, containers):
+    labelled = int(round(share * containers))
+    return lambda index: {'com.ouroboros.enable': 'true'} if index < labelled else {}
+
+
+def serve_fakes(args, directory, connection):
+    """Child process: run the fakes until the parent says stop"""
+    registry = FakeRegistry(images=args.images, tags=args.tags, latency=args.registry_latency,
+                            error_rate=args.registry_error_rate, seed=args.seed).listen()
+    engines = []
+    for index in range(args.sockets):
+        # Errors are only injected into the Engine once ouroboros is set up, see main()
+        engine = FakeEngine(registry.url, registry.repositories, containers=args.containers, swarm=args.swarm,
+                            labels=labels_for(args.label_share, args.containers), latency=args.latency,
+                            seed=args.seed)
+        engines.append(engine.listen(join(directory, f'engine{index}.sock')))
+    connection.send((registry.url, [engine.url for engine in engines]))
+    connection.recv()
+    for server in engines + [registry]:
+        server.shutdown()
+
+
+def start_fakes(args):
+    directory = mkdtemp(prefix='ouroboros-bench-')
+    parent, child = get_context('fork').Pipe()
+    process = get_context('fork').Process(target=serve_fakes, args=(args, directory, child), daemon=True)
+    process.start()
+    registry_url, engine_urls = parent.recv()
+
+    def stop():
+        parent.send('stop')
+        process.join(10)
+        rmtree(directory, ignore_errors=True)
+
+    return registry_url, engine_urls, stop
+
+
+def build_modes(args, engine_urls):
+    from pyouroboros.config import Config
+    from pyouroboros.logger import OuroborosLogger
+    from pyouroboros.dataexporters import DataManager
+    from pyouroboros.notifiers import NotificationManager
+    from pyouroboros.dockerclient import Docker, Container, Service
+    from pyouroboros.profiler import Profiler
+
+    environment = dict(option.split('=', 1) for option in args.env)
+    OuroborosLogger(level=args.log_level, log_format=environment.get('LOG_FORMAT', 'text'))
+    environment['LOG_LEVEL'] = args.log_level
+    if args.replay:
+        environment['REPLAY'] = args.replay
+    else:
+        environment['DOCKER_SOCKETS'] = ' '.join(engine_urls)
+    if args.swarm:
+        environment['SWARM'] = 'true'
+    config = Config(environment_vars=environment, cli_args=Namespace())
+    data_manager = DataManager(config)
+    notification_manager = NotificationManager(config, data_manager)
+
+    profiler = Profiler(config) if config.profile else None
+    modes = []
+    for socket in config.docker_sockets:
+        docker = Docker(socket, config, data_manager, notification_manager)
+        modes.append(Service(docker) if config.swarm else Container(docker))
+
+    if config.check_engine == 'async':
+        from pyouroboros.asynccheck import AsyncCheckEngine
+        return modes, [AsyncCheckEngine(config, modes, profiler)], data_manager
+    if profiler:
+        for mode in modes:
+            mode.update = profiler.wrap(mode.update, mode.socket)
+    return modes, modes, data_manager
+
+
+def run_update(runner):
+    try:
+        runner.update()
+    except SystemExit:
+        return 'exited'
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+    return None
+
+
+def collect_calls(urls):
+    calls = Counter()
+    for url in urls:
+        calls.update(bench_request(url, '/_bench/stats'))
+        bench_request(url, '/_bench/reset', method='POST')
+    return calls
+
+
+def collect_replay_calls(modes):
+    calls = Counter()
+    for mode in modes:
+        adapter = mode.client.api.get_adapter(mode.client.api.base_url)
+        calls.update(adapter.calls)
+        adapter.calls.clear()
+    return calls
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark ouroboros update cycles against fake Docker Engines')
+    parser.add_argument('--sockets', type=int, default=1, help='Number of fake Docker Engines\nDEFAULT: 1')
+    parser.add_argument('--containers', type=int, default=50, help='Containers (or services) per engine\n'
+                                                                   'DEFAULT: 50')
+    parser.add_argument('--images', type=int, default=10, help='Repositories in the registry\nDEFAULT: 10')
+    parser.add_argument('--tags', type=int, default=5, help='Version tags per repository\nDEFAULT: 5')
+    parser.add_argument('--cycles', type=int, default=3, help='Update cycles to run\nDEFAULT: 3')
+    parser.add_argument('--updates', type=float, default=0.0,
+                        help='Share of repositories that get a new digest before each cycle\nDEFAULT: 0')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every Engine API call')
+    parser.add_argument('--registry-latency', type=float, default=0.0, help='Seconds added to every registry call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of Engine API calls that fail')
+    parser.add_argument('--registry-error-rate', type=float, default=0.0, help='Share of registry calls that fail')
+    parser.add_argument('--label-share', type=float, default=0.0,
+                        help='Share of containers labelled com.ouroboros.enable=true')
+    parser.add_argument('--swarm', action='store_true', help='Benchmark Service.update instead of Container.update')
+    parser.add_argument('--workers', type=int, default=10,
+                        help='Sockets updated concurrently, like the scheduler thread pool\nDEFAULT: 10')
+    parser.add_argument('--env', action='append', default=[], help='Extra ouroboros option as KEY=VALUE')
+    parser.add_argument('--log-level', default='critical', help='ouroboros log level\nDEFAULT: critical')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for error injection\nDEFAULT: 1')
+    parser.add_argument('--replay', help='Replay this trace file instead of starting fakes')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Trace Python allocations during the cycles (slower) and report what they retain')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.replay:
+        registry_url, engine_urls, stop = None, [], lambda: None
+    else:
+        registry_url, engine_urls, stop = start_fakes(args)
+    results = {'arguments': vars(args), 'cycles': []}
+    try:
+        setup_start = perf_counter()
+        modes, runners, data_manager = build_modes(args, engine_urls)
+        results['setup_seconds'] = perf_counter() - setup_start
+        if args.replay:
+            results['setup_calls'] = dict(collect_replay_calls(modes))
+        else:
+            results['setup_calls'] = dict(collect_calls(engine_urls + [registry_url]))
+        print(f'setup: {results["setup_seconds"]:.3f}s, {sum(results["setup_calls"].values())} API calls')
+        if args.error_rate:
+            for url in engine_urls:
+                bench_request(url, f'/_bench/configure?error_rate={args.error_rate}', method='POST')
+
+        if args.trace_memory:
+            tracemalloc.start()
+        print(f'{"cycle":>5} {"seconds":>9} {"engine calls":>13} {"registry calls":>15} {"updated":>8}  errors')
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for cycle in range(1, args.cycles + 1):
+                if args.updates and not args.replay:
+                    bench_request(registry_url, f'/_bench/push?fraction={args.updates}', method='POST')
+                    collect_calls([registry_url])
+                updated_before = sum(data_manager.total_updated.values())
+
+                start = perf_counter()
+                errors = [error for error in executor.map(run_update, runners) if error]
+                elapsed = perf_counter() - start
+
+                if args.replay:
+                    engine_calls, registry_calls = collect_replay_calls(modes), Counter()
+                else:
+                    engine_calls = collect_calls(engine_urls)
+                    registry_calls = collect_calls([registry_url])
+                updated = sum(data_manager.total_updated.values()) - updated_before
+                results['cycles'].append({'cycle': cycle, 'seconds': elapsed, 'updated': updated, 'errors': errors,
+                                          'engine_calls': dict(engine_calls), 'registry_calls': dict(registry_calls)})
+                print(f'{cycle:>5} {elapsed:>9.3f} {sum(engine_calls.values()):>13} '
+                      f'{sum(registry_calls.values()):>15} {updated:>8}  {"; ".join(sorted(set(errors)))[:160]}')
+        if args.trace_memory:
+            gc.collect()
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results['retained_kb'], results['traced_peak_kb'] = retained // 1024, peak // 1024
+    finally:
+        stop()
+
+    routes = Counter()
+    for cycle in results['cycles']:
+        routes.update(cycle['engine_calls'])
+        routes.update(cycle['registry_calls'])
+    print()
+    print('API calls per route over all cycles:')
+    for route, count in routes.most_common():
+        print(f'{count:>8}  {route}')
+
+    results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print()
+    print(f'Peak RSS: {results["peak_rss_kb"] / 1024:.1f} MiB')
+    if args.trace_memory:
+        print(f'Python memory retained after the cycles: {results["retained_kb"] / 1024:.1f} MiB '
+              f'(peak during the cycles: {results["traced_peak_kb"] / 1024:.1f} MiB)')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
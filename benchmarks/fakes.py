@@ -0,0 +1,705 @@
+"""
+Local stand-ins for the Docker Engine API and a registry v2 endpoint
+
+The fake engine listens on a unix socket and implements the subset of the Engine API that ouroboros (through
+docker-py) uses. The fake registry listens on TCP and serves manifests and tag lists. Pulls on the fake engine
+resolve the manifest through the fake registry over HTTP, like a real daemon does, so registry latency and
+errors show up in pull times.
+
+Both servers count every request per route. `GET /_bench/stats` on either server returns the counters,
+`POST /_bench/reset` clears them, `POST /_bench/configure?latency=0.01&error_rate=0.1` changes the injected
+latency and errors and `POST /_bench/push?fraction=0.1` on the registry publishes new digests
+for that share of the images. `POST /_bench/crash?name=app` on the engine makes a container exit with code 1.
+Images saved from the fake engine are OCI layout tarballs with small placeholder layer blobs.
+"""
+import io
+import re
+import json
+import random
+import sys
+import socket
+import tarfile
+import threading
+
+from time import sleep, time
+from hashlib import sha256
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn, TCPServer, UnixStreamServer
+
+API_VERSION = '1.45'
+MANIFEST_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+LAYERS_PER_IMAGE = 3
+LAYER_SIZE = 4 * 1024 * 1024
+
+
+def digest_of(*parts):
+    return 'sha256:' + sha256('/'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+class QuietServerMixIn(object):
+    def handle_error(self, request, client_address):
+        # Clients that give up on a request (e.g. a cancelled check) close their connection mid request
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class ThreadingUnixServer(QuietServerMixIn, ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(QuietServerMixIn, ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Route(object):
+    def __init__(self, method, pattern, handler):
+        self.method = method
+        self.key = f'{method} {pattern}'
+        self.regex = re.compile('^' + re.sub(r'\{(\w+)\}', r'(?P<\1>.+?)', pattern) + '$')
+        self.handler = handler
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """Routes requests to the methods of the owning fake server"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        return 'fake'
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_bytes(self, status, body, content_type='application/x-tar'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_stream(self, status, lines):
+        """Send a chunked stream of JSON lines, like the progress output of a pull"""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for line in lines:
+            data = json.dumps(line).encode() + b'\r\n'
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def dispatch(self):
+        url = urlsplit(self.path)
+        path = re.sub(r'^/v1\.\d+', '', url.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body = self.read_body()
+        self.server.fake.handle(self, path, query, body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = dispatch
+
+
+class FakeServer(object):
+    """Shared plumbing of the fake engine and the fake registry: routing, latency and error injection, counters"""
+    routes = []
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.calls = Counter()
+        self.server = None
+        self.compiled = [Route(method, pattern, getattr(self, handler)) for method, pattern, handler in self.routes]
+
+    def handle(self, request, path, query, body):
+        if path == '/_bench/stats':
+            return request.send_json(200, dict(self.calls))
+        if path == '/_bench/reset':
+            with self.lock:
+                self.calls.clear()
+            return request.send_json(200, {})
+        if path == '/_bench/configure':
+            with self.lock:
+                self.latency = float(query.get('latency', self.latency))
+                self.error_rate = float(query.get('error_rate', self.error_rate))
+            return request.send_json(200, {'latency': self.latency, 'error_rate': self.error_rate})
+
+        for route in self.compiled:
+            if route.method != request.command and not (route.method == 'GET' and request.command == 'HEAD'):
+                continue
+            match = route.regex.match(path)
+            if not match:
+                continue
+            with self.lock:
+                self.calls[route.key] += 1
+            if self.latency:
+                sleep(self.latency)
+            if self.error_rate and self.random.random() < self.error_rate:
+                return request.send_json(500, {'message': self.injected_error(path)})
+            return route.handler(request, query, body, **match.groupdict())
+
+        with self.lock:
+            self.calls[f'{request.command} <unknown>'] += 1
+        return request.send_json(404, {'message': f'page not found: {request.command} {path}'})
+
+    def injected_error(self, path):
+        return f'injected error for {path}'
+
+    def serve(self, server):
+        server.fake = self
+        self.server = server
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class FakeRegistry(FakeServer):
+    """Registry v2 endpoint holding `images` repositories, each with a `latest` tag and `tags` older version tags"""
+    routes = [
+        ('GET', '/v2/', 'ping'),
+        ('GET', '/v2/{name}/manifests/{reference}', 'manifest'),
+        ('GET', '/v2/{name}/tags/list', 'tags_list'),
+    ]
+
+    def __init__(self, images=10, tags=5, **kwargs):
+        super().__init__(**kwargs)
+        self.repositories = {}
+        for index in range(images):
+            name = f'bench/app{index}'
+            versions = [f'1.{minor}.0' for minor in range(tags)]
+            self.repositories[name] = {tag: digest_of(name, tag, 0) for tag in versions + ['latest']}
+        self.generation = 0
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def listen(self, host='127.0.0.1', port=0):
+        return self.serve(ThreadingTCPServer((host, port), FakeHandler))
+
+    def handle(self, request, path, query, body):
+        if path == '/_bench/push':
+            return self.push(request, query, body)
+        return super().handle(request, path, query, body)
+
+    def injected_error(self, path):
+        return 'received unexpected HTTP status: 500 Internal Server Error'
+
+    def resolve(self, name, reference):
+        with self.lock:
+            tags = self.repositories.get(name)
+            if tags is None:
+                return None
+            if reference.startswith('sha256:'):
+                return reference if reference in tags.values() else None
+            return tags.get(reference)
+
+    def ping(self, request, query, body):
+        request.send_json(200, {}, headers={'Docker-Distribution-API-Version': 'registry/2.0'})
+
+    def manifest(self, request, query, body, name, reference):
+        digest = self.resolve(name, reference)
+        if digest is None:
+            return request.send_json(404, {'errors': [{'code': 'MANIFEST_UNKNOWN', 'message': 'manifest unknown'}]})
+        manifest = {
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_TYPE,
+            'config': {'mediaType': 'application/vnd.docker.container.image.v1+json', 'size': 1024,
+                       'digest': digest_of('config', digest)},
+            'layers': [{'mediaType': 'application/vnd.docker.image.rootfs.diff.tar.gzip', 'size': LAYER_SIZE,
+                        'digest': digest_of('layer', digest, layer)} for layer in range(LAYERS_PER_IMAGE)]
+        }
+        request.send_json(200, manifest, headers={'Docker-Content-Digest': digest, 'Content-Type': MANIFEST_TYPE})
+
+    def tags_list(self, request, query, body, name):
+        with self.lock:
+            tags = sorted(self.repositories.get(name, {}))
+        if not tags:
+            return request.send_json(404, {'errors': [{'code': 'NAME_UNKNOWN', 'message': 'repository unknown'}]})
+        if query.get('last'):
+            tags = [tag for tag in tags if tag > query['last']]
+        headers = {}
+        if query.get('n') and len(tags) > int(query['n']):
+            tags = tags[:int(query['n'])]
+            headers['Link'] = f'</v2/{name}/tags/list?n={query["n"]}&last={tags[-1]}>; rel="next"'
+        headers['ETag'] = f'"{digest_of(name, *tags)}"'
+        if request.headers.get('If-None-Match') == headers['ETag']:
+            return request.send_json(304, None, headers=headers)
+        request.send_json(200, {'name': name, 'tags': tags}, headers=headers)
+
+    def push(self, request, query, body):
+        """Publish a new `latest` digest for a share of the repositories, or with ?tag=, a new digest of that tag"""
+        fraction = float(query.get('fraction', 1))
+        tag = query.get('tag', 'latest')
+        with self.lock:
+            self.generation += 1
+            names = sorted(self.repositories)
+            pushed = names[:int(round(len(names) * fraction))]
+            for name in pushed:
+                self.repositories[name][tag] = digest_of(name, tag, self.generation)
+        request.send_json(200, {'pushed': pushed})
+
+
+class FakeEngine(FakeServer):
+    """Docker Engine API for `containers` running containers spread over the images of `registry`"""
+    routes = [
+        ('GET', '/_ping', 'ping'),
+        ('GET', '/version', 'version'),
+        ('GET', '/containers/json', 'list_containers'),
+        ('GET', '/containers/{id}/json', 'inspect_container'),
+        ('POST', '/containers/create', 'create_container'),
+        ('POST', '/containers/{id}/stop', 'container_action'),
+        ('POST', '/containers/{id}/kill', 'container_action'),
+        ('POST', '/containers/{id}/start', 'container_action'),
+        ('DELETE', '/containers/{id}', 'remove_container'),
+        ('GET', '/images/json', 'list_images'),
+        ('GET', '/images/{name}/json', 'inspect_image'),
+        ('POST', '/images/create', 'pull'),
+        ('DELETE', '/images/{name}', 'remove_image'),
+        ('POST', '/images/{name}/tag', 'tag_image'),
+        ('GET', '/images/{name}/get', 'save_image'),
+        ('POST', '/images/load', 'load_image'),
+        ('GET', '/distribution/{name}/json', 'distribution'),
+        ('GET', '/networks/{id}', 'inspect_network'),
+        ('POST', '/networks/{id}/connect', 'network_action'),
+        ('POST', '/networks/{id}/disconnect', 'network_action'),
+        ('POST', '/volumes/prune', 'prune_volumes'),
+        ('GET', '/services', 'list_services'),
+        ('GET', '/services/{id}', 'inspect_service'),
+        ('POST', '/services/{id}/update', 'update_service'),
+    ]
+
+    def __init__(self, registry_url, registry_repositories, containers=10, swarm=False, labels=None, **kwargs):
+        super().__init__(**kwargs)
+        self.registry_url = registry_url
+        self.registry_host = urlsplit(registry_url).netloc
+        self.images = {}
+        self.tags = {}
+        self.containers = {}
+        self.services = {}
+        self.network_id = digest_of('network', 'bridge')[7:]
+
+        names = sorted(registry_repositories)
+        for index in range(containers):
+            repository = names[index % len(names)]
+            # Images are referenced by the registry's host, like images of any private registry
+            reference = f'{self.registry_host}/{repository}:latest'
+            image_id = self.add_image(f'{self.registry_host}/{repository}', 'latest',
+                                      registry_repositories[repository]['latest'])
+            container_labels = dict(labels(index) if labels else {})
+            if swarm:
+                service_id = digest_of('service', index)[7:32]
+                self.services[service_id] = self.service_attrs(
+                    service_id, f'bench-service-{index}', container_labels,
+                    f'{reference}@{registry_repositories[repository]["latest"]}'
+                )
+            else:
+                self.add_container(f'bench-{index}', reference, image_id, container_labels)
+
+    @property
+    def url(self):
+        return f'unix://{self.server.server_address}'
+
+    def listen(self, path):
+        return self.serve(ThreadingUnixServer(path, FakeHandler))
+
+    # State helpers
+    def handle(self, request, path, query, body):
+        if path == '/_bench/crash':
+            container = self.find_container(query['name'])
+            if container is None:
+                return request.send_json(404, {'message': f'No such container: {query["name"]}'})
+            with self.lock:
+                container['State'].update({'Status': 'exited', 'Running': False, 'ExitCode': 1})
+            return request.send_json(200, {})
+        return super().handle(request, path, query, body)
+
+    def add_image(self, repository, tag, digest):
+        image_id = digest_of('config', digest)
+        with self.lock:
+            image = self.images.setdefault(image_id, {
+                'Id': image_id,
+                'RepoTags': [],
+                'RepoDigests': [f'{repository}@{digest}'],
+                'Created': '2024-01-01T00:00:00Z',
+                'Size': LAYER_SIZE * LAYERS_PER_IMAGE,
+                'Config': {'Labels': {}},
+                # The images of a repository share their base layers
+                'RootFS': {'Type': 'layers', 'Layers': [digest_of('diff', repository, layer)
+                                                        for layer in range(LAYERS_PER_IMAGE - 1)] +
+                                                       [digest_of('diff', digest, LAYERS_PER_IMAGE - 1)]}
+            })
+            self.tag(image, f'{repository}:{tag}')
+        return image_id
+
+    def tag(self, image, reference):
+        with self.lock:
+            previous = self.tags.get(reference)
+            if previous and previous != image['Id'] and reference in self.images[previous]['RepoTags']:
+                self.images[previous]['RepoTags'].remove(reference)
+            if reference not in image['RepoTags']:
+                image['RepoTags'].append(reference)
+            self.tags[reference] = image['Id']
+
+    def chains(self):
+        """The chain IDs of all layers on the engine"""
+        present = set()
+        with self.lock:
+            for image in self.images.values():
+                chain = None
+                for diff_id in image['RootFS']['Layers']:
+                    chain = diff_id if chain is None else 'sha256:' + sha256(f'{chain} {diff_id}'.encode()).hexdigest()
+                    present.add(chain)
+        return present
+
+    def find_image(self, name):
+        with self.lock:
+            if name in self.images:
+                return self.images[name]
+            if f'sha256:{name}' in self.images:
+                return self.images[f'sha256:{name}']
+            reference = name if ':' in name.split('/')[-1] else f'{name}:latest'
+            image_id = self.tags.get(reference)
+            if image_id:
+                return self.images[image_id]
+            for image in self.images.values():
+                if name in image['RepoDigests']:
+                    return image
+        return None
+
+    def add_container(self, name, reference, image_id, labels, config=None, host_config=None):
+        container_id = digest_of('container', name, time(), random.random())[7:]
+        config = dict(config or {})
+        config.setdefault('Hostname', container_id[:12])
+        config.setdefault('Domainname', '')
+        config.setdefault('User', '')
+        config.setdefault('Tty', False)
+        config.setdefault('ExposedPorts', {'80/tcp': {}})
+        config.setdefault('Volumes', None)
+        config.setdefault('WorkingDir', '')
+        config.setdefault('Cmd', ['serve'])
+        config.setdefault('Entrypoint', None)
+        config.setdefault('Env', ['PATH=/usr/local/bin:/usr/bin:/bin'])
+        config['Image'] = reference
+        config['Labels'] = labels
+        host_config = dict(host_config or {'NetworkMode': 'bridge', 'AutoRemove': False,
+                                           'RestartPolicy': {'Name': 'unless-stopped', 'MaximumRetryCount': 0}})
+        with self.lock:
+            self.containers[container_id] = {
+                'Id': container_id,
+                'Name': f'/{name}',
+                'Created': '2024-01-01T00:00:00Z',
+                'Image': image_id,
+                'State': {'Status': 'running', 'Running': True, 'Restarting': False, 'ExitCode': 0},
+                'Config': config,
+                'HostConfig': host_config,
+                'NetworkSettings': {'Networks': {'bridge': {
+                    'NetworkID': self.network_id, 'Aliases': None, 'Links': None, 'IPAMConfig': None,
+                    'IPAddress': '172.17.0.2', 'GlobalIPv6Address': ''
+                }}}
+            }
+        return container_id
+
+    def find_container(self, key):
+        with self.lock:
+            if key in self.containers:
+                return self.containers[key]
+            for container in self.containers.values():
+                if container['Name'] == f'/{key}' or container['Id'].startswith(key):
+                    return container
+        return None
+
+    def service_attrs(self, service_id, name, labels, image):
+        labels = dict(labels)
+        labels.setdefault('com.ouroboros.enable', 'true')
+        return {
+            'ID': service_id,
+            'Version': {'Index': 1},
+            'Spec': {'Name': name, 'Labels': labels,
+                     'TaskTemplate': {'ContainerSpec': {'Image': image}}, 'Mode': {'Replicated': {'Replicas': 1}}}
+        }
+
+    def registry_digest(self, repository, reference):
+        """Resolve a manifest through the fake registry, raising the registry error message on failure"""
+        repository = repository.removeprefix(f'{self.registry_host}/')
+        request = Request(f'{self.registry_url}/v2/{repository}/manifests/{reference}', method='HEAD')
+        try:
+            with urlopen(request, timeout=30) as response:
+                return response.headers['Docker-Content-Digest']
+        except HTTPError as e:
+            if e.code == 404:
+                raise LookupError(f'manifest for {repository}:{reference} not found: manifest unknown')
+            raise LookupError(f'Get "{self.registry_url}/v2/": received unexpected HTTP status: {e.code}')
+        except URLError as e:
+            raise LookupError(f'Get "{self.registry_url}/v2/": dial tcp: {e.reason}')
+
+    # Handlers
+    def ping(self, request, query, body):
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/plain')
+        request.send_header('Content-Length', '2')
+        request.send_header('Api-Version', API_VERSION)
+        request.end_headers()
+        request.wfile.write(b'OK')
+
+    def version(self, request, query, body):
+        request.send_json(200, {'Version': '26.1.0', 'ApiVersion': API_VERSION, 'MinAPIVersion': '1.24',
+                                'Os': 'linux', 'Arch': 'amd64'})
+
+    def list_containers(self, request, query, body):
+        filters = json.loads(query.get('filters') or '{}')
+        with self.lock:
+            containers = list(self.containers.values())
+        summaries = []
+        for container in containers:
+            labels = container['Config']['Labels'] or {}
+            if 'status' in filters and container['State']['Status'] not in filters['status']:
+                continue
+            if 'label' in filters and not all(
+                    (labels.get(label.split('=', 1)[0]) == label.split('=', 1)[1]) if '=' in label else label in labels
+                    for label in filters['label']):
+                continue
+            if 'name' in filters and not any(re.search(name, container['Name']) for name in filters['name']):
+                continue
+            summaries.append({
+                'Id': container['Id'],
+                'Names': [container['Name']],
+                'Image': container['Config']['Image'],
+                'ImageID': container['Image'],
+                'Command': ' '.join(container['Config']['Cmd'] or []),
+                'Created': 1704067200,
+                'Labels': labels,
+                'State': container['State']['Status'],
+                'Status': 'Up 2 hours',
+                'HostConfig': {'NetworkMode': container['HostConfig']['NetworkMode']},
+            })
+        request.send_json(200, summaries)
+
+    def inspect_container(self, request, query, body, id):
+        container = self.find_container(id)
+        if container is None:
+            return request.send_json(404, {'message': f'No such container: {id}'})
+        request.send_json(200, container)
+
+    def create_container(self, request, query, body):
+        config = json.loads(body or b'{}')
+        image = self.find_image(config.get('Image', ''))
+        if image is None:
+            return request.send_json(404, {'message': f'No such image: {config.get("Image")}'})
+        host_config = config.pop('HostConfig', None)
+        labels = config.pop('Labels', None) or {}
+        container_id = self.add_container(query.get('name') or f'created-{len(self.containers)}',
+                                          config.get('Image'), image['Id'], labels, config, host_config)
+        request.send_json(201, {'Id': container_id, 'Warnings': []})
+
+    def container_action(self, request, query, body, id):
+        container = self.find_container(id)
+        if container is None:
+            return request.send_json(404, {'message': f'No such container: {id}'})
+        with self.lock:
+            running = request.path.split('?')[0].endswith('/start')
+            container['State'].update({'Status': 'running' if running else 'exited', 'Running': running})
+        request.send_json(204, None)
+
+    def remove_container(self, request, query, body, id):
+        container = self.find_container(id)
+        if container is None:
+            return request.send_json(404, {'message': f'No such container: {id}'})
+        with self.lock:
+            self.containers.pop(container['Id'], None)
+        request.send_json(204, None)
+
+    def list_images(self, request, query, body):
+        with self.lock:
+            request.send_json(200, [dict(image, ParentId='') for image in self.images.values()])
+
+    def inspect_image(self, request, query, body, name):
+        image = self.find_image(name)
+        if image is None:
+            return request.send_json(404, {'message': f'No such image: {name}'})
+        request.send_json(200, image)
+
+    def remove_image(self, request, query, body, name):
+        image = self.find_image(name)
+        if image is None:
+            return request.send_json(404, {'message': f'No such image: {name}'})
+        with self.lock:
+            self.images.pop(image['Id'], None)
+            for reference in image['RepoTags']:
+                self.tags.pop(reference, None)
+        request.send_json(200, [{'Untagged': tag} for tag in image['RepoTags']] + [{'Deleted': image['Id']}])
+
+    def tag_image(self, request, query, body, name):
+        image = self.find_image(name)
+        if image is None:
+            return request.send_json(404, {'message': f'No such image: {name}'})
+        self.tag(image, f'{query["repo"]}:{query.get("tag") or "latest"}')
+        request.send_json(201, None)
+
+    def save_image(self, request, query, body, name):
+        image = self.find_image(name)
+        if image is None:
+            return request.send_json(404, {'message': f'No such image: {name}'})
+        config = json.dumps(image).encode()
+        layers = [f'blobs/sha256/{diff_id[7:]}' for diff_id in image['RootFS']['Layers']]
+        manifest = json.dumps([{'Config': f'blobs/sha256/{image["Id"][7:]}', 'RepoTags': image['RepoTags'],
+                                'Layers': layers}]).encode()
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as archive:
+            for member, data in [(layer, layer.encode() * 64) for layer in layers] + \
+                                [(f'blobs/sha256/{image["Id"][7:]}', config), ('manifest.json', manifest)]:
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        request.send_bytes(200, buffer.getvalue())
+
+    def load_image(self, request, query, body):
+        try:
+            with tarfile.open(fileobj=io.BytesIO(body), mode='r') as archive:
+                members = {member.name: archive.extractfile(member).read()
+                           for member in archive.getmembers() if member.isfile()}
+        except tarfile.TarError as e:
+            return request.send_json(400, {'message': f'invalid tar: {e}'})
+        present = self.chains()
+        lines = []
+        for entry in json.loads(members['manifest.json']):
+            image = json.loads(members[entry['Config']])
+            chain = None
+            for diff_id, layer in zip(image['RootFS']['Layers'], entry['Layers']):
+                chain = diff_id if chain is None else 'sha256:' + sha256(f'{chain} {diff_id}'.encode()).hexdigest()
+                if layer not in members and chain not in present:
+                    return request.send_stream(200, [{'errorDetail': {'message': f'missing layer {layer}'},
+                                                      'error': f'missing layer {layer}'}])
+            # Loaded images have no repository digests, only pulls record them
+            image = dict(image, RepoTags=[], RepoDigests=[])
+            with self.lock:
+                image = self.images.setdefault(image['Id'], image)
+            for reference in entry['RepoTags']:
+                self.tag(image, reference)
+            lines.append({'stream': f'Loaded image ID: {image["Id"]}\n'})
+        request.send_stream(200, lines)
+
+    def pull(self, request, query, body):
+        repository, tag = query.get('fromImage', ''), query.get('tag') or 'latest'
+        try:
+            digest = self.registry_digest(repository, tag)
+        except LookupError as e:
+            return request.send_json(404 if 'not found' in str(e) else 500, {'message': str(e)})
+        existing = self.find_image(f'{repository}@{digest}')
+        self.add_image(repository, tag, digest)
+
+        lines = [{'status': f'Pulling from {repository}', 'id': tag}]
+        if existing is None:
+            for layer in range(LAYERS_PER_IMAGE):
+                layer_id = digest_of('layer', digest, layer)[7:19]
+                lines.append({'status': 'Pulling fs layer', 'progressDetail': {}, 'id': layer_id})
+                for current in (LAYER_SIZE // 4, LAYER_SIZE // 2, LAYER_SIZE):
+                    lines.append({'status': 'Downloading', 'id': layer_id,
+                                  'progressDetail': {'current': current, 'total': LAYER_SIZE}})
+                lines.append({'status': 'Download complete', 'progressDetail': {}, 'id': layer_id})
+                lines.append({'status': 'Pull complete', 'progressDetail': {}, 'id': layer_id})
+        lines.append({'status': f'Digest: {digest}'})
+        lines.append({'status': f'Status: {"Downloaded newer image" if existing is None else "Image is up to date"} '
+                                f'for {repository}:{tag}'})
+        request.send_stream(200, lines)
+
+    def distribution(self, request, query, body, name):
+        repository, _, tag = name.rpartition(':') if ':' in name.split('/')[-1] else (name, '', 'latest')
+        try:
+            digest = self.registry_digest(repository, tag)
+        except LookupError as e:
+            return request.send_json(404 if 'not found' in str(e) else 500, {'message': str(e)})
+        request.send_json(200, {'Descriptor': {'mediaType': MANIFEST_TYPE, 'digest': digest, 'size': 1024},
+                                'Platforms': [{'architecture': 'amd64', 'os': 'linux'}]})
+
+    def inspect_network(self, request, query, body, id):
+        request.send_json(200, {'Id': self.network_id, 'Name': 'bridge', 'Driver': 'bridge', 'Containers': {}})
+
+    def network_action(self, request, query, body, id):
+        request.send_json(200, None)
+
+    def prune_volumes(self, request, query, body):
+        request.send_json(200, {'VolumesDeleted': [], 'SpaceReclaimed': 0})
+
+    def list_services(self, request, query, body):
+        filters = json.loads(query.get('filters') or '{}')
+        with self.lock:
+            services = [service for service in self.services.values()
+                        if all(label.split('=', 1)[0] in service['Spec']['Labels'] for label in filters.get('label', []))]
+        request.send_json(200, services)
+
+    def inspect_service(self, request, query, body, id):
+        with self.lock:
+            service = self.services.get(id) or next(
+                (service for service in self.services.values() if service['Spec']['Name'] == id), None)
+        if service is None:
+            return request.send_json(404, {'message': f'service {id} not found'})
+        request.send_json(200, service)
+
+    def update_service(self, request, query, body, id):
+        spec = json.loads(body or b'{}')
+        with self.lock:
+            service = self.services.get(id)
+            if service is None:
+                return request.send_json(404, {'message': f'service {id} not found'})
+            if int(query.get('version', -1)) != service['Version']['Index']:
+                return request.send_json(500, {'message': 'rpc error: update out of sequence'})
+            image = spec.get('TaskTemplate', {}).get('ContainerSpec', {}).get('Image')
+            if image:
+                service['Spec']['TaskTemplate']['ContainerSpec']['Image'] = image
+            service['Version']['Index'] += 1
+        request.send_json(200, {'Warnings': []})
+
+
+def bench_request(url, path, method='GET'):
+    """Call a `/_bench` control endpoint of a fake server given its unix:// or http:// url"""
+    if url.startswith('unix://'):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(url[len('unix://'):])
+        client.sendall(f'{method} {path} HTTP/1.0\r\nHost: localhost\r\nContent-Length: 0\r\n\r\n'.encode())
+        data = b''
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        client.close()
+        return json.loads(data.split(b'\r\n\r\n', 1)[1] or b'null')
+    with urlopen(Request(url + path, method=method, data=b'' if method == 'POST' else None), timeout=30) as response:
+        return json.loads(response.read() or b'null')
@@ -0,0 +1,80 @@
+"""
+Secret redaction micro-benchmark
+
+Measures the cost per log record of BlacklistFilter against the number of configured notifier URLs and docker
+sockets, and compares it with the previous implementation, which looped over every filtered string per record.
+
+EXAMPLE: python -m benchmarks.redaction --notifiers 1 10 50 --sockets 1 10
+"""
+from timeit import Timer
+from logging import LogRecord, INFO
+from argparse import ArgumentParser, Namespace
+
+from pyouroboros.config import Config
+from pyouroboros.logger import BlacklistFilter
+
+
+class LegacyBlacklistFilter(BlacklistFilter):
+    """The filter as it was before redaction was compiled into one regex"""
+
+    def filter(self, record):
+        for item in self.filtered_strings:
+            try:
+                if item in record.msg:
+                    record.msg = record.msg.replace(item, 8 * '*' + item[-5:])
+                if any(item in str(arg) for arg in record.args):
+                    record.args = tuple(arg.replace(item, 8 * '*' + item[-5:]) if isinstance(arg, str) else arg
+                                        for arg in record.args)
+            except TypeError:
+                pass
+        return True
+
+
+def filtered_strings(notifiers, sockets):
+    environment = {
+        'NOTIFIERS': ' '.join(f'discord://{1000 + index}/token{index:032d}' for index in range(notifiers)),
+        'DOCKER_SOCKETS': ' '.join(f'tcp://10.0.{index // 250}.{index % 250}:2376' for index in range(sockets)),
+        'REPO_USER': 'ci-user',
+        'REPO_PASS': 'correct-horse-battery-staple'
+    }
+    return Config(environment_vars=environment, cli_args=Namespace()).filtered_strings
+
+
+def records(strings):
+    """A plain record, one with a typical container name argument and one that contains a secret"""
+    return {
+        'plain': ('No containers are running or monitored on %s', ('local',)),
+        'args': ('%s will be updated', ('my-service-container',)),
+        'secret': ('Could not add notifier %s on socket %s', (strings[0], strings[-1]))
+    }
+
+
+def per_record_ns(filter_class, strings, msg, args, number):
+    blacklist_filter = filter_class(strings)
+
+    def run():
+        blacklist_filter.filter(LogRecord('root', INFO, __file__, 1, msg, args, None))
+
+    baseline = Timer(lambda: LogRecord('root', INFO, __file__, 1, msg, args, None)).timeit(number)
+    return (Timer(run).timeit(number) - baseline) / number * 1e9
+
+
+def main():
+    parser = ArgumentParser(description='Measure BlacklistFilter cost per log record')
+    parser.add_argument('--notifiers', type=int, nargs='+', default=[1, 10, 50], help='Notifier URL counts')
+    parser.add_argument('--sockets', type=int, nargs='+', default=[1, 10], help='Docker socket counts')
+    parser.add_argument('--number', type=int, default=20000, help='Records per measurement\nDEFAULT: 20000')
+    args = parser.parse_args()
+
+    print(f'{"notifiers":>9} {"sockets":>8} {"strings":>8} {"record":>7} {"legacy ns":>10} {"compiled ns":>12}')
+    for notifiers in args.notifiers:
+        for sockets in args.sockets:
+            strings = filtered_strings(notifiers, sockets)
+            for kind, (msg, record_args) in records(strings).items():
+                legacy = per_record_ns(LegacyBlacklistFilter, strings, msg, record_args, args.number)
+                compiled = per_record_ns(BlacklistFilter, strings, msg, record_args, args.number)
+                print(f'{notifiers:>9} {sockets:>8} {len(strings):>8} {kind:>7} {legacy:>10.0f} {compiled:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Startup time benchmark
+
+Runs a fresh interpreter with `-X importtime` for the given module and reports the slowest imports,
+the total import time and whether any optional backend was imported even though it is not enabled.
+
+EXAMPLE: python -m benchmarks.startup --module pyouroboros.ouroboros --top 15
+"""
+import sys
+import subprocess
+
+from time import perf_counter
+from argparse import ArgumentParser
+
+OPTIONAL_BACKENDS = ['apprise', 'influxdb', 'prometheus_client', 'babel', 'apscheduler', 'pytz']
+
+
+def import_times(module):
+    """Return the wall time and the parsed `-X importtime` rows (self_us, cumulative_us, name) for `module`"""
+    start = perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True, check=True)
+    wall = perf_counter() - start
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # The name column is padded with one space, nested imports are indented further
+        rows.append((int(self_us), int(cumulative_us), name[1:].rstrip()))
+    return wall, rows
+
+
+def main():
+    parser = ArgumentParser(description='Report interpreter startup and import time for ouroboros')
+    parser.add_argument('--module', default='pyouroboros.ouroboros', help='Module to import\n'
+                                                                          'DEFAULT: pyouroboros.ouroboros')
+    parser.add_argument('--top', type=int, default=20, help='Number of slowest imports to show\n'
+                                                            'DEFAULT: 20')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs, the fastest one is reported\n'
+                                                            'DEFAULT: 5')
+    args = parser.parse_args()
+
+    wall, rows = min((import_times(args.module) for _ in range(args.runs)), key=lambda run: run[0])
+    top_level = [row for row in rows if not row[2].startswith(' ')]
+    total_us = sum(cumulative_us for _, cumulative_us, _ in top_level)
+
+    print(f'Interpreter wall time: {wall * 1000:.1f} ms (best of {args.runs})')
+    print(f'Total import time:     {total_us / 1000:.1f} ms')
+    print()
+    print(f'{"cumulative ms":>14} {"self ms":>9}  module')
+    for self_us, cumulative_us, name in sorted(rows, key=lambda row: row[1], reverse=True)[:args.top]:
+        print(f'{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {name.strip()}')
+
+    imported = {name.strip().split('.')[0] for _, _, name in rows}
+    loaded_backends = [backend for backend in OPTIONAL_BACKENDS if backend in imported]
+    print()
+    print('Optional backends imported at startup: %s' % (', '.join(loaded_backends) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Monitor only announcements
+
+In monitor only mode, an outdated container is announced once for every image it could be updated to, not every
+cycle until it is updated. The announced images are kept in a JSON file per socket under hooks/announced, so a
+restart does not announce them again.
+"""
+import re
+import json
+
+from os import replace
+from pathlib import Path
+from logging import getLogger
+from threading import Lock
+
+from pyouroboros.helpers import get_exec_dir
+
+ANNOUNCED_DIR = get_exec_dir() + '/hooks/announced'
+
+
+class AnnouncementStore(object):
+    """The image IDs announced for the outdated containers (or services) of a socket, by name"""
+
+    def __init__(self, socket):
+        self.path = Path(ANNOUNCED_DIR, re.sub(r'[^A-Za-z0-9_.-]', '_', socket) + '.json')
+        self.lock = Lock()
+        self.logger = getLogger()
+        self.announced = self.read()
+
+    def read(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.logger.error('Could not read announced updates from %s. Error: %s', self.path, e)
+            return {}
+
+    def write(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temporary = self.path.with_suffix('.tmp')
+            with open(temporary, 'w') as file:
+                json.dump(self.announced, file)
+            replace(temporary, self.path)
+        except OSError as e:
+            self.logger.error('Could not save announced updates to %s. Error: %s', self.path, e)
+
+    def announce(self, name, image_id):
+        """Remember the announcement of `image_id` for `name`. False if it was announced already."""
+        with self.lock:
+            if self.announced.get(name) == image_id:
+                return False
+            self.announced[name] = image_id
+            self.write()
+            return True
+
+    def forget(self, name):
+        """Forget the announcement for `name`, which is up to date"""
+        with self.lock:
+            if self.announced.pop(name, None) is not None:
+                self.write()
@@ -0,0 +1,279 @@
+import ssl
+import json
+import asyncio
+
+from time import time
+from base64 import b64encode
+from logging import getLogger
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+from pyouroboros.registry import parse_reference, registry_url, parse_challenge, registry_breaker, MANIFEST_TYPES
+from pyouroboros.profiler import bind
+from pyouroboros.snapshot import ContainerSnapshot
+from pyouroboros.semver import TRACK_LABEL
+
+# Concurrent connections to one registry host, shared by all sockets
+REGISTRY_CONNECTIONS = 8
+
+
+class EngineError(Exception):
+    pass
+
+
+class AsyncEngineAPI(object):
+    """Read-only Docker Engine API client on an aiohttp session, using the connection settings of a docker client"""
+
+    def __init__(self, docker):
+        import aiohttp
+
+        api = docker.client.api
+        self.version = api.api_version
+        timeout = aiohttp.ClientTimeout(total=docker.config.docker_timeout)
+        if api.base_url == 'http+docker://localhost':
+            connector = aiohttp.UnixConnector(path=api.get_adapter(api.base_url).socket_path,
+                                              limit=docker.pool_size)
+            self.base_url = 'http://localhost'
+        else:
+            connector = aiohttp.TCPConnector(limit=docker.pool_size, ssl=self.ssl_context(api))
+            self.base_url = api.base_url
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    @staticmethod
+    def ssl_context(api):
+        """SSL context of the TLS settings docker-py applied to the client session, None for plain http"""
+        if not api.base_url.startswith('https://'):
+            return None
+        context = ssl.create_default_context(cafile=api.verify if isinstance(api.verify, str) else None)
+        if api.verify is False:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if api.cert:
+            context.load_cert_chain(*api.cert)
+        return context
+
+    @staticmethod
+    def supports(docker):
+        """Unix and tcp sockets are supported. ssh and npipe sockets are checked the synchronous way."""
+        return docker.client is not None and docker.client.api.base_url.startswith(
+            ('http+docker://localhost', 'http://', 'https://'))
+
+    async def get(self, path, **params):
+        """Return the decoded JSON of a GET, or None if the object does not exist (anymore)"""
+        async with self.session.get(f'{self.base_url}/v{self.version}{path}', params=params) as response:
+            if response.status == 404:
+                return None
+            if response.status >= 400:
+                raise EngineError(f'{response.status} error for GET {path}: {await response.text()}')
+            return await response.json(content_type=None)
+
+    async def close(self):
+        await self.session.close()
+
+
+class AsyncRegistry(object):
+    """Resolves image references to their current manifest digest, with token authentication"""
+
+    def __init__(self, session, config):
+        self.session = session
+        self.config = config
+        self.logger = getLogger()
+        self.authorizations = {}
+        self.digests = {}
+
+    def digest(self, tag):
+        """Return an awaitable of the digest of `tag`, shared by all containers of all sockets that use it"""
+        if tag not in self.digests:
+            self.digests[tag] = asyncio.ensure_future(self.resolve(tag))
+        return self.digests[tag]
+
+    async def resolve(self, tag):
+        """Return the digest of `tag`, or None if it could not be resolved"""
+        import aiohttp
+
+        host, repository, reference = parse_reference(tag)
+        breaker = registry_breaker(host, self.config)
+        if not breaker.allow():
+            return None
+
+        url = f'{registry_url(host)}/v2/{repository}/manifests/{reference}'
+        try:
+            status, digest = await self.head(url, host, repository)
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            self.logger.debug('Could not resolve %s. Error: %s', tag, e)
+            self.failure(breaker, host)
+            return None
+
+        if status == 429 or status >= 500:
+            self.logger.debug('Could not resolve %s. Registry answered %s', tag, status)
+            self.failure(breaker, host)
+            return None
+        breaker.success()
+        if status != 200 or not digest:
+            self.logger.debug('Could not resolve %s. Registry answered %s', tag, status)
+            return None
+        return digest
+
+    def failure(self, breaker, host):
+        if breaker.failure():
+            self.logger.error('Registry %s is failing, skipping its images for %.0fs', host, breaker.retry_in)
+
+    async def head(self, url, host, repository):
+        headers = {'Accept': ', '.join(MANIFEST_TYPES)}
+        authorization = self.authorizations.get((host, repository))
+        if authorization:
+            headers['Authorization'] = authorization
+        async with self.session.head(url, headers=headers) as response:
+            if response.status != 401 or authorization:
+                return response.status, response.headers.get('Docker-Content-Digest')
+            challenge = response.headers.get('WWW-Authenticate', '')
+
+        authorization = await self.authorize(challenge, repository)
+        if authorization is None:
+            return 401, None
+        self.authorizations[(host, repository)] = headers['Authorization'] = authorization
+        async with self.session.head(url, headers=headers) as response:
+            return response.status, response.headers.get('Docker-Content-Digest')
+
+    async def authorize(self, challenge, repository):
+        """Return the Authorization header answering a registry's challenge"""
+        import aiohttp
+
+        scheme, params = parse_challenge(challenge)
+        credentials = (self.config.repo_user, self.config.repo_pass) if self.config.auth_json else None
+        if scheme == 'basic' and credentials:
+            return 'Basic ' + b64encode(':'.join(credentials).encode()).decode()
+        if scheme != 'bearer' or 'realm' not in params:
+            return None
+
+        query = {'scope': f'repository:{repository}:pull'}
+        if 'service' in params:
+            query['service'] = params['service']
+        auth = aiohttp.BasicAuth(*credentials) if credentials else None
+        async with self.session.get(params['realm'], params=query, auth=auth) as response:
+            if response.status != 200:
+                return None
+            token = await response.json(content_type=None)
+        token = token.get('token') or token.get('access_token')
+        return f'Bearer {token}' if token else None
+
+
+class AsyncCheckEngine(object):
+    """
+    Checks the containers of all sockets concurrently on one event loop
+
+    Container listing, image inspection and registry digest resolution of every socket run as tasks of one loop.
+    Only containers whose registry digest differs from the digests of their local image (or could not be resolved)
+    are passed on to the synchronous update of their socket, which pulls, compares, inspects and recreates them.
+    """
+
+    def __init__(self, config, modes, profiler=None):
+        self.config = config
+        self.modes = modes
+        self.logger = getLogger()
+        self.profiler = profiler
+        self.updates = {mode.socket: profiler.wrap(mode.update, mode.socket) if profiler else mode.update
+                        for mode in modes}
+
+    def update(self):
+        check = self.profiler.wrap(self.check, 'all sockets', name='async_check') if self.profiler else self.check
+        results = check()
+        futures = {}
+        with ThreadPoolExecutor(max_workers=min(10, len(self.modes)) or 1) as executor:
+            for mode in self.modes:
+                if mode.socket not in results:
+                    # Not supported by the async engine
+                    futures[mode.socket] = executor.submit(self.updates[mode.socket])
+                elif results[mode.socket] is not None:
+                    futures[mode.socket] = executor.submit(self.updates[mode.socket], candidates=results[mode.socket])
+        for socket, future in futures.items():
+            if future.exception() is not None:
+                self.logger.error('Update of %s failed. Error: %s', socket, future.exception(),
+                                  exc_info=future.exception())
+
+    def check(self):
+        """Return the update candidates of every socket, None for the sockets that could not be checked"""
+        with ThreadPoolExecutor(max_workers=min(32, len(self.modes)) or 1) as executor:
+            healthy = list(executor.map(bind(lambda mode: mode.docker.healthy()), self.modes))
+
+        results = {}
+        supported = []
+        for mode, is_healthy in zip(self.modes, healthy):
+            if not is_healthy:
+                results[mode.socket] = None
+            elif AsyncEngineAPI.supports(mode.docker):
+                supported.append(mode)
+        if supported:
+            results.update(asyncio.run(self.check_sockets(supported)))
+        return results
+
+    async def check_sockets(self, modes):
+        import aiohttp
+
+        timeout = aiohttp.ClientTimeout(total=self.config.docker_timeout)
+        connector = aiohttp.TCPConnector(limit_per_host=REGISTRY_CONNECTIONS)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            registry = AsyncRegistry(session, self.config)
+            return dict(await asyncio.gather(*(self.check_socket(mode, registry) for mode in modes)))
+
+    async def check_socket(self, mode, registry):
+        import aiohttp
+
+        api = AsyncEngineAPI(mode.docker)
+        try:
+            return mode.socket, await self.candidates(mode, api, registry)
+        except EngineError as e:
+            self.logger.error("Can't check containers on %s, skipping this cycle. Error: %s", mode.socket, e)
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            mode.docker.mark_unhealthy(e)
+        finally:
+            await api.close()
+        return mode.socket, None
+
+    async def candidates(self, mode, api, registry):
+        """
+        Return snapshots of the monitored containers of a socket that may have an update. Only the images of the
+        monitored containers are inspected, the containers themselves once for their --rm property, and else are left
+        to the update.
+        """
+        summaries = await api.get('/containers/json', filters=json.dumps(mode.list_filters()))
+        monitored = [container for container in map(ContainerSnapshot.from_summary, summaries)
+                     if (self.config.self_update or mode.is_updatable(container.id, container.name, container.tags))
+                     and mode.is_monitored(container.name, container.labels)]
+        inspected = await asyncio.gather(*(api.get(f'/containers/{container.id}/json')
+                                           for container in mode.auto_remove_unknown(monitored)))
+        monitored = mode.skip_auto_remove(monitored, [ContainerSnapshot.from_inspect(attrs) if attrs else None
+                                                      for attrs in inspected])
+        mode.set_monitored(len(monitored))
+        mode.monitored = monitored
+
+        image_ids = list({container.image_id for container in monitored})
+        images = dict(zip(image_ids, await asyncio.gather(*(api.get(f'/images/{quote(image_id)}/json')
+                                                             for image_id in image_ids))))
+        changed = await asyncio.gather(*(self.changed(container, images.get(container.image_id) or {}, registry)
+                                         for container in monitored))
+        candidates = [container for container, has_changed in zip(monitored, changed) if has_changed]
+        checked = time()
+        for container, has_changed in zip(monitored, changed):
+            if not has_changed:
+                mode.checks[container.name] = (checked, container.image_id, None)
+        self.logger.debug('%d of %d monitored containers on %s are update candidates', len(candidates),
+                          len(monitored), mode.socket, extra={'socket': mode.socket, 'phase': 'check'})
+        return candidates
+
+    async def changed(self, container, image, registry):
+        """Return whether the registry digest of a container's image is not one of its local image digests"""
+        if not container.tags or TRACK_LABEL in container.labels:
+            # Untagged, the synchronous update inspects it for its reference. Or tracking a version constraint,
+            # which the synchronous update lists the tags for.
+            return True
+        tag = container.image
+        digest = None
+        if self.config.latest_only:
+            digest = await registry.digest(f"{tag.split(':')[0]}:latest")
+        if digest is None:
+            digest = await registry.digest(tag)
+        if digest is None:
+            # Unknown, the synchronous pull decides
+            return True
+        return digest not in [repo_digest.split('@')[-1] for repo_digest in image.get('RepoDigests') or []]
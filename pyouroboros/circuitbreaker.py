@@ -0,0 +1,84 @@
+from time import monotonic
+from threading import Lock
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for a remote dependency, e.g. a docker socket
+
+    closed: calls go through. After `threshold` consecutive failures the breaker opens.
+    open: calls are skipped until the backoff has passed, then one probe call is let through (half-open).
+    half-open: a successful probe closes the breaker, a failed one opens it again with twice the backoff,
+    up to `max_backoff` seconds.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, threshold=1, backoff=30, max_backoff=1800, clock=monotonic):
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.lock = Lock()
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.retry_at = None
+        # When the probe of the half-open breaker was let through
+        self.probed = None
+
+    def __getstate__(self):
+        # Picklable for worker processes, which report the state to the supervisor. The lock is not shared.
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def allow(self):
+        """
+        Return whether a call may go through now. Only one call at a time is let through while half-open, unless the
+        probe has been out for longer than the backoff: its caller never reported the outcome.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and self.clock() >= self.retry_at) or \
+                    (self.state == self.HALF_OPEN and self.clock() - self.probed >= self.current_backoff()):
+                self.state = self.HALF_OPEN
+                self.probed = self.clock()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened = 0
+            self.retry_at = None
+
+    def failure(self):
+        """Record a failed call. Return True if this opened the breaker."""
+        with self.lock:
+            self.failures += 1
+            if self.state != self.HALF_OPEN and self.failures < self.threshold:
+                return False
+            self.opened += 1
+            self.state = self.OPEN
+            self.retry_at = self.clock() + self.current_backoff()
+            return True
+
+    def current_backoff(self):
+        return min(self.backoff * 2 ** max(0, self.opened - 1), self.max_backoff)
+
+    @property
+    def retry_in(self):
+        """Seconds until the next probe is let through, 0 if calls go through"""
+        if self.retry_at is None:
+            return 0
+        return max(0, self.retry_at - self.clock())
@@ -1,6 +1,35 @@
 from os import environ
+from importlib.util import find_spec
 from logging import getLogger
 from pyouroboros.logger import BlacklistFilter
+from pyouroboros.workqueue import parse_priorities
+
+
+def read_config_file(path):
+    """Return the options of an env file: a KEY=value line per option, blank lines and # comments left out"""
+    options = {}
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key, _, value = line.partition('=')
+            key = key.strip()
+            if key.startswith('export '):
+                key = key[len('export '):].strip()
+            options[key] = value.strip()
+    return options
+
+
+def config_environment(environment_vars, config_file):
+    """Return `environment_vars` with the options of `config_file` over them, if there is one"""
+    if not config_file:
+        return environment_vars
+    try:
+        return {**environment_vars, **read_config_file(config_file)}
+    except OSError as e:
+        getLogger().error('Could not read the config file %s. Error: %s', config_file, e)
+        return environment_vars
 
 
 class Config(object):
@@ -9,26 +38,61 @@ class Config(object):
                'INFLUX_URL', 'INFLUX_PORT', 'INFLUX_USERNAME', 'INFLUX_PASSWORD', 'INFLUX_DATABASE', 'INFLUX_SSL',
                'INFLUX_VERIFY_SSL', 'DATA_EXPORT', 'SELF_UPDATE', 'LABEL_ENABLE', 'DOCKER_TLS', 'LABELS_ONLY',
                'DRY_RUN', 'MONITOR_ONLY', 'HOSTNAME', 'DOCKER_TLS_VERIFY', 'SWARM', 'SKIP_STARTUP_NOTIFICATIONS', 'LANGUAGE',
-               'TZ', 'CLEANUP_UNUSED_VOLUMES', 'DOCKER_TIMEOUT', 'LATEST_ONLY', 'SAVE_COUNTERS', 'SINGLE', 'SINGLE_WAIT']
+               'TZ', 'CLEANUP_UNUSED_VOLUMES', 'DOCKER_TIMEOUT', 'LATEST_ONLY', 'SAVE_COUNTERS', 'SINGLE', 'SINGLE_WAIT',
+               'RECORD', 'REPLAY', 'REPLAY_DELAYS', 'PROFILE', 'PROFILE_FORMAT', 'PROFILE_CPROFILE',
+               'LOG_FORMAT', 'DOCKER_POOL_SIZE', 'DOCKER_KEEPALIVE', 'CHECK_WORKERS', 'DOCKER_PROBE_TIMEOUT',
+               'DOCKER_BACKOFF', 'DOCKER_MAX_BACKOFF', 'PULL_RETRIES', 'REGISTRY_THRESHOLD', 'REGISTRY_BACKOFF',
+               'REGISTRY_MAX_BACKOFF', 'CHECK_ENGINE', 'WORKER_PROCESSES', 'CYCLE_BUDGET',
+               'PRIORITIES', 'PRIORITY_MAX_WAIT', 'TAG_CACHE_TTL',
+               'ROLLBACK_RETENTION', 'ROLLBACK_GRACE', 'ROLLOUT_WAVE_SIZE', 'ROLLOUT_CANARY',
+               'PULL_SOURCE', 'PULL_CONCURRENCY', 'PULL_RATE_LIMIT', 'MAINTENANCE_WINDOW',
+               'MAINTENANCE_DURATION', 'STATUS_ADDR', 'STATUS_PORT', 'MONITOR_RECHECK', 'CONFIG_FILE']
 
     hostname = environ.get('HOSTNAME')
     interval = 300
     cron = None
+    maintenance_window = None
+    maintenance_duration = 60
     docker_sockets = 'unix://var/run/docker.sock'
     docker_tls = False
     docker_tls_verify = True
     docker_timeout = 60
+    docker_pool_size = 10
+    docker_keepalive = 60
+    check_workers = 1
+    check_engine = 'sync'
+    worker_processes = 0
+    cycle_budget = 0
+    priorities = []
+    priority_max_wait = 3
+    docker_probe_timeout = 5
+    docker_backoff = 30
+    docker_max_backoff = 1800
+    pull_retries = 2
+    pull_concurrency = 0
+    pull_rate_limit = 0
+    registry_threshold = 3
+    registry_backoff = 60
+    registry_max_backoff = 1800
+    tag_cache_ttl = 600
+    rollback_retention = 0
+    rollback_grace = 60
+    rollout_wave_size = 0
+    rollout_canary = None
+    pull_source = None
     grace = 15
     swarm = False
     monitor = []
     ignore = []
     data_export = None
     log_level = 'info'
+    log_format = 'text'
     cleanup = False
     cleanup_unused_volumes = False
     run_once = False
     dry_run = False
     monitor_only = False
+    monitor_recheck = 3600
     self_update = False
     label_enable = False
     labels_only = False
@@ -46,6 +110,9 @@ class Config(object):
     prometheus_addr = '127.0.0.1'
     prometheus_port = 8000
 
+    status_addr = '127.0.0.1'
+    status_port = 0
+
     influx_url = '127.0.0.1'
     influx_port = 8086
     influx_ssl = False
@@ -59,6 +126,16 @@ class Config(object):
     single = False
     single_wait = 0
 
+    record = None
+    replay = None
+    replay_delays = False
+
+    profile = None
+    profile_format = 'chrome'
+    profile_cprofile = False
+
+    config_file = None
+
     def __init__(self, environment_vars, cli_args):
         self.cli_args = cli_args
         self.environment_vars = environment_vars
@@ -67,28 +144,33 @@ class Config(object):
         self.logger = getLogger()
         self.parse()
 
-    def config_blacklist(self):
-        filtered_strings = [getattr(self, key.lower()) for key in Config.options
-                            if key.lower() in BlacklistFilter.blacklisted_keys]
-        # Clear None values
-        self.filtered_strings = list(filter(None, filtered_strings))
-        # take lists inside of list and append to list
-        for index, value in enumerate(self.filtered_strings, 0):
-            if isinstance(value, list):
-                self.filtered_strings.extend(self.filtered_strings.pop(index))
-                self.filtered_strings.insert(index, self.filtered_strings[-1:][0])
+    def config_blacklist(self, keep=()):
+        # `keep`: strings masked before, e.g. the secrets of the configuration that was reloaded
+        filtered_strings = list(keep)
+        for key in BlacklistFilter.blacklisted_keys:
+            value = getattr(self, key, None)
+            if isinstance(value, dict):
+                value = list(value.values())
+            # take lists inside of list and append to list
+            filtered_strings.extend(value if isinstance(value, list) else [value])
+        # Clear None and non string values
+        filtered_strings = [string for string in filtered_strings if isinstance(string, str) and string]
         # Added matching for ports
-        ports = [string.split(':')[0] for string in self.filtered_strings if ':' in string]
-        self.filtered_strings.extend(ports)
+        ports = [string.split(':')[0] for string in filtered_strings if ':' in string]
         # Added matching for tcp sockets. ConnectionPool ignores the tcp://
-        tcp_sockets = [string.split('//')[1] for string in self.filtered_strings if '//' in string]
-        self.filtered_strings.extend(tcp_sockets)
+        tcp_sockets = [string.split('//')[1] for string in filtered_strings if '//' in string]
+        filtered_strings.extend(ports + tcp_sockets)
         # Get JUST hostname from tcp//unix
         for socket in getattr(self, 'docker_sockets'):
-            self.filtered_strings.append(socket.split('//')[1].split(':')[0])
+            filtered_strings.append(socket.split('//')[1].split(':')[0])
+        self.filtered_strings = list(dict.fromkeys(filtered_strings))
 
+        # Replace the filter of a previous parse instead of stacking another one on the handlers
+        blacklist_filter = BlacklistFilter(self.filtered_strings)
         for handler in self.logger.handlers:
-            handler.addFilter(BlacklistFilter(set(self.filtered_strings)))
+            for old_filter in [f for f in handler.filters if isinstance(f, BlacklistFilter)]:
+                handler.removeFilter(old_filter)
+            handler.addFilter(blacklist_filter)
 
     def parse(self):
         for option in Config.options:
@@ -97,7 +179,13 @@ class Config(object):
                 if isinstance(env_opt, str):
                     # Clean out quotes, both single/double and whitespace
                     env_opt = env_opt.strip("'").strip('"').strip(' ')
-                if option in ['INTERVAL', 'GRACE', 'PROMETHEUS_PORT', 'INFLUX_PORT', 'DOCKER_TIMEOUT', 'SINGLE_WAIT']:
+                if option in ['INTERVAL', 'GRACE', 'PROMETHEUS_PORT', 'INFLUX_PORT', 'DOCKER_TIMEOUT', 'SINGLE_WAIT',
+                              'DOCKER_POOL_SIZE', 'DOCKER_KEEPALIVE', 'CHECK_WORKERS', 'DOCKER_PROBE_TIMEOUT',
+                              'DOCKER_BACKOFF', 'DOCKER_MAX_BACKOFF', 'PULL_RETRIES', 'REGISTRY_THRESHOLD',
+                              'REGISTRY_BACKOFF', 'REGISTRY_MAX_BACKOFF', 'WORKER_PROCESSES',
+                              'CYCLE_BUDGET', 'PRIORITY_MAX_WAIT', 'TAG_CACHE_TTL',
+                              'ROLLBACK_RETENTION', 'ROLLBACK_GRACE', 'ROLLOUT_WAVE_SIZE', 'PULL_CONCURRENCY',
+                              'PULL_RATE_LIMIT', 'MAINTENANCE_DURATION', 'STATUS_PORT', 'MONITOR_RECHECK']:
                     try:
                         opt = int(env_opt)
                         setattr(self, option.lower(), opt)
@@ -105,7 +193,8 @@ class Config(object):
                         print(e)
                 elif option in ['CLEANUP', 'RUN_ONCE', 'INFLUX_SSL', 'INFLUX_VERIFY_SSL', 'DRY_RUN', 'MONITOR_ONLY', 'SWARM',
                                 'SELF_UPDATE', 'LABEL_ENABLE', 'DOCKER_TLS', 'LABELS_ONLY', 'DOCKER_TLS_VERIFY',
-                                'SKIP_STARTUP_NOTIFICATIONS', 'CLEANUP_UNUSED_VOLUMES', 'LATEST_ONLY', 'SINGLE']:
+                                'SKIP_STARTUP_NOTIFICATIONS', 'CLEANUP_UNUSED_VOLUMES', 'LATEST_ONLY', 'SINGLE',
+                                'REPLAY_DELAYS', 'PROFILE_CPROFILE']:
                     if env_opt.lower() in ['true', 'yes']:
                         setattr(self, option.lower(), True)
                     elif env_opt.lower() in ['false', 'no']:
@@ -131,7 +220,7 @@ class Config(object):
         if self.labels_only and not self.label_enable:
             self.logger.warning('labels_only enabled but not in use without label_enable')
 
-        for option in ['docker_sockets', 'notifiers', 'monitor', 'ignore']:
+        for option in ['docker_sockets', 'notifiers', 'monitor', 'ignore', 'priorities']:
             if isinstance(getattr(self, option), str):
                 string_list = getattr(self, option)
                 setattr(self, option, [string for string in string_list.split(' ')])
@@ -147,6 +236,22 @@ class Config(object):
                 self.cron = cron_times
                 self.interval = None
 
+        if self.maintenance_window:
+            window_times = self.maintenance_window.strip().split(' ')
+            if len(window_times) != 5:
+                self.logger.error("Maintenance window must be in cron syntax, e.g. 0 2 * * * (5 places). Applying "
+                                  "updates at any time")
+                self.maintenance_window = None
+            elif self.swarm or self.run_once or self.dry_run or self.monitor_only:
+                self.logger.warning("A maintenance window is not used with swarm, run once, dry run or monitor only")
+                self.maintenance_window = None
+            else:
+                self.maintenance_window = window_times
+            if self.maintenance_duration < 1:
+                self.logger.error("Maintenance duration must be at least 1 minute. Using %d",
+                                  Config.maintenance_duration)
+                self.maintenance_duration = Config.maintenance_duration
+
         if self.data_export == 'influxdb' and not self.influx_database:
             self.logger.error("You need to specify an influx database if you want to export to influxdb. Disabling "
                               "influxdb data export.")
@@ -158,6 +263,114 @@ class Config(object):
             self.logger.warning("Dry run is designed to be ran with run once. Setting for you.")
             self.run_once = True
 
+        if self.profile_format not in ['chrome', 'otlp']:
+            self.logger.error("Profile format must be chrome or otlp. Using chrome")
+            self.profile_format = 'chrome'
+
+        if self.profile_cprofile and not self.profile:
+            self.logger.warning('profile_cprofile enabled but not in use without profile')
+
+        if self.check_workers < 1 or self.docker_pool_size < 1:
+            self.logger.error("Check workers and docker pool size must be at least 1. Using 1")
+            self.check_workers, self.docker_pool_size = max(1, self.check_workers), max(1, self.docker_pool_size)
+
+        if self.pull_concurrency < 0 or self.pull_rate_limit < 0:
+            self.logger.error("Pull concurrency and rate limit can't be negative. Using no limit")
+            self.pull_concurrency, self.pull_rate_limit = max(0, self.pull_concurrency), max(0, self.pull_rate_limit)
+
+        if self.rollback_retention < 0 or self.rollback_grace < 0:
+            self.logger.error("Rollback retention and grace can't be negative. Using 0")
+            self.rollback_retention, self.rollback_grace = max(0, self.rollback_retention), max(0, self.rollback_grace)
+
+        if self.rollout_wave_size < 0:
+            self.logger.error("Rollout wave size can't be negative. Updating the sockets on their own")
+            self.rollout_wave_size = 0
+
+        if self.rollout_wave_size:
+            if self.swarm:
+                self.logger.warning("Rollouts are not used in swarm mode, services roll out with their update config")
+                self.rollout_wave_size = 0
+            elif not self.rollback_grace:
+                self.logger.warning("A rollout needs a rollback grace to watch its waves. Using %d",
+                                    Config.rollback_grace)
+                self.rollback_grace = Config.rollback_grace
+            if self.rollout_canary and self.rollout_canary not in self.docker_sockets:
+                self.logger.error("Rollout canary %s is not one of the docker sockets. Using %s",
+                                  self.rollout_canary, self.docker_sockets[0])
+                self.rollout_canary = None
+
+        if self.pull_source:
+            if self.swarm:
+                self.logger.warning("A pull source is not used in swarm mode")
+                self.pull_source = None
+            elif self.pull_source not in self.docker_sockets:
+                self.logger.error("Pull source %s is not one of the docker sockets. Every socket pulls on its own",
+                                  self.pull_source)
+                self.pull_source = None
+
+        if self.check_engine not in ['sync', 'async']:
+            self.logger.error("Check engine must be sync or async. Using sync")
+            self.check_engine = 'sync'
+
+        if self.check_engine == 'async':
+            if self.swarm or self.record or self.replay or self.rollout_wave_size:
+                self.logger.warning("The async check engine does not support swarm, record, replay or rollouts. "
+                                    "Using sync")
+                self.check_engine = 'sync'
+            elif find_spec('aiohttp') is None:
+                self.logger.error("The async check engine needs aiohttp, install ouroboros-cli[async]. Using sync")
+                self.check_engine = 'sync'
+
+        if self.cycle_budget < 0:
+            self.logger.error("Cycle budget can't be negative. Using no budget")
+            self.cycle_budget = 0
+
+        if self.rollback_retention and self.swarm:
+            self.logger.warning("Rollback retention is not used in swarm mode, services roll back with "
+                                "docker service rollback")
+
+        if self.tag_cache_ttl < 0:
+            self.logger.error("Tag cache TTL can't be negative. Listing all tags every cycle")
+            self.tag_cache_ttl = 0
+
+        if self.priority_max_wait < 0:
+            self.logger.error("Priority max wait can't be negative. Letting waiting containers only age")
+            self.priority_max_wait = 0
+
+        if self.priorities:
+            self.priorities = [f'{name}={priority}' for name, priority in parse_priorities(self.priorities).items()]
+
+        if self.monitor_recheck < 0:
+            self.logger.error("Monitor recheck can't be negative. Checking outdated containers every cycle")
+            self.monitor_recheck = 0
+
+        if self.status_port < 0:
+            self.logger.error("Status port can't be negative. Not serving the status API")
+            self.status_port = 0
+
+        if self.status_port and (self.worker_processes or self.run_once):
+            self.logger.warning("The status API is not served with worker processes or run once")
+            self.status_port = 0
+
+        if self.worker_processes < 0:
+            self.logger.error("Worker processes can't be negative. Updating all sockets in this process")
+            self.worker_processes = 0
+
+        if self.worker_processes and (self.record or self.replay or self.rollout_wave_size or self.pull_source):
+            self.logger.warning("Worker processes do not support record, replay, rollouts or a pull source. "
+                                "Using none")
+            self.worker_processes = 0
+
+        if self.record and self.replay:
+            self.logger.error("Recording and replaying at the same time is not supported. Disabling recording.")
+            self.record = None
+
+        if self.replay:
+            # Replay serves the sockets that were recorded, not the configured ones
+            from pyouroboros.recorder import load_trace
+            self.docker_sockets = load_trace(self.replay).sockets
+            self.logger.info("Replaying Docker API traffic from %s for %s", self.replay, self.docker_sockets)
+
         # Remove default config that is not used for cleaner logs
         if self.data_export != 'prometheus':
             self.prometheus_addr, self.prometheus_port = None, None
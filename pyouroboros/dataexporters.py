@@ -1,8 +1,7 @@
-import prometheus_client
 import json
 from os import unlink
+from collections import Counter
 from logging import getLogger
-from influxdb import InfluxDBClient
 from datetime import datetime, timezone
 from pathlib import Path
 from pyouroboros.helpers import get_exec_dir
@@ -15,6 +14,13 @@ class DataManager(object):
 
         self.monitored_containers = {}
         self.total_updated = {}
+        self.docker_connections = {}
+        self.socket_health = {}
+        self.pull_errors = Counter()
+        self.pull_bytes = Counter()
+        self.cycles = {}
+        self.cycle_overruns = Counter()
+        self.windows = {}
 
         self.prometheus = PrometheusExporter(self, config) if self.config.data_export == "prometheus" else None
         self.influx = InfluxClient(self, config) if self.config.data_export == "influxdb" else None
@@ -33,6 +39,79 @@ class DataManager(object):
         if self.config.data_export == "prometheus" and self.enabled:
             self.prometheus.set_monitored(socket)
 
+    def set_connections(self, socket, created, reused):
+        """Record the Docker API connections opened and reused on a socket"""
+        self.docker_connections[socket] = {'opened': created, 'reused': reused}
+        if self.config.data_export == "prometheus" and self.enabled:
+            self.prometheus.set_connections(socket)
+
+        elif self.config.data_export == "influxdb" and self.enabled:
+            self.influx.write_fields(socket, 'connections', self.docker_connections[socket])
+
+    def set_health(self, socket, breaker, probe_seconds=None):
+        """Record the circuit breaker state of a socket, and the duration of its last successful probe"""
+        self.socket_health[socket] = {
+            'up': int(breaker.state == breaker.CLOSED),
+            'state': breaker.state,
+            'failures': breaker.failures,
+            'retry_in': round(breaker.retry_in, 3)
+        }
+        if probe_seconds is not None:
+            self.socket_health[socket]['probe_seconds'] = round(probe_seconds, 6)
+
+        if self.config.data_export == "prometheus" and self.enabled:
+            self.prometheus.set_health(socket)
+
+        elif self.config.data_export == "influxdb" and self.enabled:
+            self.influx.write_fields(socket, 'health', self.socket_health[socket])
+
+    def add_pull_error(self, socket, registry, error_class):
+        """Count a failed (or skipped) pull by registry and error class"""
+        self.pull_errors[(registry, error_class)] += 1
+        if self.config.data_export == "prometheus" and self.enabled:
+            self.prometheus.add_pull_error(socket, registry, error_class)
+
+        elif self.config.data_export == "influxdb" and self.enabled:
+            self.influx.write_fields(socket, 'pull_error', {'count': 1},
+                                     tags={'registry': registry, 'error_class': error_class})
+
+    def add_pull_bytes(self, socket, registry, downloaded):
+        """Count the bytes a pull downloaded, by socket and registry"""
+        self.pull_bytes[(socket, registry)] += downloaded
+        if self.config.data_export == "prometheus" and self.enabled:
+            self.prometheus.add_pull_bytes(socket, registry, downloaded)
+
+        elif self.config.data_export == "influxdb" and self.enabled:
+            self.influx.write_fields(socket, 'pull', {'bytes': downloaded}, tags={'registry': registry})
+
+    def set_cycle(self, socket, seconds, carried_over):
+        """Record the duration of the last update cycle of a socket, and how many containers it left to the next"""
+        self.cycles[socket] = {'seconds': round(seconds, 3), 'carried_over': carried_over}
+        if self.config.data_export == "prometheus" and self.enabled:
+            self.prometheus.set_cycle(socket)
+
+        elif self.config.data_export == "influxdb" and self.enabled:
+            self.influx.write_fields(socket, 'cycle', self.cycles[socket])
+
+    def add_cycle_overrun(self, socket, reason):
+        """Count an update cycle that ran out of its budget, or a scheduled one that was skipped or missed"""
+        self.cycle_overruns[(socket, reason)] += 1
+        if self.config.data_export == "prometheus" and self.enabled:
+            self.prometheus.add_cycle_overrun(socket, reason)
+
+        elif self.config.data_export == "influxdb" and self.enabled:
+            self.influx.write_fields(socket, 'cycle_overrun', {'count': 1}, tags={'reason': reason})
+
+    def set_window(self, socket, seconds, window_seconds, applied):
+        """Record how long applying the updates of the last maintenance window of a socket took"""
+        self.windows[socket] = {'apply_seconds': round(seconds, 3), 'window_seconds': window_seconds,
+                                'applied': applied}
+        if self.config.data_export == "prometheus" and self.enabled:
+            self.prometheus.set_window(socket)
+
+        elif self.config.data_export == "influxdb" and self.enabled:
+            self.influx.write_fields(socket, 'window', self.windows[socket])
+
     def save(self):
         if self.config.save_counters:
             fpath = Path(get_exec_dir() + '/hooks/datamanager.json')
@@ -55,12 +134,16 @@ class DataManager(object):
 
 class PrometheusExporter(object):
     def __init__(self, data_manager, config):
+        # Imported here so that prometheus_client is only loaded when the exporter is enabled
+        import prometheus_client
+
         self.config = config
         self.data_manager = data_manager
+        # The status API serves the metrics if it listens on the same port
         self.http_server = prometheus_client.start_http_server(
             self.config.prometheus_port,
             addr=self.config.prometheus_addr
-        )
+        ) if self.config.status_port != self.config.prometheus_port else None
         self.updated_containers_counter = prometheus_client.Counter(
             'containers_updated',
             'Count of containers updated',
@@ -76,8 +159,96 @@ class PrometheusExporter(object):
             'Count of total updated',
             ['socket']
         )
+        self.docker_connections_gauge = prometheus_client.Gauge(
+            'docker_connections',
+            'Docker API connections opened and requests that reused a pooled connection',
+            ['socket', 'state']
+        )
+        self.socket_up_gauge = prometheus_client.Gauge(
+            'docker_socket_up',
+            'Whether the docker socket answered its last health probe',
+            ['socket']
+        )
+        self.socket_failures_gauge = prometheus_client.Gauge(
+            'docker_socket_consecutive_failures',
+            'Consecutive failed calls to the docker socket',
+            ['socket']
+        )
+        self.socket_probe_gauge = prometheus_client.Gauge(
+            'docker_socket_probe_seconds',
+            'Duration of the last successful health probe of the docker socket',
+            ['socket']
+        )
+        self.pull_errors_counter = prometheus_client.Counter(
+            'registry_pull_errors',
+            'Count of failed pulls by registry and error class',
+            ['socket', 'registry', 'error_class']
+        )
+        self.pull_bytes_counter = prometheus_client.Counter(
+            'registry_pull_bytes',
+            'Count of bytes downloaded by pulls, by registry',
+            ['socket', 'registry']
+        )
+        self.cycle_seconds_gauge = prometheus_client.Gauge(
+            'update_cycle_seconds',
+            'Duration of the last update cycle of the docker socket',
+            ['socket']
+        )
+        self.cycle_carried_over_gauge = prometheus_client.Gauge(
+            'update_cycle_carried_over',
+            'Containers the last update cycle did not check or update within its budget',
+            ['socket']
+        )
+        self.cycle_overruns_counter = prometheus_client.Counter(
+            'update_cycle_overruns',
+            'Count of update cycles that ran out of their budget (budget), or were skipped because the previous one '
+            'was still running (skipped) or started too late (missed)',
+            ['socket', 'reason']
+        )
+        self.window_apply_seconds_gauge = prometheus_client.Gauge(
+            'maintenance_apply_seconds',
+            'Duration of applying the updates of the last maintenance window of the docker socket',
+            ['socket']
+        )
+        self.window_seconds_gauge = prometheus_client.Gauge(
+            'maintenance_window_seconds',
+            'Length of the maintenance window',
+            ['socket']
+        )
         self.logger = getLogger()
 
+    def set_window(self, socket):
+        window = self.data_manager.windows[socket]
+        self.window_apply_seconds_gauge.labels(socket=socket).set(window['apply_seconds'])
+        self.window_seconds_gauge.labels(socket=socket).set(window['window_seconds'])
+
+    def set_cycle(self, socket):
+        cycle = self.data_manager.cycles[socket]
+        self.cycle_seconds_gauge.labels(socket=socket).set(cycle['seconds'])
+        self.cycle_carried_over_gauge.labels(socket=socket).set(cycle['carried_over'])
+
+    def add_cycle_overrun(self, socket, reason):
+        self.cycle_overruns_counter.labels(socket=socket, reason=reason).inc()
+
+    def add_pull_error(self, socket, registry, error_class):
+        self.pull_errors_counter.labels(socket=socket, registry=registry, error_class=error_class).inc()
+
+    def add_pull_bytes(self, socket, registry, downloaded):
+        self.pull_bytes_counter.labels(socket=socket, registry=registry).inc(downloaded)
+
+    def set_health(self, socket):
+        """Set the health gauges of a socket"""
+        health = self.data_manager.socket_health[socket]
+        self.socket_up_gauge.labels(socket=socket).set(health['up'])
+        self.socket_failures_gauge.labels(socket=socket).set(health['failures'])
+        if 'probe_seconds' in health:
+            self.socket_probe_gauge.labels(socket=socket).set(health['probe_seconds'])
+
+    def set_connections(self, socket):
+        """Set the Docker API connection pool gauges of a socket"""
+        for state, count in self.data_manager.docker_connections[socket].items():
+            self.docker_connections_gauge.labels(socket=socket, state=state).set(count)
+
     def set_monitored(self, socket):
         """Set number of containers being monitoring with a gauge"""
         self.monitored_containers_gauge.labels(socket=socket).set(self.data_manager.monitored_containers[socket])
@@ -96,6 +267,9 @@ class PrometheusExporter(object):
 
 class InfluxClient(object):
     def __init__(self, data_manger, config):
+        # Imported here so that influxdb (and its dependencies) are only loaded when the exporter is enabled
+        from influxdb import InfluxDBClient
+
         self.data_manager = data_manger
         self.config = config
         self.logger = getLogger()
@@ -155,3 +329,16 @@ class InfluxClient(object):
 
         self.logger.debug("Writing data to influxdb: %s", influx_payload)
         self.influx.write_points(influx_payload)
+
+    def write_fields(self, socket, kind, fields, tags=None):
+        """Write one point of `fields` for a socket, tagged with the type `kind` and any extra `tags`"""
+        influx_payload = [
+            {
+                "measurement": "Ouroboros",
+                "tags": {'socket': socket.split("//")[1], 'type': kind, **(tags or {})},
+                "time": datetime.now(timezone.utc).astimezone().isoformat(),
+                "fields": fields
+            }
+        ]
+        self.logger.debug("Writing data to influxdb: %s", influx_payload)
+        self.influx.write_points(influx_payload)
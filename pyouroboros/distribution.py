@@ -0,0 +1,181 @@
+"""
+Image distribution from one socket to the others
+
+With PULL_SOURCE, the other sockets don't pull images from the registry. The source socket pulls them, once per
+image for all sockets, and every other socket gets the image streamed from the source through the save
+(GET /images/{id}/get) and load (POST /images/load) endpoints of the Engine API. The stream is passed on in chunks,
+the tarball is never held in memory. Layers the target already has are left out of the stream.
+"""
+import tarfile
+
+from hashlib import sha256
+from time import monotonic
+from threading import Lock
+from logging import getLogger
+from docker.errors import DockerException, NotFound
+from requests.exceptions import RequestException
+
+from pyouroboros.profiler import span
+from pyouroboros.rollback import split_reference
+
+# Seconds an image pulled on the source is not pulled again, for the sockets checking it in the same cycle
+SOURCE_PULL_TTL = 60
+STREAM_CHUNK = 1024 * 1024
+# Layers in the OCI layout of docker save (Engine 25 and later) are blobs named by their diff ID. The layers of
+# the legacy layout can't be told apart before the manifest at the end of the stream, they are always sent.
+LAYER_BLOB_PREFIX = 'blobs/sha256/'
+
+
+def chain_ids(diff_ids):
+    """Return the chain IDs of the layers of an image, which identify a layer with the layers below it"""
+    chains = []
+    for diff_id in diff_ids:
+        chains.append(diff_id if not chains else 'sha256:' + sha256(f'{chains[-1]} {diff_id}'.encode()).hexdigest())
+    return chains
+
+
+class ChunkReader(object):
+    """File object over an iterator of byte chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.position = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.position < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer = self.buffer[self.position:] + chunk
+            self.position = 0
+        end = len(self.buffer) if size < 0 else min(len(self.buffer), self.position + size)
+        data = self.buffer[self.position:end]
+        self.position = end
+        return data
+
+
+def without_members(chunks, skipped):
+    """Yield the tar stream of `chunks` without the members named in `skipped`, in chunks of at most STREAM_CHUNK"""
+    archive = tarfile.open(fileobj=ChunkReader(chunks), mode='r|')
+    for member in archive:
+        if member.name in skipped:
+            continue
+        yield member.tobuf(archive.format, archive.encoding, archive.errors)
+        if member.isfile():
+            content = archive.extractfile(member)
+            while True:
+                data = content.read(STREAM_CHUNK)
+                if not data:
+                    break
+                yield data
+            if member.size % tarfile.BLOCKSIZE:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - member.size % tarfile.BLOCKSIZE)
+    yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+class Distributor(object):
+    """Pulls images on the source socket, and streams them to the sockets that pull through it"""
+
+    def __init__(self, source):
+        self.source = source
+        self.logger = getLogger()
+        self.lock = Lock()
+        self.tag_locks = {}
+        self.pulled = {}
+
+    @classmethod
+    def attach(cls, modes, config):
+        """Let the container modes pull through the source, if it is one of `modes`"""
+        source = next((mode for mode in modes if mode.socket == config.pull_source), None)
+        if source is None:
+            getLogger().error('Pull source %s is not connected, every socket pulls on its own', config.pull_source)
+            return
+        distributor = cls(source)
+        for mode in modes:
+            if mode.mode == 'container':
+                mode.distributor = distributor
+
+    def source_image_id(self, tag):
+        """Return the ID of the image of `tag` on the source, pulling it unless it was pulled moments ago"""
+        with self.lock:
+            tag_lock = self.tag_locks.setdefault(tag, Lock())
+        with tag_lock:
+            image_id, pulled_at = self.pulled.get(tag, (None, None))
+            if image_id is None or monotonic() - pulled_at >= SOURCE_PULL_TTL:
+                image_id = self.source._pull(tag).id
+                self.pulled[tag] = image_id, monotonic()
+            return image_id
+
+    def fetch(self, target, tag):
+        """
+        Return the image of `tag` on the `target` socket, streamed from the source if the target doesn't have it.
+        None if the source can't be reached or the stream failed, the target pulls on its own then. Registry errors
+        of the source pull are raised like the errors of a pull. The source shares the pulls of the other sockets.
+        """
+        if target is self.source:
+            return target.client.images.get(self.source_image_id(tag))
+        try:
+            image_id = self.source_image_id(tag)
+        except (DockerException, RequestException) as e:
+            self.logger.warning('Could not pull %s on the pull source %s, pulling it on %s. Error: %s', tag,
+                                self.source.socket, target.socket, e, extra={'socket': target.socket, 'phase': 'pull'})
+            return None
+
+        try:
+            try:
+                target.client.api.inspect_image(image_id)
+            except NotFound:
+                with span('distribute', socket=target.socket, image=tag):
+                    self.stream(image_id, target)
+            repository, reference = split_reference(tag)
+            if reference:
+                target.client.api.tag(image_id, repository, reference, force=True)
+            return target.client.images.get(image_id)
+        except (DockerException, RequestException, tarfile.TarError, OSError) as e:
+            self.logger.warning('Could not stream %s from %s to %s, pulling it there. Error: %s', tag,
+                                self.source.socket, target.socket, e, extra={'socket': target.socket, 'phase': 'pull'})
+            return None
+
+    def stream(self, image_id, target):
+        stream_start = monotonic()
+        skipped = self.present_layers(image_id, target)
+        try:
+            self.load(image_id, target, skipped)
+        except DockerException as e:
+            if not skipped:
+                raise
+            # The target did not have a layer after all
+            self.logger.debug('Loading %s on %s without %d layers failed, sending them. Error: %s', image_id[7:19],
+                              target.socket, len(skipped), e, extra={'socket': target.socket, 'phase': 'pull'})
+            skipped = set()
+            self.load(image_id, target, skipped)
+        self.logger.debug('Streamed %s from %s to %s in %.2fs, leaving out %d layers', image_id[7:19],
+                          self.source.socket, target.socket, monotonic() - stream_start, len(skipped),
+                          extra={'socket': target.socket, 'phase': 'pull'})
+
+    def load(self, image_id, target, skipped):
+        chunks = self.source.client.api.get_image(image_id, chunk_size=STREAM_CHUNK)
+        for line in target.client.api.load_image(without_members(chunks, skipped) if skipped else chunks):
+            if line.get('error'):
+                raise DockerException(line['error'])
+
+    def present_layers(self, image_id, target):
+        """
+        Return the names of the layer blobs of an image that the target has already, with the layers below them.
+        Only the images of the same repository are looked at, they are the ones that share layers.
+        """
+        source_image = self.source.client.api.inspect_image(image_id)
+        diff_ids = source_image['RootFS']['Layers']
+        present = set()
+        for repository in {split_reference(tag)[0] for tag in source_image.get('RepoTags') or []}:
+            for image in target.client.api.images(name=repository):
+                present.update(chain_ids(target.client.api.inspect_image(image['Id'])['RootFS']['Layers']))
+
+        shared = 0
+        for chain_id in chain_ids(diff_ids):
+            if chain_id not in present:
+                break
+            shared += 1
+        # The load reads a layer from the stream unless its chain is present, whatever its diff ID
+        return {LAYER_BLOB_PREFIX + diff_id[7:] for diff_id in set(diff_ids[:shared]) - set(diff_ids[shared:])}
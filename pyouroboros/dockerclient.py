@@ -1,23 +1,128 @@
-from time import sleep
+import re
+
+from time import sleep, monotonic, time
+from random import uniform
+from itertools import repeat
 from logging import getLogger
+from threading import BoundedSemaphore, Lock
+from contextlib import nullcontext
 from docker import DockerClient, tls
+from docker.utils import parse_repository_tag
 from os.path import isdir, isfile, join
+from socket import SOL_SOCKET, SO_KEEPALIVE, IPPROTO_TCP
+from concurrent.futures import ThreadPoolExecutor
 from docker.errors import DockerException, APIError, NotFound
-
-from pyouroboros.helpers import set_properties, remove_sha_prefix, get_digest, run_hook
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from docker.transport.unixconn import UnixHTTPAdapter, UnixHTTPConnectionPool
+from requests.exceptions import RequestException
+
+try:
+    from socket import TCP_KEEPIDLE, TCP_KEEPINTVL
+except ImportError:
+    TCP_KEEPIDLE = TCP_KEEPINTVL = None
+
+from pyouroboros.helpers import (set_properties, remove_sha_prefix, get_digest, run_hook, registry_host,
+                                 container_name)
+from pyouroboros.recorder import load_trace, record_session, replay_session
+from pyouroboros.profiler import span, bind
+from pyouroboros.circuitbreaker import CircuitBreaker
+from pyouroboros.snapshot import ContainerSnapshot, ImageSnapshot
+from pyouroboros.workqueue import WorkQueue, parse_priorities
+from pyouroboros.rollback import RollbackStore, split_reference, container_config
+from pyouroboros.semver import TRACK_LABEL, best_tag
+from pyouroboros.pulls import TokenBucket, PullProgress, PROGRESS_INTERVAL
+from pyouroboros.announcements import AnnouncementStore
+from pyouroboros.handoff import Handoff
+from pyouroboros.registry import (PullError, classify_error, registry_breaker, parse_reference, tag_lister, AUTH,
+                                  TIMEOUT, CIRCUIT_OPEN, REGISTRY_ERRORS, RETRIED_ERRORS, RETRY_DELAY)
+
+
+# Result of a container check skipped because the cycle ran out of its budget
+UNCHECKED = 'unchecked'
+
+
+class UnixSocketConnectionPool(UnixHTTPConnectionPool):
+    def _new_conn(self):
+        # urllib3 only counts the connections it opens itself
+        self.num_connections += 1
+        return super()._new_conn()
+
+
+class UnixSocketAdapter(UnixHTTPAdapter):
+    """
+    HTTP adapter for unix:// sockets with one connection pool per socket
+
+    docker-py keeps a pool per request URL, so nearly every request (they contain container and image ids) opened
+    a new connection. All requests go to the same daemon, so they can share one pool.
+    """
+
+    def get_connection(self, url, proxies=None):
+        with self.pools.lock:
+            pool = self.pools.get(self.socket_path)
+            if pool is None:
+                pool = UnixSocketConnectionPool('http+docker://localhost', self.socket_path, self.timeout,
+                                                maxsize=self.max_pool_size)
+                self.pools[self.socket_path] = pool
+        return pool
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    """
+    HTTP(S) adapter for tcp:// sockets
+
+    Threads wait for a pooled connection instead of opening throwaway ones, and idle connections are kept alive
+    with TCP keep-alive probes, so that TLS handshakes are only paid when the pool grows.
+    """
+
+    def __init__(self, pool_size, keepalive, **kwargs):
+        self.keepalive = keepalive
+        super().__init__(pool_connections=1, pool_maxsize=pool_size, pool_block=True, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            socket_options = HTTPConnection.default_socket_options + [(SOL_SOCKET, SO_KEEPALIVE, 1)]
+            if TCP_KEEPIDLE is not None:
+                socket_options += [(IPPROTO_TCP, TCP_KEEPIDLE, self.keepalive),
+                                   (IPPROTO_TCP, TCP_KEEPINTVL, max(1, self.keepalive // 4))]
+            kwargs['socket_options'] = socket_options
+        super().init_poolmanager(*args, **kwargs)
 
 
 class Docker(object):
     def __init__(self, socket, config, data_manager, notification_manager):
         self.config = config
         self.socket = socket
-        self.client = self.connect()
-        self.data_manager = data_manager
         self.logger = getLogger()
-
+        self.data_manager = data_manager
         self.notification_manager = notification_manager
+        self.breaker = CircuitBreaker(socket, backoff=self.config.docker_backoff,
+                                      max_backoff=self.config.docker_max_backoff)
+
+        try:
+            self.client = self.connect()
+        except DockerException as e:
+            # Connecting is retried by the health probe, so that one bad socket does not stop the others
+            self.client = None
+            self.mark_unhealthy(e)
+
+    def reconnect(self):
+        """Connect again with the options of a reloaded configuration. A cycle still using the old client keeps it."""
+        try:
+            self.client = self.connect()
+        except DockerException as e:
+            self.client = None
+            self.mark_unhealthy(e)
 
     def connect(self):
+        if self.config.replay:
+            # The version is taken from the trace, so that the client does not need to ask a daemon for it
+            trace = load_trace(self.config.replay)
+            client = DockerClient(base_url='tcp://replay:2375', version=trace.api_versions.get(self.socket),
+                                  timeout=self.config.docker_timeout)
+            replay_session(client.api, self.socket, self.config)
+            return client
+
         if self.config.docker_tls:
             try:
                 cert_paths = {
@@ -45,61 +150,210 @@ class Docker(object):
                     verify=cert_paths['cert_files']['ca_crt'] if self.config.docker_tls_verify else False,
                     client_cert=(cert_paths['cert_files']['client_cert'], cert_paths['cert_files']['client_key'])
                 )
-                client = DockerClient(base_url=self.socket, tls=tls_config, timeout=self.config.docker_timeout)
+                client = DockerClient(base_url=self.socket, tls=tls_config, timeout=self.config.docker_timeout,
+                                      max_pool_size=self.pool_size)
             except ValueError:
                 self.logger.error('Invalid Docker TLS config for %s, reverting to unsecured', self.socket)
-                client = DockerClient(base_url=self.socket, timeout=self.config.docker_timeout)
+                client = DockerClient(base_url=self.socket, timeout=self.config.docker_timeout,
+                                      max_pool_size=self.pool_size)
         else:
-            client = DockerClient(base_url=self.socket, timeout=self.config.docker_timeout)
+            client = DockerClient(base_url=self.socket, timeout=self.config.docker_timeout,
+                                  max_pool_size=self.pool_size)
+
+        adapter = client.api.adapters.get('http+docker://')
+        if type(adapter) is UnixHTTPAdapter:
+            client.api.mount('http+docker://', UnixSocketAdapter(f'http+unix://{adapter.socket_path}',
+                                                                 timeout=adapter.timeout,
+                                                                 max_pool_size=self.pool_size))
+        # docker-py only sizes the pool of unix/npipe/ssh sockets, tcp sockets use the requests default adapters
+        elif client.api.base_url.startswith(('http://', 'https://')):
+            adapter = KeepAliveHTTPAdapter(self.pool_size, self.config.docker_keepalive)
+            client.api.mount('http://', adapter)
+            client.api.mount('https://', adapter)
+
+        if self.config.record:
+            recorder = record_session(client.api, self.socket, self.config)
+            recorder.add_source(self.socket, api_version=client.api.api_version)
 
         return client
 
+    def ping(self):
+        """Probe the daemon with a short timeout. Any answer that is not a server error counts as healthy."""
+        response = self.client.api.get(f'{self.client.api.base_url}/_ping', timeout=self.config.docker_probe_timeout)
+        if response.status_code >= 500:
+            raise DockerException(f'Ping failed with status {response.status_code}')
+
+    def healthy(self):
+        """Return whether the socket can be used this cycle, probing it unless its circuit breaker is open"""
+        if not self.breaker.allow():
+            self.logger.debug('Skipping %s, it is unhealthy. Next probe in %.0fs', self.socket, self.breaker.retry_in,
+                              extra={'socket': self.socket, 'phase': 'probe'})
+            return False
+
+        probe_start = monotonic()
+        try:
+            with span('probe', socket=self.socket):
+                if self.client is None:
+                    self.client = self.connect()
+                self.ping()
+        except (DockerException, RequestException, OSError) as e:
+            self.mark_unhealthy(e)
+            return False
+
+        if self.breaker.state != CircuitBreaker.CLOSED:
+            self.logger.info('Docker API at %s is healthy again', self.socket, extra={'socket': self.socket})
+        self.breaker.success()
+        self.data_manager.set_health(self.socket, self.breaker, monotonic() - probe_start)
+        return True
+
+    def mark_unhealthy(self, error):
+        """Record a failed call to the socket on its circuit breaker"""
+        if self.breaker.failure():
+            self.logger.error("Can't connect to Docker API at %s, skipping it for %.0fs. Error: %s", self.socket,
+                              self.breaker.retry_in, error, extra={'socket': self.socket, 'phase': 'probe'})
+        self.data_manager.set_health(self.socket, self.breaker)
+
+    @property
+    def pool_size(self):
+        # Every check worker needs its own connection, or the pool would be the bottleneck
+        return max(self.config.docker_pool_size, self.config.check_workers)
+
+    def connection_stats(self):
+        """Return the connections opened and the requests that reused a pooled connection for this socket"""
+        created, requests = 0, 0
+        if self.client is None:
+            return created, requests
+        for adapter in set(self.client.api.adapters.values()):
+            # Unwrap the recording adapter
+            adapter = getattr(adapter, 'adapter', adapter)
+            pools = getattr(adapter, 'pools', None)
+            if pools is None and getattr(adapter, 'poolmanager', None) is not None:
+                pools = adapter.poolmanager.pools
+            if pools is None:
+                continue
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    created += pool.num_connections
+                    requests += pool.num_requests
+        return created, max(0, requests - created)
+
+    def report_connections(self):
+        created, reused = self.connection_stats()
+        self.logger.debug('Docker connections for %s: %d opened, %d requests reused a connection',
+                          self.socket, created, reused)
+        self.data_manager.set_connections(self.socket, created, reused)
+
 
 class BaseImageObject(object):
     def __init__(self, docker_client):
         self.docker = docker_client
         self.logger = self.docker.logger
         self.config = self.docker.config
-        self.client = self.docker.client
         self.socket = self.docker.socket
         self.data_manager = self.docker.data_manager
         self.data_manager.total_updated[self.socket] = 0
         self.notification_manager = self.docker.notification_manager
+        # Limits of the pulls of this socket: pulls at a time, and bytes per second
+        self.pull_slots = BoundedSemaphore(self.config.pull_concurrency) if self.config.pull_concurrency else None
+        self.pull_bucket = TokenBucket(self.config.pull_rate_limit * 1024) if self.config.pull_rate_limit else None
+        self.announcements = AnnouncementStore(self.socket) if self.config.monitor_only else None
+
+    def reconfigure(self, options):
+        """Rebuild what was built from the `options` that changed on a configuration reload"""
+        if 'PULL_CONCURRENCY' in options:
+            self.pull_slots = BoundedSemaphore(self.config.pull_concurrency) if self.config.pull_concurrency else None
+        if 'PULL_RATE_LIMIT' in options:
+            self.pull_bucket = TokenBucket(self.config.pull_rate_limit * 1024) if self.config.pull_rate_limit else None
+        if 'MONITOR_ONLY' in options:
+            self.announcements = AnnouncementStore(self.socket) if self.config.monitor_only else None
+        if 'DOCKER_BACKOFF' in options or 'DOCKER_MAX_BACKOFF' in options:
+            # The breaker keeps its state, the next backoff uses the new limits
+            self.docker.breaker.backoff = self.config.docker_backoff
+            self.docker.breaker.max_backoff = self.config.docker_max_backoff
+
+    @property
+    def client(self):
+        # The docker client is replaced when a socket that was down at startup comes back
+        return self.docker.client
 
     def _pull(self, tag):
         """Docker pull image tag"""
-        self.logger.debug('Checking tag: %s', tag)
-        try:
-            if self.config.dry_run:
-                # The authentication doesn't work with this call
-                # See bugs https://github.com/docker/docker-py/issues/2225
-                return self.client.images.get_registry_data(tag)
-            else:
-                if self.config.auth_json:
-                    return_image = self.client.images.pull(tag, auth_config=self.config.auth_json)
-                else:
-                    return_image = self.client.images.pull(tag)
-                return return_image
-        except APIError as e:
-            self.logger.debug(str(e))
-            if '<html>' in str(e):
-                self.logger.debug("Docker api issue. Ignoring")
-                raise ConnectionError
-            elif 'unauthorized' in str(e):
+        self.logger.debug('Checking tag: %s', tag, extra={'socket': self.socket, 'phase': 'pull'})
+        registry = registry_host(tag)
+        breaker = registry_breaker(registry, self.config)
+        for attempt in range(self.config.pull_retries + 1):
+            if not breaker.allow():
+                self.logger.debug('Skipping %s, registry %s is failing. Next try in %.0fs', tag, registry,
+                                  breaker.retry_in, extra={'socket': self.socket, 'phase': 'pull'})
+                self.data_manager.add_pull_error(self.socket, registry, CIRCUIT_OPEN)
+                raise PullError(registry, CIRCUIT_OPEN)
+            try:
                 if self.config.dry_run:
+                    # The authentication doesn't work with this call
+                    # See bugs https://github.com/docker/docker-py/issues/2225
+                    image = self.client.images.get_registry_data(tag)
+                else:
+                    image = self.stream_pull(tag)
+            except (DockerException, RequestException) as e:
+                self.logger.debug(str(e))
+                error_class = classify_error(e)
+                self.data_manager.add_pull_error(self.socket, registry, error_class)
+                if error_class in REGISTRY_ERRORS:
+                    if breaker.failure():
+                        self.logger.error('Registry %s is failing, skipping its images for %.0fs', registry,
+                                          breaker.retry_in, extra={'socket': self.socket, 'phase': 'pull'})
+                else:
+                    # The registry answered, the error is about this image
+                    breaker.success()
+
+                if error_class in RETRIED_ERRORS and attempt < self.config.pull_retries:
+                    delay = uniform(0, RETRY_DELAY * 2 ** attempt)
+                    self.logger.debug('%s error pulling %s, retrying in %.1fs', error_class, tag, delay,
+                                      extra={'socket': self.socket, 'phase': 'pull'})
+                    sleep(delay)
+                    continue
+
+                if error_class == AUTH and self.config.dry_run:
                     self.logger.error('dry run : Upstream authentication issue while checking %s. See: '
                                       'https://github.com/docker/docker-py/issues/2225', tag)
-                    raise ConnectionError
+                elif error_class == AUTH:
+                    self.logger.error('Invalid credentials for %s on %s. Skipping', tag, registry)
+                elif error_class == TIMEOUT:
+                    self.logger.error("Timed out pulling %s from %s. Local Build? Skipping", tag, registry)
                 else:
-                    self.logger.critical("Invalid Credentials. Exiting")
-                    exit(1)
-            elif 'Client.Timeout' in str(e):
-                self.logger.critical(
-                    "Couldn't find an image on docker.com for %s. Local Build?", tag)
-                raise ConnectionError
-            elif ('pull access' or 'TLS handshake') in str(e):
-                self.logger.critical("Couldn't pull. Skipping. Error: %s", e)
-                raise ConnectionError
+                    self.logger.error("Couldn't pull %s (%s error). Skipping. Error: %s", tag, error_class,
+                                      getattr(e, 'explanation', None) or e)
+                raise PullError(registry, error_class, e) from e
+
+            breaker.success()
+            return image
+
+    def stream_pull(self, tag):
+        """Pull through the progress stream, within the pull limits of the socket"""
+        repository, reference = parse_repository_tag(tag)
+        reference = reference or 'latest'
+        with self.pull_slots or nullcontext():
+            progress = PullProgress(tag)
+            logged = monotonic()
+            try:
+                for line in self.client.api.pull(repository, tag=reference, stream=True, decode=True,
+                                                 auth_config=self.config.auth_json):
+                    downloaded = progress.feed(line)
+                    if downloaded and self.pull_bucket is not None:
+                        self.pull_bucket.consume(downloaded)
+                    if monotonic() - logged >= PROGRESS_INTERVAL:
+                        logged = monotonic()
+                        self.logger.debug('Pulling %s: %s', tag, progress.summary(),
+                                          extra={'socket': self.socket, 'phase': 'pull'})
+            finally:
+                if progress.downloaded:
+                    self.data_manager.add_pull_bytes(self.socket, registry_host(tag), progress.downloaded)
+
+        if progress.downloaded:
+            self.logger.debug('Pulled %s: %s', tag, progress.summary(), extra={'socket': self.socket, 'phase': 'pull'})
+        separator = '@' if reference.startswith('sha256:') else ':'
+        return self.client.images.get(f'{repository}{separator}{reference}')
 
 
 class Container(BaseImageObject):
@@ -107,11 +361,47 @@ class Container(BaseImageObject):
 
     def __init__(self, docker_client):
         super().__init__(docker_client)
-        self.monitored = self.monitor_filter()
+        # Work the last cycle did not get to within its budget: the IDs of the containers it did not check, and the
+        # updates it found but did not apply. Both wait in the queue, which orders checks and updates by priority.
+        self.carried_over = []
+        self.pending_updates = []
+        self.queue = WorkQueue(self.config.priorities, self.config.priority_max_wait)
+        self.rollbacks = RollbackStore(self.socket)
+        # (name, image ID) of the containers that failed their watch this cycle, and images not to update to, which
+        # a Rollout shares between its sockets
+        self.failed = []
+        self.rejected_images = set()
+        # Pulls through the PULL_SOURCE socket, see Distributor
+        self.distributor = None
+        # Hands the state of this instance over to the new one on a self update
+        self.handoff = None
+        # The MaintenanceWindow updates are applied in, the updates found outside of it, and the opening of the
+        # window they were last applied in
+        self.window = None
+        self.prefetched = None
+        self.applied_window = None
+        # (time, latest image ID, latest repository digest) of the last check of every container, by name, which
+        # outlives the recreate of an update
+        self.checks = {}
+        # Monitor only: the (time, update) the outdated containers were found with, by container ID
+        self.outdated = {}
+        # Whether a container is removed when it stops (--rm), by container ID. Only its inspect data has it.
+        self.auto_removed = {}
+        # Cycles and the checks requested through the status API take turns
+        self.cycle_lock = Lock()
+        self.monitored = self.monitor_filter() if self.docker.client is not None else []
+
+    def reconfigure(self, options):
+        super().reconfigure(options)
+        if 'PRIORITIES' in options or 'PRIORITY_MAX_WAIT' in options:
+            # The cycles the containers waited are kept
+            self.queue.priorities = parse_priorities(self.config.priorities)
+            self.queue.max_wait = self.config.priority_max_wait
 
     # Container sub functions
     def stop(self, container):
-        self.logger.debug('Stopping container: %s', container.name)
+        self.logger.debug('Stopping container: %s', container.name,
+                          extra={'socket': self.socket, 'container': container.name, 'phase': 'stop'})
         stop_signal = container.labels.get('com.ouroboros.stop_signal', False)
         if stop_signal:
             try:
@@ -124,7 +414,8 @@ class Container(BaseImageObject):
             container.stop()
 
     def remove(self, container):
-        self.logger.debug('Removing container: %s', container.name)
+        self.logger.debug('Removing container: %s', container.name,
+                          extra={'socket': self.socket, 'container': container.name, 'phase': 'remove'})
         try:
             container.remove()
         except NotFound as e:
@@ -132,16 +423,22 @@ class Container(BaseImageObject):
             return
 
     def recreate(self, container, latest_image):
-        new_config = set_properties(old=container, new=latest_image)
+        new_config = set_properties(old=container, new=latest_image, image=getattr(latest_image, 'reference', None))
 
-        self.stop(container)
-        self.remove(container)
+        with span('stop', container=container.name):
+            self.stop(container)
+        with span('remove', container=container.name):
+            self.remove(container)
+        return self.create(new_config, container.attrs['NetworkSettings']['Networks'])
 
-        created = self.client.api.create_container(**new_config)
-        new_container = self.client.containers.get(created.get("Id"))
+    def create(self, new_config, networks):
+        """Create and start a container from a `set_properties` configuration, attached to `networks`"""
+        with span('create', container=new_config['name']):
+            created = self.client.api.create_container(**new_config)
+            new_container = self.client.containers.get(created.get("Id"))
 
         # connect the new container to all networks of the old container
-        for network_config in container.attrs['NetworkSettings']['Networks'].values():
+        for network_config in networks.values():
             network = self.client.networks.get(network_config['NetworkID'])
             try:
                 network.disconnect(new_container.id, force=True)
@@ -171,9 +468,135 @@ class Container(BaseImageObject):
                 else:
                     self.logger.error('Unable to attach updated container to network "%s". Error: %s', network.name, e)
 
-        new_container.start()
+        with span('start', container=new_config['name']):
+            new_container.start()
         return new_container
 
+    def retain(self, old_container, current_image, latest_image):
+        """Keep the previous image and configuration of a container that is about to be updated, for a rollback"""
+        previous = self.rollbacks.retain(old_container.name, {
+            'config': set_properties(old=old_container, new=current_image),
+            'networks': old_container.attrs['NetworkSettings']['Networks'],
+            'reference': old_container.attrs['Config']['Image'],
+            'image_id': current_image.id,
+            # Pulled again if the image was removed meanwhile, e.g. by docker image prune
+            'repo_digest': current_image.repo_digests[0] if current_image.repo_digests else None,
+            'new_image_id': latest_image.id,
+            'cleanup': self.config.cleanup
+        })
+        if previous:
+            self.release(old_container.name, previous)
+
+    def release(self, name, record):
+        """Let go of a retained image, removing it if its update would have cleaned it up"""
+        if not record['cleanup']:
+            return
+        try:
+            mylocals = {}
+            mylocals['image'] = record['image_id']
+            run_hook('before_image_cleanup', None, mylocals)
+            self.client.images.remove(record['image_id'])
+        except APIError as e:
+            self.logger.error("Could not delete old image for %s, Error: %s", name, e)
+
+    def expire_rollbacks(self):
+        for name, record in self.rollbacks.expire(self.config.rollback_retention).items():
+            self.logger.debug('The previous image of %s is no longer retained', name,
+                              extra={'socket': self.socket, 'container': name, 'phase': 'rollback'})
+            self.release(name, record)
+
+    def watch(self, watching):
+        """
+        Roll back the updated containers, {name: ID}, that exit with an error, restart or turn unhealthy within
+        ROLLBACK_GRACE seconds, and add them to `failed`. A container with a healthcheck passes as soon as it is
+        healthy.
+        """
+        deadline = monotonic() + self.config.rollback_grace
+        while watching:
+            for name, container_id in list(watching.items()):
+                try:
+                    attrs = self.client.api.inspect_container(container_id)
+                except NotFound:
+                    # Removed by someone else, nothing to roll back to
+                    del watching[name]
+                    continue
+                state = attrs['State']
+                health = (state.get('Health') or {}).get('Status')
+                if state['Status'] in ['exited', 'dead'] and state['ExitCode']:
+                    failure = f'it exited with code {state["ExitCode"]}'
+                elif state.get('Restarting') or attrs.get('RestartCount'):
+                    failure = 'it restarted'
+                elif health == 'unhealthy':
+                    failure = 'it is unhealthy'
+                else:
+                    if health == 'healthy' or state['Status'] in ['exited', 'dead']:
+                        del watching[name]
+                    continue
+                del watching[name]
+                self.failed.append((name, attrs['Image']))
+                if self.config.rollback_retention:
+                    self.rollback(name, failure)
+                else:
+                    self.logger.error('%s failed after its update, %s', name, failure,
+                                      extra={'socket': self.socket, 'container': name, 'phase': 'watch'})
+            if not watching or monotonic() >= deadline:
+                break
+            sleep(1)
+
+    def rollback(self, name, reason):
+        """Recreate a container from its retained previous image and configuration. Returns whether it did."""
+        record = self.rollbacks.get(name)
+        if record is None:
+            self.logger.error('No previous image of %s is retained on %s, it can not be rolled back', name,
+                              self.socket, extra={'socket': self.socket, 'container': name, 'phase': 'rollback'})
+            return False
+        self.logger.warning('Rolling back %s to %s, %s', name, record['image_id'][7:19], reason,
+                            extra={'socket': self.socket, 'container': name, 'phase': 'rollback'})
+        rollback_start = monotonic()
+        try:
+            try:
+                self.client.api.inspect_image(record['image_id'])
+            except NotFound:
+                if not record['repo_digest']:
+                    raise
+                self.logger.warning('The previous image of %s was removed, pulling %s', name, record['repo_digest'])
+                self.client.images.pull(record['repo_digest'], auth_config=self.config.auth_json)
+            repository, tag = split_reference(record['reference'])
+            if tag:
+                # The reference points to the new image, create_container resolves it locally
+                self.client.api.tag(record['image_id'], repository, tag, force=True)
+
+            try:
+                current = self.client.containers.get(name)
+            except NotFound:
+                current = None
+            if current is not None:
+                with span('stop', container=name):
+                    self.stop(current)
+                with span('remove', container=name):
+                    self.remove(current)
+            with span('rollback', container=name):
+                new_container = self.create(container_config(record), record['networks'])
+        except APIError as e:
+            self.logger.error('Could not roll back %s. Error: %s', name, e,
+                              extra={'socket': self.socket, 'container': name, 'phase': 'rollback'})
+            return False
+        seconds = monotonic() - rollback_start
+        self.logger.info('Rolled back %s in %.2fs', name, seconds,
+                         extra={'socket': self.socket, 'container': name, 'phase': 'rollback',
+                                'duration': round(seconds, 3)})
+
+        # Not updated to the image it was rolled back from again, only to a newer one
+        self.rollbacks.rolled_back(name, record['new_image_id'])
+        mylocals = {}
+        mylocals['new_container'] = new_container
+        mylocals['reason'] = reason
+        run_hook('after_rollback', None, mylocals)
+        self.notification_manager.send(container_tuples=[(name, record['new_image_id'][7:19],
+                                                          record['image_id'][7:19])],
+                                       socket=self.socket, kind='rollback')
+        return True
+
     def pull(self, current_tag):
         """Docker pull image tag"""
         tag = current_tag
@@ -182,105 +605,312 @@ class Container(BaseImageObject):
             raise ConnectionError
         elif ':' not in tag:
             tag = f'{tag}:latest'
-        return self._pull(tag)
+        with span('pull', tag=tag):
+            if self.distributor is not None and not self.config.dry_run:
+                image = self.distributor.fetch(self, tag)
+                if image is not None:
+                    return image
+            return self._pull(tag)
 
     # Filters
+    def list_filters(self):
+        """
+        Return the daemon-side filters of the container list. They only narrow it down, `is_monitored` still decides:
+        the label filter can't match its values, and name filters are regular expressions.
+        """
+        filters = {'status': ['running']}
+        if self.config.labels_only:
+            filters['label'] = ['com.ouroboros.enable']
+        elif self.config.monitor and not self.config.label_enable:
+            filters['name'] = [f'^/?{re.escape(name)}$' for name in self.config.monitor]
+        return filters
+
     def running_filter(self):
-        """Return running container objects list, except ouroboros itself"""
+        """Return snapshots of the running containers, except ouroboros itself"""
         running_containers = []
         try:
-            for container in self.client.containers.list(filters={'status': 'running'}):
-                if self.config.self_update:
+            for summary in self.client.api.containers(filters=self.list_filters()):
+                container = ContainerSnapshot.from_summary(summary)
+                if self.config.self_update or self.is_updatable(container.id, container.name, container.tags):
                     running_containers.append(container)
-                else:
-                    try:
-                        if 'ouroboros' not in container.image.tags[0]:
-                            if container.attrs['HostConfig']['AutoRemove']:
-                                self.logger.debug("Skipping %s due to --rm property.", container.name)
-                            else:
-                                running_containers.append(container)
-                    except IndexError:
-                        self.logger.error("%s has no tags.. you should clean it up! Ignoring.", container.id)
-                        continue
 
-        except DockerException:
-            self.logger.critical("Can't connect to Docker API at %s", self.config.docker_socket)
-            exit(1)
+        except DockerException as e:
+            # The daemon answered, but with an error. APIError is a requests exception as well, so it comes first.
+            self.logger.error("Can't list containers on %s, skipping this cycle. Error: %s", self.socket, e)
+        except RequestException as e:
+            self.docker.mark_unhealthy(e)
 
         return running_containers
 
     def monitor_filter(self):
-        """Return filtered running container objects list"""
+        """
+        Return snapshots of the monitored running containers. They are built from the list summaries: a container
+        is only inspected once it has an update, by `check_container`, and once for its --rm property.
+        """
         running_containers = self.running_filter()
-        monitored_containers = []
-
-        for container in running_containers:
-            ouro_label = container.labels.get('com.ouroboros.enable', False)
-            # if labels enabled, use the label. 'true/yes' trigger monitoring.
-            if self.config.label_enable and ouro_label:
-                if ouro_label.lower() in ["true", "yes"]:
-                    monitored_containers.append(container)
-                else:
-                    continue
-            elif not self.config.labels_only:
-                if self.config.monitor:
-                    if container.name in self.config.monitor and container.name not in self.config.ignore:
-                        monitored_containers.append(container)
-                elif container.name not in self.config.ignore:
-                    monitored_containers.append(container)
-
-        self.data_manager.monitored_containers[self.socket] = len(monitored_containers)
-        self.data_manager.set(self.socket)
+        monitored_containers = [container for container in running_containers
+                                if self.is_monitored(container.name, container.labels)]
+        inspected = [self.inspect(container) for container in self.auto_remove_unknown(monitored_containers)]
+        monitored_containers = self.skip_auto_remove(monitored_containers, inspected)
+        self.set_monitored(len(monitored_containers))
 
         return monitored_containers
 
+    def is_updatable(self, container_id, name, image_tags):
+        """Return whether a running container may be updated: its image is tagged, and it is not ouroboros itself"""
+        if not image_tags:
+            self.logger.error("%s has no tags.. you should clean it up! Ignoring.", container_id)
+            return False
+        if 'ouroboros' in image_tags[0]:
+            return False
+        return True
+
+    def is_monitored(self, name, labels):
+        """Return whether a container is monitored, by its ouroboros label or the monitor and ignore lists"""
+        ouro_label = labels.get('com.ouroboros.enable', False)
+        # if labels enabled, use the label. 'true/yes' trigger monitoring.
+        if self.config.label_enable and ouro_label:
+            return ouro_label.lower() in ["true", "yes"]
+        elif self.config.labels_only:
+            return False
+        elif self.config.monitor:
+            return name in self.config.monitor and name not in self.config.ignore
+        return name not in self.config.ignore
+
+    def auto_remove_unknown(self, containers):
+        """Return the `containers` to inspect for their --rm property, see `skip_auto_remove`"""
+        if self.config.self_update:
+            return []
+        return [container for container in containers if container.id not in self.auto_removed]
+
+    def skip_auto_remove(self, containers, inspected):
+        """
+        Return the `containers` that are not removed when they stop (--rm). Those are left alone unless ouroboros
+        updates itself. `inspected` are the snapshots of the `auto_remove_unknown` containers, from their inspect
+        data, None for the ones that are gone.
+        """
+        if self.config.self_update:
+            return containers
+        known = {container.id: container.auto_remove for container in inspected if container is not None}
+        self.auto_removed = {container.id: known.get(container.id, self.auto_removed.get(container.id))
+                             for container in containers
+                             if container.id in known or container.id in self.auto_removed}
+        kept = []
+        for container in containers:
+            if container.id not in self.auto_removed:
+                continue
+            if self.auto_removed[container.id]:
+                self.logger.debug("Skipping %s due to --rm property.", container.name)
+                continue
+            kept.append(container)
+        return kept
+
+    def set_monitored(self, count):
+        self.data_manager.monitored_containers[self.socket] = count
+        self.data_manager.set(self.socket)
+
     # Socket Functions
     def self_check(self):
-        if self.config.self_update:
-            me_list = [container for container in self.client.containers.list() if 'ouroboros' in container.name]
+        if self.config.self_update and self.docker.healthy():
+            me_list = [container for container in self.client.containers.list(sparse=True,
+                                                                              filters={'name': ['ouroboros']})
+                       if 'ouroboros' in container_name(container.attrs)]
             if len(me_list) > 1:
                 self.update_self(count=2, me_list=me_list)
 
-    def socket_check(self):
-        depends_on_names = []
-        hard_depends_on_names = []
-        updateable = []
-        self.monitored = self.monitor_filter()
-
-        if not self.monitored:
-            self.logger.info('No containers are running or monitored on %s', self.socket)
-            return
-
-        for container in self.monitored:
-            current_image = container.image
-            current_tag = container.attrs['Config']['Image']
-            latest_image = None
-
-            if self.config.latest_only:
-                image_name = current_tag.split(':')[0]
-                try:
-                    latest_image = self.pull(f"{image_name}:latest")
-                except ConnectionError:
-                    latest_image = None
-
+    def inspect(self, container):
+        """Return the snapshot of a container from its inspect data, None if it is gone"""
+        try:
+            return ContainerSnapshot.from_inspect(self.client.api.inspect_container(container.id))
+        except NotFound:
+            self.logger.debug('%s is gone, skipping it', container.name,
+                              extra={'socket': self.socket, 'container': container.name})
+            return None
+
+    def check_container(self, container):
+        """
+        Return the (container, current_image, latest_image) snapshot tuple if the container has an update, else None.
+        A container snapshot from the list is inspected only then.
+        """
+        if not container.tags:
+            # The reference moved to another image (self update checks untagged images), only inspect data has it
+            container = self.inspect(container)
+            if container is None:
+                return None
+        current_tag = container.image
+        latest_image = None
+        reference = current_tag
+
+        if TRACK_LABEL in container.labels:
+            reference = self.tracked_reference(container)
+            if reference is None:
+                return None
+        elif self.config.latest_only:
+            image_name = current_tag.split(':')[0]
             try:
-                if latest_image is None:
-                    latest_image = self.pull(current_tag)
+                latest_image = self.pull(f"{image_name}:latest")
             except ConnectionError:
-                continue
+                latest_image = None
 
+        try:
             if latest_image is None:
-                self.logger.error('Failed to pull image %s for container %s. Skipping', current_tag, container.name)
-                continue
+                latest_image = self.pull(reference)
+        except ConnectionError:
+            return None
+
+        if latest_image is None:
+            self.logger.error('Failed to pull image %s for container %s. Skipping', reference, container.name)
+            return None
+        repo_digests = latest_image.attrs.get('RepoDigests') or []
+        self.checks[container.name] = (time(), latest_image.id,
+                                       latest_image.attrs.get('Descriptor', {}).get('digest') or
+                                       (repo_digests[0].split('@')[-1] if repo_digests else None))
 
-            try:
-                if current_image.id != latest_image.id:
-                    updateable.append((container, current_image, latest_image))
-                else:
-                    continue
-            except AttributeError:
-                self.logger.error("Issue detecting %s's image tag. Skipping...", container.name)
+        try:
+            if container.image_id == latest_image.id:
+                return None
+        except AttributeError:
+            self.logger.error("Issue detecting %s's image tag. Skipping...", container.name)
+            return None
+        if latest_image.id in self.rejected_images:
+            self.logger.debug('The rollout of %s was halted, skipping %s', latest_image.id[7:19], container.name,
+                              extra={'socket': self.socket, 'container': container.name, 'phase': 'check'})
+            return None
+        if self.config.rollback_retention and self.rollbacks.rejected(container.name) == latest_image.id:
+            self.logger.debug('%s was rolled back from %s, skipping it', container.name, latest_image.id[7:19],
+                              extra={'socket': self.socket, 'container': container.name, 'phase': 'check'})
+            return None
+
+        if container.auto_remove is None:
+            container = self.inspect(container)
+            if container is None:
+                return None
+        try:
+            current_image = ImageSnapshot.from_inspect(self.client.api.inspect_image(container.image_id))
+        except NotFound:
+            self.logger.error("Issue detecting %s's image tag. Skipping...", container.name)
+            return None
+        return container, current_image, ImageSnapshot.from_image(latest_image,
+                                                                  reference if reference != current_tag else None)
+
+    def tracked_reference(self, container):
+        """
+        Return the reference of the highest version of a container's image that matches its com.ouroboros.track
+        constraint, its current reference if there is no higher one, None if the tags could not be listed
+        """
+        constraint = container.labels[TRACK_LABEL]
+        if '@' in container.image:
+            self.logger.warning('%s is pinned to a digest, it can not track %s', container.name, constraint,
+                                extra={'socket': self.socket, 'container': container.name, 'phase': 'check'})
+            return container.image
+        host, repository, tag = parse_reference(container.image)
+        try:
+            tags = tag_lister(self.config).tags(host, repository)
+        except PullError as e:
+            self.data_manager.add_pull_error(self.socket, e.registry, e.error_class)
+            self.logger.error("Couldn't list the tags of %s (%s error). Skipping %s", repository, e.error_class,
+                              container.name, extra={'socket': self.socket, 'container': container.name,
+                                                     'phase': 'check'})
+            return None
+        try:
+            best = best_tag(tags, constraint, tag)
+        except ValueError as e:
+            self.logger.error('%s has an invalid %s label, %s. Skipping', container.name, TRACK_LABEL, e)
+            return None
+        if best is None or best == tag:
+            return container.image
+        self.logger.debug('%s tracks %s, checking %s', container.name, constraint, best,
+                          extra={'socket': self.socket, 'container': container.name, 'phase': 'check'})
+        name = container.image[:-len(tag) - 1] if container.image.endswith(f':{tag}') else container.image
+        return f'{name}:{best}'
+
+    def socket_check(self, candidates=None, deadline=None, targeted=False):
+        """
+        Return the updateable containers and their dependencies. Only `candidates` are checked if given, e.g. the
+        containers whose registry digest changed according to the async check engine. Containers are checked in
+        priority order, see WorkQueue. Updates carried over from the last cycle are not checked again. The containers
+        that are not checked by the `deadline` are carried over to the next cycle. A `targeted` check, e.g. one asked
+        for over the status API, keeps what is carried over for the other containers.
+        """
+        if candidates is None:
+            self.monitored = monitored = self.monitor_filter()
+            if not monitored:
+                self.logger.info('No containers are running or monitored on %s', self.socket,
+                                 extra={'socket': self.socket, 'phase': 'check'})
+                self.carried_over, self.pending_updates = [], []
+                return [], [], []
+        else:
+            # The monitored containers stay those of the last full listing
+            monitored = candidates
+            if not monitored:
+                self.logger.debug('No update candidates on %s', self.socket,
+                                  extra={'socket': self.socket, 'phase': 'check'})
+                if not targeted:
+                    self.carried_over, self.pending_updates = [], []
+                return [], [], []
+
+        monitored_ids = {container.id for container in monitored}
+        pending = [update for update in self.pending_updates if update[0].id in monitored_ids]
+        if self.config.monitor_only:
+            # Outdated containers are not checked again until MONITOR_RECHECK passed
+            self.outdated = {container_id: (found_at, update) for container_id, (found_at, update)
+                             in self.outdated.items()
+                             if (container_id in monitored_ids and monotonic() - found_at < self.config.monitor_recheck)
+                             or (targeted and container_id not in monitored_ids)}
+            pending += [update for container_id, (_, update) in self.outdated.items() if container_id in monitored_ids]
+        pending_ids = {container.id for container, _, _ in pending}
+        unchecked = self.queue.order([container for container in monitored if container.id not in pending_ids])
+
+        if self.config.check_workers > 1:
+            # The docker client is shared, its connection pool is sized for the workers
+            with ThreadPoolExecutor(max_workers=self.config.check_workers) as executor:
+                checked = list(executor.map(bind(self.check_before), unchecked, repeat(deadline)))
+        else:
+            checked = [self.check_before(container, deadline) for container in unchecked]
+
+        carried_over = [container.id for container, result in zip(unchecked, checked) if result is UNCHECKED]
+        if targeted:
+            self.carried_over = [container_id for container_id in self.carried_over
+                                 if container_id not in monitored_ids] + carried_over
+            self.pending_updates = [update for update in self.pending_updates if update[0].id not in monitored_ids]
+        else:
+            self.carried_over, self.pending_updates = carried_over, []
+        found = [result for result in checked if result is not None and result is not UNCHECKED]
+        if self.config.monitor_only:
+            self.outdated.update({update[0].id: (monotonic(), update) for update in found})
+            for container, result in zip(unchecked, checked):
+                if result is None and self.checks.get(container.name, (None, None))[1] == container.image_id:
+                    self.announcements.forget(container.name)
+        updateable = self.queue.order(pending + found, container=lambda update: update[0])
+        depends_on_containers, hard_depends_on_containers = self.resolve_dependencies(updateable)
+        return updateable, depends_on_containers, hard_depends_on_containers
+
+    def check_before(self, container, deadline):
+        """`check_container`, or UNCHECKED once the deadline has passed"""
+        if deadline is not None and monotonic() >= deadline:
+            return UNCHECKED
+        return self.check_container(container)
 
+    def report_cycle(self, cycle_start, targeted=False):
+        if targeted:
+            # Not a cycle: the other containers did not have their turn, and what is carried over is the last cycle's
+            return
+        seconds = monotonic() - cycle_start
+        carried_over = len(self.carried_over) + len(self.pending_updates)
+        self.queue.next_cycle(self.carried_over + [container.id for container, _, _ in self.pending_updates])
+        if carried_over:
+            self.logger.warning('The update cycle of %s ran out of its %ds budget. %d updates and %d unchecked '
+                                'containers move up the queue next cycle', self.socket, self.config.cycle_budget,
+                                len(self.pending_updates), len(self.carried_over),
+                                extra={'socket': self.socket, 'phase': 'cycle'})
+            self.data_manager.add_cycle_overrun(self.socket, 'budget')
+        self.data_manager.set_cycle(self.socket, seconds, carried_over)
+
+    def resolve_dependencies(self, updateable):
+        """Return the containers the updateable ones depend on, which are restarted or recreated with them"""
+        depends_on_names = []
+        hard_depends_on_names = []
+        for container, current_image, latest_image in updateable:
             # Get container list to restart after update complete
             depends_on = container.labels.get('com.ouroboros.depends_on', False)
             hard_depends_on = container.labels.get('com.ouroboros.hard_depends_on', False)
@@ -306,20 +936,50 @@ class Container(BaseImageObject):
             except NotFound:
                 self.logger.error("Could not find dependent container %s on socket %s. Ignoring", name, self.socket)
 
-        return updateable, depends_on_containers, hard_depends_on_containers
+        return depends_on_containers, hard_depends_on_containers
 
-    def update(self):
+    def update(self, candidates=None, targeted=False):
+        with self.cycle_lock:
+            self.update_cycle(candidates, targeted)
+
+    def update_cycle(self, candidates=None, targeted=False):
+        cycle_start = monotonic()
+        deadline = cycle_start + self.config.cycle_budget if self.config.cycle_budget else None
+        # The async check engine has just talked to the socket when it passes candidates
+        if candidates is None and not self.docker.healthy():
+            return
         updated_count = 0
         actually_updated = []
-        try:
-            updateable, depends_on_containers, hard_depends_on_containers = self.socket_check()
-            mylocals = {}
-            mylocals['updateable'] = updateable
-            mylocals['depends_on_containers'] = depends_on_containers
-            mylocals['hard_depends_on_containers'] = hard_depends_on_containers
-            run_hook('updates_enumerated', None, mylocals)
-        except TypeError:
+        watching = {}
+        handed_over = False
+        self.failed = []
+        if self.config.rollback_retention:
+            self.expire_rollbacks()
+        # The first cycle in an open maintenance window applies the updates prefetched before it opened
+        applying = self.window is not None and self.window.is_open and self.applied_window != self.window.opened \
+            and not targeted
+        if targeted and self.prefetched:
+            candidate_ids = {container.id for container in candidates}
+            self.prefetched = [update for update in self.prefetched if update[0].id not in candidate_ids]
+        if applying and self.prefetched is not None:
+            updateable, self.prefetched = self.prefetched, None
+            depends_on_containers, hard_depends_on_containers = self.resolve_dependencies(updateable)
+        else:
+            with span('socket_check', socket=self.socket):
+                updateable, depends_on_containers, hard_depends_on_containers = self.socket_check(candidates, deadline,
+                                                                                                  targeted)
+        mylocals = {}
+        mylocals['updateable'] = updateable
+        mylocals['depends_on_containers'] = depends_on_containers
+        mylocals['hard_depends_on_containers'] = hard_depends_on_containers
+        run_hook('updates_enumerated', None, mylocals)
+
+        if self.window is not None and not self.window.is_open:
+            # Opened during the check, if it is open now
+            self.prefetch(updateable, cycle_start, targeted)
             return
+        if applying:
+            self.applied_window = self.window.opened
 
         for container in depends_on_containers + hard_depends_on_containers:
             mylocals = {}
@@ -328,10 +988,23 @@ class Container(BaseImageObject):
             if not self.config.dry_run and not self.config.monitor_only:
                 self.stop(container)
 
-        for container, current_image, latest_image in updateable:
+        for index, (container, current_image, latest_image) in enumerate(updateable):
+            # At least one update is applied per cycle, so that a cycle whose checks take up the budget still
+            # gets ahead. The others are applied first next cycle, without checking them again.
+            if index and deadline is not None and monotonic() >= deadline:
+                self.pending_updates = updateable[index:] + (self.pending_updates if targeted else [])
+                break
+            if self.window is not None and not self.window.is_open:
+                self.logger.warning('The maintenance window closed with %d updates left on %s. They are applied in '
+                                    'the next one', len(updateable) - index, self.socket,
+                                    extra={'socket': self.socket, 'phase': 'window'})
+                self.keep_prefetched(updateable[index:], targeted)
+                break
+
             if self.config.dry_run:
-                # Ugly hack for repo digest
-                repo_digest_id = current_image.attrs['RepoDigests'][0].split('@')[1]
+                # Ugly hack for repo digest. Images streamed from the PULL_SOURCE have none, their IDs are compared.
+                repo_digest_id = current_image.repo_digests[0].split('@')[1] if current_image.repo_digests \
+                    else current_image.id
                 if repo_digest_id != latest_image.id:
                     mylocals = {}
                     mylocals['container'] = container
@@ -342,9 +1015,15 @@ class Container(BaseImageObject):
                 continue
 
             if self.config.monitor_only:
-                # Ugly hack for repo digest
-                repo_digest_id = current_image.attrs['RepoDigests'][0].split('@')[1]
+                # Ugly hack for repo digest. Images streamed from the PULL_SOURCE have none, their IDs are compared.
+                repo_digest_id = current_image.repo_digests[0].split('@')[1] if current_image.repo_digests \
+                    else current_image.id
                 if repo_digest_id != latest_image.id:
+                    if not self.announcements.announce(container.name, latest_image.id):
+                        self.logger.debug('%s was announced for %s already', latest_image.short_id, container.name,
+                                          extra={'socket': self.socket, 'container': container.name,
+                                                 'phase': 'notify'})
+                        continue
                     mylocals = {}
                     mylocals['container'] = container
                     mylocals['current_image'] = current_image
@@ -357,28 +1036,53 @@ class Container(BaseImageObject):
                     )
                 continue
 
+            # The snapshot only holds what the check needs, the recreate copies the full inspect data
+            try:
+                old_container = self.client.containers.get(container.id)
+            except NotFound:
+                self.logger.error('%s is gone, skipping its update', container.name,
+                                  extra={'socket': self.socket, 'container': container.name, 'phase': 'recreate'})
+                continue
+
             if container.name in ['ouroboros', 'ouroboros-updated']:
                 self.data_manager.total_updated[self.socket] += 1
                 self.data_manager.add(label=container.name, socket=self.socket)
                 self.data_manager.add(label='all', socket=self.socket)
-                self.notification_manager.send(container_tuples=updateable,
-                                               socket=self.socket, kind='update')
-                self.update_self(old_container=container, new_image=latest_image, count=1)
+                handed_over = self.update_self(old_container=old_container, new_image=latest_image, count=1,
+                                               updates=updateable)
+                if handed_over:
+                    # The new instance took over with the state of this one, and notifies. It applies the updates
+                    # left, once the dependencies stopped for this cycle are started again below.
+                    break
+                continue
 
-            self.logger.info('%s will be updated', container.name)
+            self.logger.info('%s will be updated', container.name,
+                             extra={'socket': self.socket, 'container': container.name, 'phase': 'recreate'})
 
             mylocals = {}
-            mylocals['old_container'] = container
+            mylocals['old_container'] = old_container
             mylocals['old_image'] = current_image
             mylocals['new_image'] = latest_image
             run_hook('before_update', None, mylocals)
 
-            new_container = self.recreate(container, latest_image)
+            if self.config.rollback_retention:
+                self.retain(old_container, current_image, latest_image)
+
+            recreate_start = monotonic()
+            with span('recreate', container=container.name):
+                new_container = self.recreate(old_container, latest_image)
+            seconds = monotonic() - recreate_start
+            self.logger.debug('Recreated %s in %.2fs', container.name, seconds,
+                              extra={'socket': self.socket, 'container': container.name, 'phase': 'recreate',
+                                     'duration': round(seconds, 3)})
 
             mylocals['new_container'] = new_container
             run_hook('after_update', None, mylocals)
+            if self.config.rollback_grace and (self.config.rollback_retention or self.config.rollout_wave_size):
+                watching[container.name] = new_container.id
 
-            if self.config.cleanup:
+            # With a rollback retention, the old image is cleaned up once it is no longer retained
+            if self.config.cleanup and not self.config.rollback_retention:
                 try:
                     mylocals = {}
                     mylocals['image'] = current_image
@@ -427,17 +1131,62 @@ class Container(BaseImageObject):
             mylocals['old_container'] = container
             run_hook('before_recreate_hard_depends_container', None, mylocals)
             if not self.config.dry_run and not self.config.monitor_only:
-                new_container = self.recreate(container, container.image)
+                with span('recreate', container=container.name):
+                    new_container = self.recreate(container, container.image)
                 mylocals['new_container'] = new_container
             else:
                 mylocals['new_container'] = container
             run_hook('after_recreate_hard_depends_container', None, mylocals)
 
-        if updated_count > 0:
+        if watching:
+            with span('watch', socket=self.socket):
+                self.watch(watching)
+
+        if updated_count > 0 and not handed_over:
             notification_tuples = actually_updated if actually_updated else updateable
             self.notification_manager.send(container_tuples=notification_tuples, socket=self.socket, kind='update')
 
-    def update_self(self, count=None, old_container=None, me_list=None, new_image=None):
+        if applying:
+            self.report_window(cycle_start, updated_count)
+        self.docker.report_connections()
+        self.report_cycle(cycle_start, targeted)
+        seconds = monotonic() - cycle_start
+        self.logger.debug('Update cycle for %s finished in %.2fs', self.socket, seconds,
+                          extra={'socket': self.socket, 'phase': 'cycle', 'duration': round(seconds, 3)})
+
+    def prefetch(self, updateable, cycle_start, targeted=False):
+        """Keep the updates a cycle outside the maintenance window found, their images are pulled already"""
+        self.keep_prefetched(updateable, targeted)
+        if updateable:
+            self.logger.info('Prefetched %d updates on %s, they are applied when the maintenance window opens at %s',
+                             len(updateable), self.socket, self.window.next_open(),
+                             extra={'socket': self.socket, 'phase': 'window'})
+        self.docker.report_connections()
+        self.report_cycle(cycle_start, targeted)
+
+    def keep_prefetched(self, updates, targeted):
+        """
+        Keep `updates` for the next maintenance window. Those of a `targeted` check join the updates prefetched for
+        the other containers. If none were, the first cycle of the window checks all containers, these too.
+        """
+        if not targeted:
+            self.prefetched = updates
+        elif self.prefetched is not None:
+            self.prefetched = self.prefetched + updates
+
+    def report_window(self, cycle_start, updated_count):
+        """Report how much of the maintenance window applying its updates took"""
+        seconds = monotonic() - cycle_start
+        self.logger.info('Applied %d updates on %s in %.1fs, %.0f%% of the %ds maintenance window', updated_count,
+                         self.socket, seconds, 100 * seconds / self.window.duration, self.window.duration,
+                         extra={'socket': self.socket, 'phase': 'window', 'duration': round(seconds, 3)})
+        self.data_manager.set_window(self.socket, seconds, self.window.duration, updated_count)
+
+    def update_self(self, count=None, old_container=None, me_list=None, new_image=None, updates=None):
+        """
+        count 2: remove the older of two ouroboros containers, after a self update. count 1: start the new ouroboros
+        with the state of this one, and return whether it took over, see Handoff.
+        """
         if count == 2:
             self.logger.debug('God im messy... cleaning myself up.')
             old_me_index = 0 if me_list[0].attrs['Created'] < me_list[1].attrs['Created'] else 1
@@ -462,26 +1211,39 @@ class Container(BaseImageObject):
         elif count == 1:
             self.logger.debug('I need to update! Starting the ouroboros ;)')
             self_name = 'ouroboros-updated' if old_container.name == 'ouroboros' else 'ouroboros'
-            new_config = set_properties(old=old_container, new=new_image, self_name=self_name)
+            new_config = set_properties(old=old_container, new=new_image, self_name=self_name,
+                                        image=getattr(new_image, 'reference', None))
             self.data_manager.save()
             mylocals = {}
             mylocals['self_name'] = self_name
             mylocals['old_container'] = old_container
             mylocals['new_image'] = new_image
             run_hook('before_self_update', None, mylocals)
+            handoff = self.handoff or Handoff([self], self.data_manager)
             try:
                 me_created = self.client.api.create_container(**new_config)
                 new_me = self.client.containers.get(me_created.get("Id"))
+                try:
+                    token = handoff.hand_over(new_me, self.socket, updates)
+                except APIError:
+                    new_me.remove(force=True)
+                    raise
                 new_me.start()
                 self.logger.debug('If you strike me down, I shall become '
                                   'more powerful than you could possibly imagine.')
                 self.logger.debug('https://bit.ly/2VVY7GH')
                 mylocals['new_container'] = new_me
                 run_hook('after_self_update', None, mylocals)
-                sleep(30)
+                ready = handoff.wait_ready(new_me, token)
+                if ready is None:
+                    # It takes over without the snapshot, and the notification in it
+                    self.notification_manager.send(container_tuples=updates, socket=self.socket, kind='update')
+                return ready is not False
             except APIError as e:
                 self.logger.error("Self update failed.")
                 self.logger.error(e)
+                self.notification_manager.send(container_tuples=updates, socket=self.socket, kind='update')
+        return False
 
 
 class Service(BaseImageObject):
@@ -489,11 +1251,18 @@ class Service(BaseImageObject):
 
     def __init__(self, docker_client):
         super().__init__(docker_client)
-        self.monitored = self.monitor_filter()
+        self.monitored = self.monitor_filter() if self.docker.client is not None else []
 
     def monitor_filter(self):
         """Return filtered service objects list"""
-        services = self.client.services.list(filters={'label': 'com.ouroboros.enable'})
+        try:
+            services = self.client.services.list(filters={'label': 'com.ouroboros.enable'})
+        except DockerException as e:
+            self.logger.error("Can't list services on %s, skipping this cycle. Error: %s", self.socket, e)
+            services = []
+        except RequestException as e:
+            self.docker.mark_unhealthy(e)
+            services = []
 
         monitored_services = []
 
@@ -509,11 +1278,16 @@ class Service(BaseImageObject):
 
     def pull(self, tag):
         """Docker pull image tag"""
-        return self._pull(tag)
+        with span('pull', tag=tag):
+            return self._pull(tag)
 
     def update(self):
+        cycle_start = monotonic()
+        if not self.docker.healthy():
+            return
         updated_service_tuples = []
-        self.monitored = self.monitor_filter()
+        with span('monitor_filter', socket=self.socket):
+            self.monitored = self.monitor_filter()
 
         if not self.monitored:
             self.logger.info('No services monitored')
@@ -551,6 +1325,8 @@ class Service(BaseImageObject):
             latest_image_sha256 = get_digest(latest_image)
             self.logger.debug('Latest sha256 for %s is %s', tag, latest_image_sha256)
 
+            if sha256 == latest_image_sha256 and self.config.monitor_only:
+                self.announcements.forget(service.name)
             if sha256 != latest_image_sha256:
                 if self.config.dry_run:
                     # Ugly hack for repo digest
@@ -558,6 +1334,8 @@ class Service(BaseImageObject):
                     continue
 
                 if self.config.monitor_only:
+                    if not self.announcements.announce(service.name, latest_image_sha256):
+                        continue
                     # Ugly hack for repo digest
                     self.notification_manager.send(
                         container_tuples=[(service, sha256[-10], latest_image)],
@@ -578,11 +1356,13 @@ class Service(BaseImageObject):
                     self.notification_manager.send(container_tuples=updated_service_tuples,
                                                    socket=self.socket, kind='update', mode='service')
 
-                self.logger.info('%s will be updated', service.name)
+                self.logger.info('%s will be updated', service.name,
+                                 extra={'socket': self.socket, 'container': service.name, 'phase': 'recreate'})
                 try:
                     # Reload service to get latest version before updating
-                    service.reload()
-                    service.update(image=f"{tag}@sha256:{latest_image_sha256}")
+                    with span('service_update', service=service.name):
+                        service.reload()
+                        service.update(image=f"{tag}@sha256:{latest_image_sha256}")
                 except APIError as e:
                     if 'update out of sequence' in str(e):
                         self.logger.warning('Service %s was updated by another process. Skipping this update cycle.', service.name)
@@ -617,3 +1397,8 @@ class Service(BaseImageObject):
                 kind='update',
                 mode='service'
             )
+
+        self.docker.report_connections()
+        seconds = monotonic() - cycle_start
+        self.logger.debug('Update cycle for %s finished in %.2fs', self.socket, seconds,
+                          extra={'socket': self.socket, 'phase': 'cycle', 'duration': round(seconds, 3)})
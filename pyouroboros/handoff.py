@@ -0,0 +1,169 @@
+"""
+Self update handoff
+
+When ouroboros updates itself, the old instance creates the new container and copies a snapshot of its state into
+it before it starts it: the last checks and the work queue of every socket, the update counters, the cached
+registry tag lists, when the next cycle is due and the notification of the update. The new instance restores the
+snapshot before it schedules its cycles, so that it resumes the schedule with warm caches instead of starting with a
+check right away, sends the notification, and then writes a ready file with the token of the snapshot. The old
+instance waits for that file instead of a fixed time, and stops updating once it is there. The new instance removes
+the old one with its self check.
+
+With worker processes, the new instance signals readiness and sends the notification, its workers start cold.
+"""
+import json
+import tarfile
+
+from io import BytesIO
+from os import replace, unlink
+from time import time, sleep
+from uuid import uuid4
+from pathlib import Path
+from logging import getLogger
+from datetime import datetime
+
+from docker.errors import NotFound
+
+from pyouroboros.helpers import get_exec_dir
+from pyouroboros.notifiers import summarize
+
+HANDOFF_DIR = get_exec_dir() + '/hooks'
+SNAPSHOT_FILE = 'handoff.json'
+READY_FILE = 'handoff.ready'
+# Seconds the old instance waits for the new one to be ready, and between its looks
+READY_TIMEOUT = 120
+READY_POLL = 1
+
+
+def archive(name, data):
+    """Return a tar archive of one file, as the Engine API copies files into containers"""
+    buffer = BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = len(data), int(time()), 0o600
+        tar.addfile(info, BytesIO(data))
+    return buffer.getvalue()
+
+
+class Handoff(object):
+    """Hands the state of the container `modes` of this instance over to the instance that replaces it"""
+
+    def __init__(self, modes, data_manager, next_run=None):
+        self.modes = modes
+        self.data_manager = data_manager
+        # Returns when the next update cycle is due
+        self.next_run = next_run
+        self.logger = getLogger()
+
+    def snapshot(self, notifications):
+        from pyouroboros.registry import tag_lister
+
+        modes = [mode for mode in self.modes if mode.mode == 'container']
+        next_run = self.next_run() if self.next_run else None
+        return {
+            'token': uuid4().hex,
+            'written': time(),
+            'next_run': next_run.timestamp() if next_run else None,
+            'total_updated': dict(self.data_manager.total_updated),
+            'monitored_containers': dict(self.data_manager.monitored_containers),
+            'sockets': {mode.socket: {'checks': dict(mode.checks), 'waited': dict(mode.queue.waited)}
+                        for mode in modes},
+            'tag_lists': tag_lister(modes[0].config).export() if modes else [],
+            'notifications': notifications
+        }
+
+    def hand_over(self, container, socket, updates):
+        """
+        Copy the snapshot into the created, not yet started, `container`, with the notification of the `updates` of
+        `socket` for it to send. Return the token the new instance signals readiness with.
+        """
+        snapshot = self.snapshot([{'socket': socket, 'kind': 'update', 'updates': summarize(updates)}])
+        container.put_archive(HANDOFF_DIR, archive(SNAPSHOT_FILE, json.dumps(snapshot).encode()))
+        self.logger.debug('Handed over the state of %d sockets to %s', len(snapshot['sockets']), container.name)
+        return snapshot['token']
+
+    def wait_ready(self, container, token):
+        """
+        Return True if the started `container` signalled readiness, False if it stopped before, and None if it did
+        not signal readiness within READY_TIMEOUT but runs still
+        """
+        started = time()
+        while time() - started < READY_TIMEOUT:
+            if self.ready_token(container) == token:
+                self.logger.info('%s is ready after %.1fs, handing over to it', container.name, time() - started)
+                return True
+            container.reload()
+            if container.status not in ['created', 'running', 'restarting']:
+                self.logger.error('%s stopped before it was ready (%s). Removing it', container.name,
+                                  container.status)
+                container.remove(force=True)
+                return False
+            sleep(READY_POLL)
+        # e.g. a release without the handoff, which takes over with its self check alone
+        self.logger.warning('%s did not signal readiness in %ds. Leaving the updates to it', container.name,
+                            READY_TIMEOUT)
+        return None
+
+    @staticmethod
+    def ready_token(container):
+        try:
+            stream, _ = container.get_archive(f'{HANDOFF_DIR}/{READY_FILE}')
+        except NotFound:
+            return None
+        with tarfile.open(fileobj=BytesIO(b''.join(stream))) as tar:
+            return tar.extractfile(READY_FILE).read().decode().strip()
+
+
+def receive():
+    """Return the snapshot handed over by the instance this one replaces, None if there is none"""
+    path = Path(HANDOFF_DIR, SNAPSHOT_FILE)
+    try:
+        with open(path) as file:
+            snapshot = json.load(file)
+        unlink(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        getLogger().error('Could not read the handed over state from %s, starting without it. Error: %s', path, e)
+        return None
+    getLogger().info('Taking over from the previous instance, %.1fs after it handed over',
+                     time() - snapshot['written'])
+    return snapshot
+
+
+def restore(snapshot, modes, data_manager):
+    """Restore the counters, checks, work queues and registry tag lists of a `snapshot` into the new `modes`"""
+    from pyouroboros.registry import tag_lister
+
+    data_manager.total_updated.update(snapshot['total_updated'])
+    data_manager.monitored_containers.update(snapshot['monitored_containers'])
+    for mode in modes:
+        state = snapshot['sockets'].get(mode.socket)
+        if state is None or mode.mode != 'container':
+            continue
+        mode.checks.update({name: tuple(check) for name, check in state['checks'].items()})
+        mode.queue.waited.update(state['waited'])
+    if modes:
+        tag_lister(modes[0].config).restore(snapshot['tag_lists'], time() - snapshot['written'])
+
+
+def next_run(snapshot, tz):
+    """Return when the previous instance would have run its next cycle, None if it is due now"""
+    if not snapshot or not snapshot['next_run'] or snapshot['next_run'] <= time():
+        return None
+    return datetime.fromtimestamp(snapshot['next_run'], tz)
+
+
+def signal_ready(snapshot, notification_manager):
+    """Tell the previous instance that this one took over, and send the notifications it handed over"""
+    path = Path(HANDOFF_DIR, READY_FILE)
+    try:
+        temporary = path.with_suffix('.tmp')
+        with open(temporary, 'w') as file:
+            file.write(snapshot['token'])
+        replace(temporary, path)
+    except OSError as e:
+        getLogger().error('Could not signal readiness to the previous instance. Error: %s', e)
+    for notification in snapshot['notifications']:
+        notification_manager.send(container_tuples=[tuple(update) for update in notification['updates']],
+                                  socket=notification['socket'], kind=notification['kind'])
@@ -3,6 +3,8 @@ from logging import getLogger
 from os.path import dirname, abspath
 from pathlib import Path
 
+from pyouroboros.profiler import span
+
 def get_exec_dir() -> str:
     """
     Returns the absolute path to the directory of this script, without trailing slash
@@ -30,7 +32,8 @@ def run_hook(hookname:str, myglobals:dict|None=None, mylocals:dict|None=None):
         getLogger().error("An error was raised while scanning the directory for hook %s", hookname, exc_info=True)
         return
     for path in pathlist:
-        execfile(str(path), myglobals, mylocals)
+        with span('hook', hook=hookname, script=path.name):
+            execfile(str(path), myglobals, mylocals)
 
 # Copied from https://stackoverflow.com/a/41658338
 def execfile(filepath:str, myglobals:dict|None=None, mylocals:dict|None=None):
@@ -68,7 +71,7 @@ def isContainerNetwork(container) -> bool:
     parts = container.attrs['HostConfig']['NetworkMode'].split(':')
     return len(parts) > 1 and parts[0] == 'container'
 
-def set_properties(old, new, self_name:str|None=None) -> dict:
+def set_properties(old, new, self_name:str|None=None, image:str|None=None) -> dict:
     """
     Cretates a configuration dict for a new container, based on the configuration of the old container
 
@@ -76,6 +79,7 @@ def set_properties(old, new, self_name:str|None=None) -> dict:
         old: The old container
         new: The new image (unused)
         self_name (str|None): The name of the new container; `None` to use the old container name
+        image (str|None): The image reference of the new container; `None` to use the old container image
 
     Returns:
         dict: The new configuration
@@ -94,7 +98,7 @@ def set_properties(old, new, self_name:str|None=None) -> dict:
             v for v in old.attrs['Config']['Volumes'].keys()
         ],
         'working_dir': old.attrs['Config']['WorkingDir'],
-        'image': old.attrs['Config']['Image'],
+        'image': image if image else old.attrs['Config']['Image'],
         'command': old.attrs['Config']['Cmd'],
         'host_config': old.attrs['HostConfig'],
         'labels': old.attrs['Config']['Labels'],
@@ -127,3 +131,23 @@ def get_digest(image) -> str:
             "RepoDigests"
         )[0].split('@')[1] or image.id
     return remove_sha_prefix(digest)
+
+
+def registry_host(tag:str) -> str:
+    """
+    Utility to return the registry host of an image reference, `docker.io` for Docker Hub images
+    """
+    name = tag.split('@')[0]
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        return first
+    return 'docker.io'
+
+
+def container_name(summary:dict) -> str:
+    """
+    Utility to return the name of a container from its list summary, which also lists the `/other/alias` names of
+    the containers linked to it
+    """
+    names = [name.lstrip('/') for name in summary.get('Names') or []]
+    return next((name for name in names if '/' not in name), names[0] if names else summary['Id'][:12])
@@ -1,9 +1,19 @@
+import re
+import json
+import atexit
+
+from copy import copy
+from queue import Queue
 from logging import Filter, getLogger, Formatter, StreamHandler
+from logging.handlers import QueueHandler, QueueListener
 
 
 class BlacklistFilter(Filter):
     """
     Log filter for blacklisted tokens and passwords
+
+    All filtered strings are compiled into a single regex alternation, longest first, so that masking a record
+    is one pass over its rendered message no matter how many notifiers and sockets are configured.
     """
 
     blacklisted_keys = ['repo_user', 'repo_pass', 'auth_json', 'docker_sockets', 'prometheus_addr',
@@ -11,23 +21,106 @@ class BlacklistFilter(Filter):
 
     def __init__(self, filteredstrings):
         super().__init__()
-        self.filtered_strings = filteredstrings
+        # Longest first, so that a secret is never partially masked by one of its own substrings
+        self.filtered_strings = sorted({item for item in filteredstrings if isinstance(item, str) and item},
+                                       key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(item) for item in self.filtered_strings)) \
+            if self.filtered_strings else None
+
+    @staticmethod
+    def mask(item):
+        return 8 * '*' + item[-5:]
+
+    @classmethod
+    def mask_match(cls, match):
+        return cls.mask(match.group(0))
+
+    def redact(self, text):
+        """Return `text` with every filtered string masked"""
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(self.mask_match, text)
 
     def filter(self, record):
-        for item in self.filtered_strings:
-            try:
-                if item in record.msg:
-                    record.msg = record.msg.replace(item, 8 * '*' + item[-5:])
-                if any(item in str(arg) for arg in record.args):
-                    record.args = tuple(arg.replace(item, 8 * '*' + item[-5:]) if isinstance(arg, str) else arg
-                                        for arg in record.args)
-            except TypeError:
-                pass
+        # Handler filters only see records that passed the logger and handler level checks
+        if self.pattern is None:
+            return True
+        try:
+            message = record.getMessage()
+        except Exception:
+            # Leave broken format strings to the handler, which reports them
+            return True
+        # The message is rendered once here, so the handler does not render it again
+        record.msg, record.args = self.redact(message), ()
+        if isinstance(getattr(record, 'socket', None), str):
+            record.socket = self.redact(record.socket)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+        if record.exc_text:
+            record.exc_text = self.redact(record.exc_text)
         return True
 
 
+_exception_formatter = Formatter()
+
+
+class Lazy(object):
+    """
+    Log argument that is only built when a record is actually rendered
+
+    EXAMPLE: logger.debug('Configuration: %s', Lazy(lambda: expensive_dump()))
+    """
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
+
+class JsonFormatter(Formatter):
+    """Formats records as JSON lines, with the structured fields passed through `extra` when present"""
+
+    fields = ['socket', 'container', 'phase', 'duration']
+
+    def format(self, record):
+        payload = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S%z'),
+            'level': record.levelname,
+            'module': record.module,
+            'message': record.getMessage()
+        }
+        for field in self.fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload['exception'] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+class OuroborosQueueHandler(QueueHandler):
+    """
+    Hands records to the logging thread
+
+    Only the message is rendered on the calling thread (the BlacklistFilter has to see it). Time stamps, layout and
+    writing happen on the QueueListener thread.
+    """
+
+    def prepare(self, record):
+        record = copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
 class OuroborosLogger(object):
-    def __init__(self, level='INFO'):
+    def __init__(self, level='INFO', log_format='text'):
         # Create the Logger
         self.logger = getLogger()
         try:
@@ -37,7 +130,11 @@ class OuroborosLogger(object):
             self.logger.setLevel(level.upper())
 
         # Create a Formatter for formatting the log messages
-        logger_formatter = Formatter('%(asctime)s : %(levelname)s : %(module)s : %(message)s', '%Y-%m-%d %H:%M:%S')
+        if log_format == 'json':
+            logger_formatter = JsonFormatter()
+        else:
+            logger_formatter = Formatter('%(asctime)s : %(levelname)s : %(module)s : %(message)s',
+                                         '%Y-%m-%d %H:%M:%S')
 
         # Add the console logger
         console_logger = StreamHandler()
@@ -45,7 +142,14 @@ class OuroborosLogger(object):
 
         console_logger.setLevel(level.upper())
 
+        # Write from a background thread, so that logging never blocks the update loop on the console
+        queue_handler = OuroborosQueueHandler(Queue(-1))
+        queue_handler.setLevel(level.upper())
+        self.listener = QueueListener(queue_handler.queue, console_logger, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
         # Add the Handler to the Logger
-        self.logger.addHandler(console_logger)
+        self.logger.addHandler(queue_handler)
 
         getLogger('apscheduler').setLevel(level.upper())
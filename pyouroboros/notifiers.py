@@ -1,9 +1,21 @@
-import apprise
 import gettext
 
 from logging import getLogger
-from babel import dates
-from pytz import timezone
+
+from pyouroboros.profiler import span
+
+
+def summarize(container_tuples, mode='container'):
+    """
+    Return the (name, old image, new image) string tuples of (container, current_image, latest_image) update
+    tuples, as notifications show them. Tuples that are already summarized, e.g. by a worker process, are kept.
+    """
+    return [update if isinstance(update[0], str) else (
+        update[0].name,
+        update[1] if mode == 'service' else update[1].short_id.split(':')[1],
+        update[2].short_id.split(':')[1]
+    ) for update in container_tuples or []]
+
 
 class NotificationManager(object):
     def __init__(self, config, data_manager):
@@ -11,7 +23,6 @@ class NotificationManager(object):
         self.data_manager = data_manager
         self.logger = getLogger()
 
-        self.apprise = self.build_apprise()
         self._ = None
 
         try:
@@ -23,7 +34,12 @@ class NotificationManager(object):
                 self.logger.error("Can't find the '%s' language", self.config.language)
             self._ = gettext.gettext
 
+        self.apprise = self.build_apprise() if self.config.notifiers else None
+
     def build_apprise(self):
+        # Imported here so that apprise and its plugins are only loaded when notifiers are configured
+        import apprise
+
         asset = apprise.AppriseAsset(
             image_url_mask='https://raw.githubusercontent.com/styliteag/ouroboros/main/assets/ouroboros_logo_icon_72.png',
             default_extension='.png'
@@ -44,12 +60,28 @@ class NotificationManager(object):
         return apprise_obj
 
     def send(self, container_tuples=None, socket=None, kind='update', next_run=None, mode='container'):
+        if not self.apprise or not self.apprise.servers:
+            return
+
+        import apprise
+        from babel import dates
+        from pytz import timezone
+
         if kind == 'startup':
             title = self._('Ouroboros has started')
             body_fields = [
                 self._('Host: %s') % self.config.hostname,
                 self._('Time: %s') % dates.format_datetime(None, format='full', tzinfo=timezone(self.config.tz), locale=self.config.language),
                 self._('Next Run: %s') % dates.format_datetime(next_run, format='full', tzinfo=timezone(self.config.tz), locale=self.config.language)]
+        elif kind == 'rollback':
+            title = self._('Ouroboros has rolled back containers!')
+            body_fields = [self._('Host/Socket: %s / %s') % (self.config.hostname, socket.split('//')[1])]
+            body_fields.extend(
+                [
+                    self._("{} rolled back from {} to {}").format(name, new_image, old_image)
+                    for name, new_image, old_image in container_tuples
+                ]
+            )
         elif kind == 'monitor':
             title = self._('Ouroboros has detected updates!')
             body_fields = [
@@ -59,11 +91,8 @@ class NotificationManager(object):
             ]
             body_fields.extend(
                 [
-                    self._("{} updated from {} to {}").format(
-                        container.name,
-                        old_image if mode == 'service' else old_image.short_id.split(':')[1],
-                        new_image.short_id.split(':')[1]
-                    ) for container, old_image, new_image in container_tuples
+                    self._("{} updated from {} to {}").format(name, old_image, new_image)
+                    for name, old_image, new_image in summarize(container_tuples, mode)
                 ]
             )
         else:
@@ -76,14 +105,11 @@ class NotificationManager(object):
             ]
             body_fields.extend(
                 [
-                    self._("{} updated from {} to {}").format(
-                        container.name,
-                        old_image if mode == 'service' else old_image.short_id.split(':')[1],
-                        new_image.short_id.split(':')[1]
-                    ) for container, old_image, new_image in container_tuples
+                    self._("{} updated from {} to {}").format(name, old_image, new_image)
+                    for name, old_image, new_image in summarize(container_tuples, mode)
                 ]
             )
         body = '\r\n'.join(body_fields)
 
-        if self.apprise.servers:
+        with span('notify', kind=kind):
             self.apprise.notify(title=title, body=body, body_format=apprise.NotifyFormat.TEXT)
@@ -2,16 +2,17 @@ import gettext
 
 from time import sleep
 from os import environ
+from logging import getLogger
 
 from requests.exceptions import ConnectionError
 from datetime import datetime, timedelta
 from argparse import ArgumentParser, RawTextHelpFormatter
-from apscheduler.schedulers.background import BackgroundScheduler
-from pytz import timezone
 
-from pyouroboros.config import Config
+from pyouroboros import handoff
+from pyouroboros.config import Config, config_environment
 from pyouroboros import VERSION, BRANCH
-from pyouroboros.logger import OuroborosLogger
+from pyouroboros.logger import OuroborosLogger, Lazy
+from pyouroboros.profiler import Profiler
 from pyouroboros.dataexporters import DataManager
 from pyouroboros.notifiers import NotificationManager
 from pyouroboros.dockerclient import Docker, Container, Service
@@ -46,6 +47,15 @@ def main():
                             help='Cron formatted string for scheduling\n'
                                  'EXAMPLE: "*/5 * * * *"')
 
+    core_group.add_argument('--maintenance-window', default=Config.maintenance_window, dest='MAINTENANCE_WINDOW',
+                            help='Cron formatted start of the window containers are updated in. Outside of it, '
+                                 'updates are only checked and pulled\n'
+                                 'EXAMPLE: "0 2 * * *"')
+
+    core_group.add_argument('--maintenance-duration', type=int, default=Config.maintenance_duration,
+                            dest='MAINTENANCE_DURATION', help='Minutes the maintenance window stays open\n'
+                                                              'DEFAULT: 60')
+
     core_group.add_argument('-G', '--grace', default=Config.grace, dest='GRACE',
                             help='Grace time for late jobs to execute anyway. -1 for always execute; 0 for never execute if late; number of seconds otherwise\n'
                                 'DEFAULT: 15')
@@ -54,6 +64,10 @@ def main():
                             dest='LOG_LEVEL', default=Config.log_level, help='Set logging level\n'
                                                                              'DEFAULT: info')
 
+    core_group.add_argument('--log-format', choices=['text', 'json'], dest='LOG_FORMAT', default=Config.log_format,
+                            help='Set logging format. json writes one JSON object per line\n'
+                                 'DEFAULT: text')
+
     core_group.add_argument('-u', '--self-update', default=Config.self_update, dest='SELF_UPDATE', action='store_true',
                             help='Let ouroboros update itself')
 
@@ -66,6 +80,11 @@ def main():
     core_group.add_argument('-mo', '--monitor-only', default=Config.monitor_only, action='store_true', dest='MONITOR_ONLY',
                             help='Run and send notifications without making changes')
 
+    core_group.add_argument('--monitor-recheck', type=int, default=Config.monitor_recheck, dest='MONITOR_RECHECK',
+                            help='Seconds before a container found outdated in monitor only mode is checked again. '
+                                 'Updates are announced once per new image either way\n'
+                                 'DEFAULT: 3600')
+
     core_group.add_argument('-N', '--notifiers', nargs='+', default=Config.notifiers, dest='NOTIFIERS',
                             help='Apprise formatted notifiers\n'
                                  'EXAMPLE: -N discord://1234123412341234/jasdfasdfasdfasddfasdf '
@@ -77,11 +96,128 @@ def main():
     core_group.add_argument('-tz', '--timezone', default=Config.tz, dest='TZ',
                             help='Set the timezone of notifications and cron\nDEFAULT: UTC')
 
+    core_group.add_argument('--config-file', default=Config.config_file, dest='CONFIG_FILE',
+                            help='Env file of options (KEY=value lines) over the environment. It is watched, and '
+                                 'read again on SIGHUP: the options that changed are applied without a restart\n'
+                                 'EXAMPLE: /app/pyouroboros/hooks/ouroboros.env')
+
     docker_group = parser.add_argument_group("Docker", "Configuration of docker functionality")
     docker_group.add_argument('--docker-timeout', type=int, default=Config.docker_timeout, dest='DOCKER_TIMEOUT',
                               help='Docker client timeout, in seconds\n'
                                    'DEFAULT: 60')
 
+    docker_group.add_argument('--docker-pool-size', type=int, default=Config.docker_pool_size,
+                              dest='DOCKER_POOL_SIZE', help='Connections kept open per docker socket\n'
+                                                            'DEFAULT: 10')
+
+    docker_group.add_argument('--docker-keepalive', type=int, default=Config.docker_keepalive,
+                              dest='DOCKER_KEEPALIVE', help='TCP keep-alive idle time of tcp:// docker sockets, in '
+                                                            'seconds. 0 disables keep-alive\n'
+                                                            'DEFAULT: 60')
+
+    docker_group.add_argument('--check-workers', type=int, default=Config.check_workers, dest='CHECK_WORKERS',
+                              help='Containers checked for updates concurrently per docker socket\n'
+                                   'DEFAULT: 1')
+
+    docker_group.add_argument('--check-engine', choices=['sync', 'async'], default=Config.check_engine,
+                              dest='CHECK_ENGINE', help='async checks the containers of all sockets concurrently on '
+                                                        'one event loop, comparing registry digests before pulling. '
+                                                        'Needs aiohttp\n'
+                                                        'DEFAULT: sync')
+
+    docker_group.add_argument('--cycle-budget', type=int, default=Config.cycle_budget, dest='CYCLE_BUDGET',
+                              help='Seconds an update cycle of a socket may take. Containers it did not check or '
+                                   'update in time go first in the next cycle. 0 for no limit\n'
+                                   'DEFAULT: 0')
+
+    docker_group.add_argument('--worker-processes', type=int, default=Config.worker_processes,
+                              dest='WORKER_PROCESSES', help='Update the sockets in this many worker processes, each '
+                                                            'with its own group of sockets. A supervisor restarts '
+                                                            'crashed workers. 0 updates all sockets in this process. '
+                                                            'Not used with run once\n'
+                                                            'DEFAULT: 0')
+
+    docker_group.add_argument('--docker-probe-timeout', type=int, default=Config.docker_probe_timeout,
+                              dest='DOCKER_PROBE_TIMEOUT', help='Timeout of the health probe of a docker socket '
+                                                                'before every update cycle, in seconds\n'
+                                                                'DEFAULT: 5')
+
+    docker_group.add_argument('--docker-backoff', type=int, default=Config.docker_backoff, dest='DOCKER_BACKOFF',
+                              help='Seconds an unhealthy docker socket is skipped before it is probed again. '
+                                   'Doubles on every failed probe\n'
+                                   'DEFAULT: 30')
+
+    docker_group.add_argument('--docker-max-backoff', type=int, default=Config.docker_max_backoff,
+                              dest='DOCKER_MAX_BACKOFF', help='Maximum seconds an unhealthy docker socket is skipped\n'
+                                                              'DEFAULT: 1800')
+
+    docker_group.add_argument('--pull-retries', type=int, default=Config.pull_retries, dest='PULL_RETRIES',
+                              help='Retries of a pull that failed with a registry timeout or server error\n'
+                                   'DEFAULT: 2')
+
+    docker_group.add_argument('--pull-concurrency', type=int, default=Config.pull_concurrency,
+                              dest='PULL_CONCURRENCY', help='Pulls a docker socket runs at a time. 0 for no limit\n'
+                                                            'DEFAULT: 0')
+
+    docker_group.add_argument('--pull-rate-limit', type=int, default=Config.pull_rate_limit, dest='PULL_RATE_LIMIT',
+                              help='KiB per second the pulls of a docker socket download, together. 0 for no limit\n'
+                                   'DEFAULT: 0')
+
+    docker_group.add_argument('--registry-threshold', type=int, default=Config.registry_threshold,
+                              dest='REGISTRY_THRESHOLD', help='Consecutive registry errors after which the images of '
+                                                              'that registry are skipped\n'
+                                                              'DEFAULT: 3')
+
+    docker_group.add_argument('--registry-backoff', type=int, default=Config.registry_backoff,
+                              dest='REGISTRY_BACKOFF', help='Seconds the images of a failing registry are skipped. '
+                                                            'Doubles while the registry keeps failing\n'
+                                                            'DEFAULT: 60')
+
+    docker_group.add_argument('--registry-max-backoff', type=int, default=Config.registry_max_backoff,
+                              dest='REGISTRY_MAX_BACKOFF', help='Maximum seconds the images of a failing registry '
+                                                                'are skipped\n'
+                                                                'DEFAULT: 1800')
+
+    docker_group.add_argument('--rollback-retention', type=int, default=Config.rollback_retention,
+                              dest='ROLLBACK_RETENTION', help='Seconds the previous image and configuration of an '
+                                                              'updated container are kept, to roll it back. With '
+                                                              'cleanup, the previous image is removed after that. '
+                                                              '0 keeps nothing\n'
+                                                              'DEFAULT: 0')
+
+    docker_group.add_argument('--rollback-grace', type=int, default=Config.rollback_grace, dest='ROLLBACK_GRACE',
+                              help='Seconds an updated container is watched, with a rollback retention or a '
+                                   'rollout. It is rolled back if it exits with an error, restarts or turns '
+                                   'unhealthy\n'
+                                   'DEFAULT: 60')
+
+    docker_group.add_argument('--rollout-wave-size', type=int, default=Config.rollout_wave_size,
+                              dest='ROLLOUT_WAVE_SIZE', help='Roll updates out over the docker sockets in waves of '
+                                                             'this many sockets, after the canary socket. A wave '
+                                                             'starts once the containers of the last one passed '
+                                                             'their rollback grace. 0 updates every socket on its '
+                                                             'own\n'
+                                                             'DEFAULT: 0')
+
+    docker_group.add_argument('--rollout-canary', default=Config.rollout_canary, dest='ROLLOUT_CANARY',
+                              help='Docker socket updated first in a rollout\n'
+                                   'DEFAULT: The first docker socket')
+
+    docker_group.add_argument('--pull-source', default=Config.pull_source, dest='PULL_SOURCE',
+                              help='Docker socket that pulls the images of all sockets. The other sockets get them '
+                                   'streamed from it, instead of pulling from the registry\n'
+                                   'EXAMPLE: --pull-source tcp://build-cache:2376')
+
+    docker_group.add_argument('--rollback', nargs='+', metavar='CONTAINER', dest='ROLLBACK',
+                              help='Roll back these containers to their retained previous image and exit\n'
+                                   'EXAMPLE: --rollback container1 container2')
+
+    docker_group.add_argument('--tag-cache-ttl', type=int, default=Config.tag_cache_ttl, dest='TAG_CACHE_TTL',
+                              help='Seconds the tags of a repository are cached, for containers that track a '
+                                   'version constraint with the com.ouroboros.track label. Then only the pages of '
+                                   'the tag list that changed are fetched again\n'
+                                   'DEFAULT: 600')
+
     docker_group.add_argument('-S', '--swarm', default=Config.swarm, dest='SWARM', action='store_true',
                             help='Put ouroboros in swarm mode')
 
@@ -93,6 +229,18 @@ def main():
                               help='Container(s) to ignore\n'
                                    'EXAMPLE: -n container1 container2')
 
+    docker_group.add_argument('--priorities', nargs='+', default=Config.priorities, dest='PRIORITIES',
+                              help='Priority of container(s), as name=priority. Higher priorities are checked and '
+                                   'updated first. The com.ouroboros.priority label takes precedence\n'
+                                   'EXAMPLE: --priorities database=10 proxy=5')
+
+    docker_group.add_argument('--priority-max-wait', type=int, default=Config.priority_max_wait,
+                              dest='PRIORITY_MAX_WAIT', help='Cycles a container the cycle budget left unchecked or '
+                                                             'not updated waits at most before it goes first, '
+                                                             'whatever its priority. Until then its priority rises '
+                                                             'by one per cycle. 0 lets it only rise\n'
+                                                             'DEFAULT: 3')
+
     docker_group.add_argument('-k', '--label-enable', default=Config.label_enable, dest='LABEL_ENABLE',
                               action='store_true', help='Enable label monitoring for ouroboros label options\n'
                                                         'Note: labels take precedence'
@@ -132,6 +280,15 @@ def main():
                             dest='PROMETHEUS_PORT', help='Port to run Prometheus exporter on\n'
                                                          'DEFAULT: 8000')
 
+    data_group.add_argument('--status-addr', default=Config.status_addr, dest='STATUS_ADDR',
+                            help='Bind address of the status API\n'
+                                 'DEFAULT: 127.0.0.1')
+
+    data_group.add_argument('--status-port', type=int, default=Config.status_port, dest='STATUS_PORT',
+                            help='Port of the status API, which serves the monitored containers and their last checks '
+                                 'as JSON. On the Prometheus port, it serves the metrics too. 0 disables it\n'
+                                 'DEFAULT: 0')
+
     data_group.add_argument('-I', '--influx-url', default=Config.influx_url, dest='INFLUX_URL',
                             help='URL for influxdb\n'
                                   'DEFAULT: 127.0.0.1')
@@ -168,88 +325,359 @@ def main():
                               help='Wait time in seconds after updating a service/container when --single is enabled\n'
                                    'DEFAULT: 0')
 
-    _ = None
-    args = parser.parse_args()
+    docker_group.add_argument('--record', default=Config.record, dest='RECORD',
+                              help='Record all Docker API traffic, with secrets redacted, to a trace file\n'
+                                   'EXAMPLE: /app/pyouroboros/hooks/trace.jsonl.gz')
 
-    try:
-        language = gettext.translation('ouroboros', localedir='locales', languages=args.LANGUAGE)
-        language.install()
-        _ = language.gettext
-    except FileNotFoundError:
-        _ = gettext.gettext
+    docker_group.add_argument('--replay', default=Config.replay, dest='REPLAY',
+                              help='Serve the Docker API from a recorded trace file instead of the docker sockets\n'
+                                   'The sockets of the trace are used, -d is ignored')
+
+    docker_group.add_argument('--replay-delays', default=Config.replay_delays, dest='REPLAY_DELAYS',
+                              action='store_true', help='Wait as long as the recorded response took when replaying')
+
+    profile_group = parser.add_argument_group('Profiling', 'Tracing of update cycles')
+    profile_group.add_argument('--profile', default=Config.profile, dest='PROFILE',
+                               help='Write a trace of the spans of every update cycle to this directory\n'
+                                    'EXAMPLE: /app/pyouroboros/hooks/profiles')
+
+    profile_group.add_argument('--profile-format', choices=['chrome', 'otlp'], default=Config.profile_format,
+                               dest='PROFILE_FORMAT', help='Trace file format: Chrome trace-event or OTLP/JSON\n'
+                                                           'DEFAULT: chrome')
 
-    if environ.get('LOG_LEVEL'):
-        log_level = environ.get('LOG_LEVEL')
+    profile_group.add_argument('--profile-cprofile', default=Config.profile_cprofile, dest='PROFILE_CPROFILE',
+                               action='store_true', help='Also write cProfile output (.prof) for every cycle')
+
+    args = parser.parse_args()
+    _ = translation(args.LANGUAGE)
+
+    environment = config_environment(environ, environ.get('CONFIG_FILE') or args.CONFIG_FILE)
+    if environment.get('LOG_LEVEL'):
+        log_level = environment.get('LOG_LEVEL')
     else:
         log_level = args.LOG_LEVEL
-    ol = OuroborosLogger(level=log_level)
+    ol = OuroborosLogger(level=log_level, log_format=environment.get('LOG_FORMAT') or args.LOG_FORMAT)
     ol.logger.info(_('Version: %s-%s'), VERSION, BRANCH)
-    config = Config(environment_vars=environ, cli_args=args)
-    config_dict = {key: value for key, value in vars(config).items() if key.upper() in config.options}
-    ol.logger.debug(_("Ouroboros configuration: %s"), config_dict)
+    config = Config(environment_vars=environment, cli_args=args)
+    ol.logger.debug(_("Ouroboros configuration: %s"), Lazy(
+        lambda: {key: value for key, value in vars(config).items() if key.upper() in config.options}))
 
     data_manager = DataManager(config)
     notification_manager = NotificationManager(config, data_manager)
+    profiler = Profiler(config) if config.profile else None
+    # The state of the instance this one replaces on a self update
+    snapshot = handoff.receive()
+
+    if (args.ROLLBACK or config.run_once) and snapshot:
+        # Nothing to resume, the previous instance only waits for this one to start
+        handoff.signal_ready(snapshot, notification_manager)
+
+    if args.ROLLBACK:
+        rollback(config, data_manager, notification_manager, args.ROLLBACK, _)
+        return
+
+    if config.run_once:
+        run_once(config, data_manager, notification_manager, profiler, _)
+        return
+
+    # Imported here so that run once mode never pays for the scheduler or timezone database
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    if config.worker_processes:
+        from pyouroboros.workers import Supervisor
+
+        supervisor = Supervisor(config, data_manager, notification_manager)
+        supervisor.start()
+        ignore_reloads(_)
+        if snapshot:
+            handoff.signal_ready(snapshot, notification_manager)
+        if not config.skip_startup_notifications:
+            notification_manager.send(kind='startup', next_run=next_run_time(config))
+
+        while supervisor.workers:
+            supervisor.watch()
+            sleep(1)
+        return
+
     scheduler = BackgroundScheduler()
     scheduler.start()
+    reloader = schedule_sockets(scheduler, config, data_manager, notification_manager, profiler, _, snapshot)
+    reloader.watch()
+    if snapshot:
+        handoff.signal_ready(snapshot, notification_manager)
+
+    if not config.skip_startup_notifications:
+        notification_manager.send(kind='startup', next_run=next_run_time(config, scheduler))
+
+    while scheduler.get_jobs():
+        sleep(1)
 
+    scheduler.shutdown()
+
+
+def ignore_reloads(_):
+    """Log SIGHUP instead of exiting on it, for the worker processes, which have no Reloader"""
+    import signal
+
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: getLogger().warning(
+            _('The configuration is not reloaded with worker processes. Restart ouroboros to apply it')))
+
+
+def translation(language):
+    """Return the gettext function of the ouroboros messages in `language`"""
+    try:
+        translations = gettext.translation('ouroboros', localedir='locales', languages=language)
+        translations.install()
+        return translations.gettext
+    except FileNotFoundError:
+        return gettext.gettext
+
+
+def schedule_sockets(scheduler, config, data_manager, notification_manager, profiler, _, snapshot=None):
+    """
+    Connect to the sockets of `config` and add their self check and update jobs. With the `snapshot` of the instance
+    this one replaces, its state is restored and its schedule resumed. Return the Reloader of the configuration, which
+    keeps the modes and jobs.
+    """
+    from pytz import timezone
+    from pyouroboros.reload import Reloader
+
+    modes = connect_sockets(scheduler, config.docker_sockets, config, data_manager, notification_manager, _)
+    if config.pull_source:
+        from pyouroboros.distribution import Distributor
+
+        Distributor.attach(modes, config)
+    if snapshot:
+        handoff.restore(snapshot, modes, data_manager)
+
+    window = maintenance_window(config) if config.maintenance_window else None
+    job_ids, listener = schedule_modes(scheduler, modes, window, config, data_manager, profiler, _,
+                                       start=handoff.next_run(snapshot, timezone(config.tz)))
+    if config.status_port:
+        from pyouroboros.statusapi import StatusServer
+
+        StatusServer(config, modes, data_manager).start()
+    reloader = Reloader(scheduler, config, modes, window, job_ids, listener, data_manager, notification_manager,
+                        profiler, _)
+    state = handoff.Handoff(modes, data_manager, reloader.next_run)
+    for mode in modes:
+        if mode.mode == 'container':
+            mode.handoff = state
+    return reloader
+
+
+def connect_sockets(scheduler, sockets, config, data_manager, notification_manager, _):
+    """Connect to `sockets`, add the self check jobs of the container modes and return the modes"""
+    modes = []
+    for socket in sockets:
+        try:
+            mode = build_mode(socket, config, data_manager, notification_manager)
+            modes.append(mode)
+            if mode.mode == 'container':
+                scheduler.add_job(mode.self_check, name=_('Self Check for %s') % socket)
+        except ConnectionError:
+            getLogger().error(_("Could not connect to socket %s. Check your config"), socket)
+    return modes
+
+
+def schedule_modes(scheduler, modes, window, config, data_manager, profiler, _, start=None):
+    """Add the update jobs of `modes`, and the job of the maintenance `window` if there is one. Return the IDs of the
+    jobs and the listener counting their overruns. Interval jobs run first at `start`, else now."""
+    async_modes = []
+    rollout_modes = []
+    sockets_by_job = {}
+    for mode in modes:
+        if mode.mode == 'container':
+            mode.window = window
+        if config.check_engine == 'async':
+            # Checked together with the other sockets, see below
+            async_modes.append(mode)
+        elif config.rollout_wave_size:
+            rollout_modes.append(mode)
+        else:
+            job = schedule_update(scheduler, profiler.wrap(mode.update, mode.socket) if profiler else mode.update,
+                                  mode.socket, config, _, start)
+            sockets_by_job[job.id] = [mode.socket]
+
+    if async_modes:
+        from pyouroboros.asynccheck import AsyncCheckEngine
+
+        engine = AsyncCheckEngine(config, async_modes, profiler)
+        job = schedule_update(scheduler, engine.update, _('all sockets'), config, _, start)
+        sockets_by_job[job.id] = [mode.socket for mode in async_modes]
+
+    if rollout_modes:
+        from pyouroboros.rollout import Rollout
+
+        job = schedule_update(scheduler, Rollout(config, rollout_modes, profiler).update, _('all sockets'), config, _,
+                              start)
+        sockets_by_job[job.id] = [mode.socket for mode in rollout_modes]
+
+    job_ids = list(sockets_by_job)
+    if window is not None:
+        job_ids.append(schedule_window(scheduler, window, list(sockets_by_job), config, _).id)
+    return job_ids, watch_overruns(scheduler, sockets_by_job, data_manager)
+
+
+def next_run_time(config, scheduler=None):
+    """Return when the first update runs, for the startup notification. Without a scheduler, e.g. when worker
+    processes run the updates, the cron schedule is evaluated here."""
+    from pytz import timezone
+
+    if config.cron and scheduler:
+        return scheduler.get_jobs()[0].next_run_time
+    if config.cron:
+        from apscheduler.triggers.cron import CronTrigger
+
+        trigger = CronTrigger(minute=config.cron[0], hour=config.cron[1], day=config.cron[2], month=config.cron[3],
+                              day_of_week=config.cron[4], timezone=timezone(config.tz))
+        return trigger.get_next_fire_time(None, datetime.now(timezone(config.tz)))
+    now = datetime.now(timezone('UTC')).astimezone()
+    return now + timedelta(0, config.interval)
+
+
+def schedule_update(scheduler, update, socket, config, _, start=None):
+    """
+    Add the update job of a socket, on the cron schedule or every interval starting at `start` or now, and return it.
+    Only one cycle of a socket runs at a time: a run that comes due while the previous cycle is still going is skipped.
+    """
+    from pytz import timezone
+
+    if config.cron:
+        return scheduler.add_job(
+            update,
+            name=_('Cron container update for %s') % socket,
+            trigger='cron',
+            minute=config.cron[0],
+            hour=config.cron[1],
+            day=config.cron[2],
+            month=config.cron[3],
+            day_of_week=config.cron[4],
+            timezone=timezone(config.tz),
+            coalesce=True,
+            max_instances=1,
+            misfire_grace_time=config.grace
+        )
+    # The initial run is the first run of the interval job, so that it can't overlap with the next one
+    return scheduler.add_job(
+        update,
+        name=_('Interval container update for %s') % socket,
+        trigger='interval', seconds=config.interval,
+        next_run_time=start or datetime.now(timezone(config.tz)),
+        coalesce=True,
+        max_instances=1,
+        misfire_grace_time=config.grace
+    )
+
+
+def maintenance_window(config):
+    from pytz import timezone
+    from apscheduler.triggers.cron import CronTrigger
+    from pyouroboros.window import MaintenanceWindow
+
+    window = config.maintenance_window
+    trigger = CronTrigger(minute=window[0], hour=window[1], day=window[2], month=window[3], day_of_week=window[4],
+                          timezone=timezone(config.tz))
+    return MaintenanceWindow(trigger, config.maintenance_duration * 60, timezone(config.tz))
+
+
+def schedule_window(scheduler, window, job_ids, config, _):
+    """Open the maintenance window on its schedule, run the update jobs `job_ids` when it opens, and return its job"""
+    def open_window():
+        window.open()
+        getLogger().info(_('Maintenance window open until %s'), window.closes)
+        for job_id in job_ids:
+            scheduler.modify_job(job_id, next_run_time=window.now())
+
+    return scheduler.add_job(open_window, name=_('Maintenance window'), trigger=window.trigger, coalesce=True,
+                             max_instances=1, misfire_grace_time=config.grace)
+
+
+def watch_overruns(scheduler, sockets_by_job, data_manager):
+    """Count the update runs the scheduler skipped because the previous cycle was still running, or missed"""
+    from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+
+    def overrun(event):
+        # The scheduler logs a warning for both already
+        for socket in sockets_by_job.get(event.job_id, []):
+            data_manager.add_cycle_overrun(socket, 'missed' if event.code == EVENT_JOB_MISSED else 'skipped')
+
+    scheduler.add_listener(overrun, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+    return overrun
+
+
+def build_mode(socket, config, data_manager, notification_manager):
+    """Connect to a docker socket and return the Container or Service object that updates it"""
+    docker = Docker(socket, config, data_manager, notification_manager)
+    if config.swarm:
+        return Service(docker)
+    return Container(docker)
+
+
+def run_once(config, data_manager, notification_manager, profiler, _):
+    """Update every socket a single time, in parallel, without starting a scheduler or polling loop"""
+    logger = getLogger()
+    modes = []
     for socket in config.docker_sockets:
         try:
-            docker = Docker(socket, config, data_manager, notification_manager)
-            if config.swarm:
-                mode = Service(docker)
-            else:
-                mode = Container(docker)
-
-            if config.run_once:
-                scheduler.add_job(mode.update, name=_('Run Once container update for %s') % socket)
-            else:
-                if mode.mode == 'container':
-                    scheduler.add_job(mode.self_check, name=_('Self Check for %s') % socket)
-                if config.cron:
-                    scheduler.add_job(
-                        mode.update,
-                        name=_('Cron container update for %s') % socket,
-                        trigger='cron',
-                        minute=config.cron[0],
-                        hour=config.cron[1],
-                        day=config.cron[2],
-                        month=config.cron[3],
-                        day_of_week=config.cron[4],
-                        timezone=timezone(config.tz),
-                        coalesce=True,
-                        misfire_grace_time=config.grace
-                    )
-                else:
-                    scheduler.add_job(
-                        mode.update,
-                        name=_('Initial run interval container update for %s') % socket
-                    )
-                    scheduler.add_job(
-                        mode.update,
-                        name=_('Interval container update for %s') % socket,
-                        trigger='interval', seconds=config.interval,
-                        coalesce=True,
-                        misfire_grace_time=config.grace
-                    )
+            modes.append(build_mode(socket, config, data_manager, notification_manager))
         except ConnectionError:
-            ol.logger.error(_("Could not connect to socket %s. Check your config"), socket)
+            logger.error(_("Could not connect to socket %s. Check your config"), socket)
 
-    if config.run_once:
-        next_run = None
-    elif config.cron:
-        next_run = scheduler.get_jobs()[0].next_run_time
-    else:
-        now = datetime.now(timezone('UTC')).astimezone()
-        next_run = (now + timedelta(0, config.interval))
+    if config.pull_source:
+        from pyouroboros.distribution import Distributor
+
+        Distributor.attach(modes, config)
 
     if not config.skip_startup_notifications:
-        notification_manager.send(kind='startup', next_run=next_run)
+        notification_manager.send(kind='startup', next_run=None)
 
-    while scheduler.get_jobs():
-        sleep(1)
+    if config.check_engine == 'async' and modes:
+        from pyouroboros.asynccheck import AsyncCheckEngine
 
-    scheduler.shutdown()
+        logger.debug(_('Run Once container update for %s'), _('all sockets'))
+        AsyncCheckEngine(config, modes, profiler).update()
+        return
+
+    if config.rollout_wave_size and modes:
+        from pyouroboros.rollout import Rollout
+
+        logger.debug(_('Run Once container update for %s'), _('all sockets'))
+        Rollout(config, modes, profiler).update()
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(10, len(modes)) or 1) as executor:
+        futures = {}
+        for mode in modes:
+            logger.debug(_('Run Once container update for %s'), mode.socket)
+            futures[mode.socket] = executor.submit(profiler.wrap(mode.update, mode.socket) if profiler else mode.update)
+    for socket, future in futures.items():
+        if future.exception() is not None:
+            logger.error('Update of %s failed. Error: %s', socket, future.exception(), exc_info=future.exception())
+
+
+def rollback(config, data_manager, notification_manager, names, _):
+    """Roll back the containers `names` on every socket that retains their previous image"""
+    logger = getLogger()
+    if config.swarm:
+        logger.error(_('Services are rolled back with docker service rollback'))
+        return
+    remaining = list(names)
+    for socket in config.docker_sockets:
+        try:
+            mode = build_mode(socket, config, data_manager, notification_manager)
+        except ConnectionError:
+            logger.error(_("Could not connect to socket %s. Check your config"), socket)
+            continue
+        retained = mode.rollbacks.names()
+        for name in [name for name in names if name in retained]:
+            if mode.rollback(name, _('on demand')) and name in remaining:
+                remaining.remove(name)
+    for name in remaining:
+        logger.error(_('Could not roll back %s'), name)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,228 @@
+import json
+import threading
+
+from os import getpid, makedirs
+from time import time_ns, strftime
+from random import getrandbits
+from functools import wraps
+from logging import getLogger
+from os.path import join
+from contextlib import contextmanager
+
+from pyouroboros.logger import BlacklistFilter
+
+_local = threading.local()
+_cprofile_lock = threading.Lock()
+
+
+class NullSpan(object):
+    """Span returned while no cycle is being profiled. Entering and leaving it does nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    __slots__ = ('cycle', 'name', 'attributes', 'span_id', 'parent_id', 'thread_id', 'start', 'end')
+
+    def __init__(self, cycle, name, attributes):
+        self.cycle = cycle
+        self.name = name
+        self.attributes = attributes
+        self.span_id = '%016x' % getrandbits(64)
+        self.parent_id = None
+        self.thread_id = threading.get_ident()
+        self.start = None
+        self.end = None
+
+    def __enter__(self):
+        stack = _local.stack
+        self.parent_id = stack[-1].span_id if stack else None
+        stack.append(self)
+        self.start = time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time_ns()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        _local.stack.pop()
+        self.cycle.add(self)
+        return False
+
+    def set(self, **attributes):
+        """Add attributes to the span, e.g. results that are only known once the work is done"""
+        self.attributes.update(attributes)
+
+
+class Cycle(object):
+    """Spans of one profiled update cycle"""
+
+    def __init__(self, name, socket):
+        self.name = name
+        self.socket = socket
+        self.trace_id = '%032x' % getrandbits(128)
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def chrome_trace(self):
+        """Chrome trace-event format, as loaded by chrome://tracing, Perfetto or speedscope"""
+        pid = getpid()
+        return {
+            'displayTimeUnit': 'ms',
+            'otherData': {'socket': self.socket, 'trace_id': self.trace_id},
+            'traceEvents': [
+                {
+                    'name': span.name,
+                    'cat': 'ouroboros',
+                    'ph': 'X',
+                    'ts': span.start / 1000,
+                    'dur': (span.end - span.start) / 1000,
+                    'pid': pid,
+                    'tid': span.thread_id,
+                    'args': {key: str(value) for key, value in span.attributes.items()}
+                } for span in self.spans
+            ]
+        }
+
+    def otlp_trace(self):
+        """OTLP/JSON export format, as accepted by an OpenTelemetry collector"""
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'ouroboros'}}]},
+                'scopeSpans': [{
+                    'scope': {'name': 'pyouroboros'},
+                    'spans': [
+                        {
+                            'traceId': self.trace_id,
+                            'spanId': span.span_id,
+                            'parentSpanId': span.parent_id or '',
+                            'name': span.name,
+                            'kind': 1,
+                            'startTimeUnixNano': str(span.start),
+                            'endTimeUnixNano': str(span.end),
+                            'attributes': [{'key': key, 'value': {'stringValue': str(value)}}
+                                           for key, value in span.attributes.items()],
+                            'status': {'code': 2} if 'error' in span.attributes else {}
+                        } for span in self.spans
+                    ]
+                }]
+            }]
+        }
+
+
+def span(name, **attributes):
+    """
+    Return a span context manager for `name` in the update cycle profiled on this thread
+
+    This is the API for hooks as well, e.g.
+
+        from pyouroboros.profiler import span
+        with span('my_hook_work', container=container.name):
+            ...
+
+    Outside of a profiled cycle (including when profiling is disabled) a shared no-op span is returned.
+    """
+    cycle = getattr(_local, 'cycle', None)
+    if cycle is None:
+        return NULL_SPAN
+    return Span(cycle, name, attributes)
+
+
+def bind(func):
+    """Wrap `func` so that spans it opens on another thread (e.g. a worker pool) belong to the current cycle"""
+    cycle = getattr(_local, 'cycle', None)
+    if cycle is None:
+        return func
+
+    @wraps(func)
+    def bound(*args, **kwargs):
+        _local.cycle, _local.stack = cycle, []
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.cycle, _local.stack = None, []
+
+    return bound
+
+
+class Profiler(object):
+    """Writes the spans of every wrapped update cycle to a trace file, optionally with cProfile output"""
+
+    def __init__(self, config):
+        self.config = config
+        self.logger = getLogger()
+        self.directory = config.profile
+        self.redactor = BlacklistFilter(set(config.filtered_strings or []))
+        makedirs(self.directory, exist_ok=True)
+
+    def wrap(self, func, socket, name='update'):
+        @wraps(func)
+        def profiled(*args, **kwargs):
+            with self.cycle(socket, name):
+                return func(*args, **kwargs)
+
+        return profiled
+
+    @contextmanager
+    def cycle(self, socket, name='update'):
+        if getattr(_local, 'cycle', None) is not None:
+            # Already inside a profiled cycle on this thread
+            yield _local.cycle
+            return
+
+        redacted_socket = self.redactor.redact(socket)
+        cycle = Cycle(name, redacted_socket)
+        _local.cycle, _local.stack = cycle, []
+        profile = self.start_cprofile()
+        try:
+            with Span(cycle, name, {'socket': redacted_socket}):
+                yield cycle
+        finally:
+            if profile:
+                profile.disable()
+                _cprofile_lock.release()
+            _local.cycle, _local.stack = None, []
+            self.write(cycle, profile)
+
+    def start_cprofile(self):
+        if not self.config.profile_cprofile:
+            return None
+        # Only one cProfile can be active per process on recent Pythons, so concurrent cycles go without
+        if not _cprofile_lock.acquire(blocking=False):
+            self.logger.debug('cProfile is already running for another cycle, skipping it for this one')
+            return None
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def write(self, cycle, profile=None):
+        base = join(self.directory, f'{strftime("%Y%m%dT%H%M%S")}-{cycle.name}-{cycle.trace_id[:8]}')
+        try:
+            if self.config.profile_format == 'otlp':
+                path, payload = f'{base}.otlp.json', cycle.otlp_trace()
+            else:
+                path, payload = f'{base}.trace.json', cycle.chrome_trace()
+            with open(path, 'w') as file:
+                json.dump(payload, file)
+            if profile:
+                profile.dump_stats(f'{base}.prof')
+            self.logger.debug('Wrote profile of %s cycle for %s to %s', cycle.name, cycle.socket, path)
+        except OSError as e:
+            self.logger.error('Could not write profile to %s. Error: %s', self.directory, e)
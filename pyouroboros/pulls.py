@@ -0,0 +1,84 @@
+"""
+Streaming pulls
+
+Pulls read the progress stream of the Engine API line by line while the daemon downloads, instead of waiting for
+the pull to finish. The bytes downloaded are counted per layer as they are reported, and with PULL_RATE_LIMIT the
+stream is read no faster than the limit allows: a socket starts its next pull only once the bytes of the previous
+ones fit in the limit.
+"""
+from time import monotonic, sleep
+from threading import Lock
+from docker.errors import APIError
+
+# Seconds between the progress lines logged for a running pull
+PROGRESS_INTERVAL = 10
+MIB = 1024 * 1024
+
+
+class TokenBucket(object):
+    """Limits a flow to `rate` units per second, with bursts of up to one second of it"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def consume(self, amount):
+        """Take `amount` tokens, waiting until the bucket has refilled enough for them"""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens taken ahead of time are a debt that later callers wait for as well
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+
+
+class PullProgress(object):
+    """The layers of a pull and their bytes downloaded, from the lines of its progress stream"""
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.started = monotonic()
+        # Layer ID: [bytes downloaded, total bytes]
+        self.layers = {}
+        self.complete = set()
+        self.downloaded = 0
+
+    def feed(self, line):
+        """Take a line of the progress stream, return the bytes downloaded since the previous one"""
+        if line.get('error'):
+            # The daemon reports errors after the stream started in the stream, not as an HTTP error
+            raise APIError(line['error'], explanation=(line.get('errorDetail') or {}).get('message', line['error']))
+        status, layer = line.get('status', ''), line.get('id')
+        if status in ['Pulling fs layer', 'Waiting', 'Already exists']:
+            self.layers.setdefault(layer, [0, 0])
+        if status in ['Pull complete', 'Already exists']:
+            self.complete.add(layer)
+        if layer not in self.layers:
+            return 0
+
+        progress = self.layers[layer]
+        detail = line.get('progressDetail') or {}
+        if status == 'Downloading' and detail.get('current') is not None:
+            current = detail['current']
+            progress[1] = detail.get('total') or progress[1]
+        elif status == 'Download complete' and progress[1]:
+            current = progress[1]
+        else:
+            return 0
+        downloaded = max(0, current - progress[0])
+        progress[0] += downloaded
+        self.downloaded += downloaded
+        return downloaded
+
+    @property
+    def seconds(self):
+        return monotonic() - self.started
+
+    def summary(self):
+        return (f'{len(self.complete)} of {len(self.layers)} layers, {self.downloaded / MIB:.1f} MiB in '
+                f'{self.seconds:.1f}s ({self.downloaded / MIB / max(self.seconds, 0.001):.1f} MiB/s)')
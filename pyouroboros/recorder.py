@@ -0,0 +1,279 @@
+import gzip
+import json
+import atexit
+
+from io import BytesIO
+from time import perf_counter, sleep
+from threading import Lock
+from logging import getLogger
+from base64 import b64encode, b64decode
+from urllib.parse import urlsplit
+from collections import defaultdict, deque, Counter
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from pyouroboros.logger import BlacklistFilter
+
+TRACE_FORMAT = 'ouroboros-trace'
+TRACE_VERSION = 1
+
+# Response headers that docker-py or a registry client act on. Everything else is dropped to keep traces small.
+RECORDED_HEADERS = ['Content-Type', 'Api-Version', 'Docker-Content-Digest', 'Docker-Distribution-Api-Version',
+                    'Link', 'ETag', 'Location', 'WWW-Authenticate']
+
+_lock = Lock()
+_recorders = {}
+_traces = {}
+
+
+def request_key(method, url):
+    """Method and path with query of a request, without scheme and host"""
+    parts = urlsplit(url)
+    return f'{method} {parts.path}' + (f'?{parts.query}' if parts.query else '')
+
+
+def redact_socket(redactor, socket):
+    """Redact a socket but keep its scheme, so that the result is still usable as a socket string"""
+    scheme, _, rest = socket.partition('//')
+    return f'{scheme}//{redactor.redact(rest)}'
+
+
+def encode_body(data):
+    if not isinstance(data, (bytes, str)):
+        # Streamed request bodies (generators, files) are not recorded
+        return None
+    if isinstance(data, str):
+        return data
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return {'base64': b64encode(data).decode('ascii')}
+
+
+def decode_body(data):
+    if data is None:
+        return b''
+    if isinstance(data, dict):
+        return b64decode(data['base64'])
+    return data.encode('utf-8')
+
+
+class ReplayBody(BytesIO):
+    """
+    In-memory response body
+
+    docker-py reads streamed responses (e.g. pull progress) from `response.raw._fp` as long as it is chunked.
+    This body presents itself as a chunked stream where every line of the content is one chunk.
+    """
+    chunked = True
+
+    def __init__(self, content):
+        super().__init__(content)
+        self.content = content
+
+    @property
+    def _fp(self):
+        return self
+
+    @property
+    def chunk_left(self):
+        position = self.tell()
+        end = self.content.find(b'\n', position)
+        return (len(self.content) if end == -1 else end + 1) - position
+
+    def release_conn(self):
+        pass
+
+
+def build_response(request, status, headers, content, adapter):
+    response = Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.raw = ReplayBody(content)
+    response.reason = ''
+    response.url = request.url
+    response.request = request
+    response.connection = adapter
+    return response
+
+
+class TraceRecorder(object):
+    """Appends redacted request/response exchanges to a gzipped JSON lines trace file"""
+
+    def __init__(self, path, filtered_strings):
+        self.path = path
+        self.redactor = BlacklistFilter(set(filtered_strings))
+        self.lock = Lock()
+        self.sources = {}
+        self.file = gzip.open(path, 'wt', encoding='utf-8')
+        self.write({'type': 'header', 'format': TRACE_FORMAT, 'version': TRACE_VERSION})
+        atexit.register(self.close)
+
+    def write(self, entry):
+        line = json.dumps(entry, separators=(',', ':'))
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(line + '\n')
+            # Keep the trace readable even if ouroboros is killed mid cycle
+            self.file.flush()
+
+    def add_source(self, source, api_version=None):
+        self.write({'type': 'source', 'source': self.redact_source(source), 'api_version': api_version})
+
+    def redact_source(self, source):
+        """Redact a source name, keeping different sources apart even when their redacted forms are equal"""
+        with self.lock:
+            if source not in self.sources:
+                redacted = redact_socket(self.redactor, source) if '//' in source else self.redactor.redact(source)
+                taken = set(self.sources.values())
+                name, index = redacted, 1
+                while name in taken:
+                    index += 1
+                    name = f'{redacted}-{index}'
+                self.sources[source] = name
+            return self.sources[source]
+
+    def record(self, source, request, response, content, elapsed):
+        self.write({
+            'type': 'exchange',
+            'source': self.redact_source(source),
+            'key': self.redactor.redact(request_key(request.method, request.url)),
+            'request': self.redact_body(request.body),
+            'status': response.status_code,
+            'headers': {key: self.redactor.redact(value) for key, value in response.headers.items()
+                        if key.lower() in [header.lower() for header in RECORDED_HEADERS]},
+            'content': self.redact_body(content),
+            'elapsed': round(elapsed, 6)
+        })
+
+    def redact_body(self, data):
+        body = encode_body(data)
+        return self.redactor.redact(body) if isinstance(body, str) else body
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class RecordingAdapter(BaseAdapter):
+    """Transport adapter that passes requests to the wrapped adapter and records every exchange"""
+
+    def __init__(self, adapter, recorder, source):
+        super().__init__()
+        self.adapter = adapter
+        self.recorder = recorder
+        self.source = source
+
+    def send(self, request, **kwargs):
+        start = perf_counter()
+        response = self.adapter.send(request, **kwargs)
+        # Reading the content waits for streamed responses to finish, the same as docker-py does for a pull
+        content = response.content
+        self.recorder.record(self.source, request, response, content, perf_counter() - start)
+        response.raw = ReplayBody(content)
+        response._content = False
+        response._content_consumed = False
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class Trace(object):
+    """Recorded exchanges, served in recorded order per source and request"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.api_versions = {}
+        self.exchanges = defaultdict(deque)
+
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            try:
+                for line in file:
+                    entry = json.loads(line)
+                    if entry['type'] == 'header' and (entry.get('format') != TRACE_FORMAT
+                                                      or entry.get('version') != TRACE_VERSION):
+                        raise ValueError(f'{path} is not a version {TRACE_VERSION} ouroboros trace')
+                    elif entry['type'] == 'source':
+                        self.api_versions[entry['source']] = entry.get('api_version')
+                    elif entry['type'] == 'exchange':
+                        self.exchanges[(entry['source'], entry['key'])].append(entry)
+            except (EOFError, json.JSONDecodeError):
+                getLogger().warning('Trace %s is truncated, replaying the complete part', path)
+
+    @property
+    def sockets(self):
+        return [source for source in self.api_versions if '//' in source]
+
+    def next(self, source, key):
+        """Return the next recorded exchange for a request. The last one is repeated once all have been served."""
+        with self.lock:
+            exchanges = self.exchanges.get((source, key))
+            if not exchanges:
+                return None
+            return exchanges.popleft() if len(exchanges) > 1 else exchanges[0]
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport adapter that answers requests from a trace without any network access"""
+
+    def __init__(self, trace, source, delays=False):
+        super().__init__()
+        self.trace = trace
+        self.source = source
+        self.delays = delays
+        self.calls = Counter()
+
+    def send(self, request, **kwargs):
+        key = request_key(request.method, request.url)
+        self.calls[key] += 1
+        exchange = self.trace.next(self.source, key)
+        if exchange is None:
+            getLogger().debug('No recorded response for %s on %s', key, self.source)
+            content = json.dumps({'message': f'ouroboros replay: no recorded response for {key}'}).encode()
+            return build_response(request, 404, {'Content-Type': 'application/json'}, content, self)
+        if self.delays:
+            sleep(exchange['elapsed'])
+        return build_response(request, exchange['status'], exchange['headers'], decode_body(exchange['content']),
+                              self)
+
+    def close(self):
+        pass
+
+
+def get_recorder(path, filtered_strings):
+    """Return the recorder for a trace file, shared by all sockets"""
+    with _lock:
+        if path not in _recorders:
+            _recorders[path] = TraceRecorder(path, filtered_strings)
+        return _recorders[path]
+
+
+def load_trace(path):
+    with _lock:
+        if path not in _traces:
+            _traces[path] = Trace(path)
+        return _traces[path]
+
+
+def record_session(session, source, config):
+    """Record all traffic of a requests session (e.g. `DockerClient.api`) to the configured trace file"""
+    recorder = get_recorder(config.record, config.filtered_strings)
+    for prefix, adapter in list(session.adapters.items()):
+        session.mount(prefix, RecordingAdapter(adapter, recorder, source))
+    return recorder
+
+
+def replay_session(session, source, config):
+    """Serve all requests of a requests session from the configured trace file"""
+    adapter = ReplayAdapter(load_trace(config.replay), source, delays=config.replay_delays)
+    for prefix in ['http+docker://', 'http://', 'https://']:
+        session.mount(prefix, adapter)
+    return adapter
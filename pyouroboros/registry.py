@@ -0,0 +1,274 @@
+import re
+
+from time import monotonic
+from base64 import b64encode
+from threading import Lock
+from logging import getLogger
+from ipaddress import ip_address
+from itertools import chain
+from urllib.parse import urljoin
+from requests import Session, RequestException, Timeout, ConnectionError as RequestsConnectionError
+
+from pyouroboros.helpers import registry_host
+from pyouroboros.circuitbreaker import CircuitBreaker
+
+# Error classes of a failed pull, in the order they are matched. The daemon wraps most registry errors in a 500,
+# so the message is checked before the status code.
+AUTH = 'auth'
+RATE_LIMIT = 'rate_limit'
+NOT_FOUND = 'not_found'
+TIMEOUT = 'timeout'
+TLS = 'tls'
+SERVER = 'server'
+OTHER = 'other'
+CIRCUIT_OPEN = 'circuit_open'
+
+ERROR_PATTERNS = [
+    (RATE_LIMIT, ['toomanyrequests', 'too many requests', 'rate limit']),
+    (NOT_FOUND, ['pull access denied', 'manifest unknown', 'repository does not exist', 'name unknown',
+                 'not found', 'no such image']),
+    (AUTH, ['unauthorized', 'authentication required', 'denied', 'incorrect username or password']),
+    (TIMEOUT, ['client.timeout', 'timeout', 'deadline exceeded', 'timed out']),
+    (TLS, ['tls handshake', 'x509', 'certificate', 'tls:']),
+    (SERVER, ['<html>', 'bad gateway', 'service unavailable', 'internal server error',
+              'received unexpected http status: 5'])
+]
+
+# Errors that say something about the registry as a whole, rather than about one image. They count towards
+# the registry's circuit breaker, and are retried.
+REGISTRY_ERRORS = [RATE_LIMIT, TIMEOUT, TLS, SERVER]
+RETRIED_ERRORS = [TIMEOUT, SERVER]
+# Seconds before the first retry, doubled for every following one. The actual delay is a random share of it.
+RETRY_DELAY = 1
+
+# Manifest types accepted when resolving a tag, multi-platform indexes first, as the daemon records their digest
+MANIFEST_TYPES = ['application/vnd.oci.image.index.v1+json',
+                  'application/vnd.docker.distribution.manifest.list.v2+json',
+                  'application/vnd.oci.image.manifest.v1+json',
+                  'application/vnd.docker.distribution.manifest.v2+json']
+
+CHALLENGE_PARAM = re.compile(r'(\w+)="([^"]*)"')
+
+# Tags asked for per page of a tag list. Registries may answer with less and link to the next page.
+TAGS_PAGE_SIZE = 1000
+
+_lock = Lock()
+_breakers = {}
+_tag_lister = None
+
+
+class PullError(ConnectionError):
+    """A pull that failed, with the registry and the class of the error"""
+
+    def __init__(self, registry, error_class, error=None):
+        super().__init__(f'{error_class} error from {registry}: {error}')
+        self.registry = registry
+        self.error_class = error_class
+        self.error = error
+
+
+def classify_error(error):
+    """Return the error class of an exception raised by a pull"""
+    # Raised by the docker client itself, e.g. a read timeout between the lines of a streaming pull
+    if isinstance(error, Timeout):
+        return TIMEOUT
+    if isinstance(error, RequestsConnectionError):
+        return SERVER
+    message = str(error).lower()
+    for error_class, patterns in ERROR_PATTERNS:
+        if any(pattern in message for pattern in patterns):
+            return error_class
+
+    status_code = getattr(error, 'status_code', None)
+    if status_code == 429:
+        return RATE_LIMIT
+    if status_code in [401, 403]:
+        return AUTH
+    if status_code == 404:
+        return NOT_FOUND
+    if status_code is not None and status_code >= 500:
+        return SERVER
+    return OTHER
+
+
+def registry_breaker(registry, config):
+    """Return the circuit breaker of a registry, shared by all sockets"""
+    with _lock:
+        if registry not in _breakers:
+            _breakers[registry] = CircuitBreaker(registry, threshold=config.registry_threshold,
+                                                 backoff=config.registry_backoff,
+                                                 max_backoff=config.registry_max_backoff)
+        return _breakers[registry]
+
+
+def reconfigure_breakers(config):
+    """Apply the breaker options of a reloaded `config` to the registry breakers, keeping their state"""
+    with _lock:
+        for breaker in _breakers.values():
+            breaker.threshold = max(1, config.registry_threshold)
+            breaker.backoff = config.registry_backoff
+            breaker.max_backoff = config.registry_max_backoff
+
+
+def parse_reference(tag):
+    """Return the registry host, repository and tag or digest of an image reference"""
+    host = registry_host(tag)
+    name = tag.split('/', 1)[1] if tag.startswith(f'{host}/') else tag
+    if '@' in name:
+        name, reference = name.split('@', 1)
+    elif ':' in name.split('/')[-1]:
+        name, reference = name.rsplit(':', 1)
+    else:
+        reference = 'latest'
+    if host == 'docker.io' and '/' not in name:
+        name = f'library/{name}'
+    return host, name, reference
+
+
+def registry_url(host):
+    """Base URL of a registry's API. Like the daemon, loopback registries are spoken to over plain http."""
+    if host == 'docker.io':
+        return 'https://registry-1.docker.io'
+    hostname = host.rsplit(':', 1)[0] if host.count(':') == 1 else host
+    try:
+        insecure = hostname == 'localhost' or ip_address(hostname.strip('[]')).is_loopback
+    except ValueError:
+        insecure = False
+    return f'{"http" if insecure else "https"}://{host}'
+
+
+def parse_challenge(header):
+    """Return the scheme and parameters of a WWW-Authenticate header, e.g. Bearer realm="...",service="..." """
+    scheme, _, rest = header.strip().partition(' ')
+    return scheme.lower(), {key.lower(): value for key, value in CHALLENGE_PARAM.findall(rest)}
+
+
+class TagList(object):
+    """The cached tags of a repository, and the pages they were listed from by URL, as (etag, tags, next URL)"""
+    __slots__ = ('tags', 'pages', 'listed', 'lock')
+
+    def __init__(self):
+        self.tags = frozenset()
+        self.pages = {}
+        self.listed = None
+        self.lock = Lock()
+
+
+class TagLister(object):
+    """
+    Lists the tags of repositories over the registry API, with token authentication
+
+    Tag lists are cached for TAG_CACHE_TTL seconds. Then the repository is listed again page by page, asking for
+    every page with the etag it had, so that the registry only sends the pages that changed.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.logger = getLogger()
+        self.session = Session()
+        self.lock = Lock()
+        self.authorizations = {}
+        self.tag_lists = {}
+
+    def tags(self, host, repository):
+        """Return the tags of a repository. Raises PullError if the registry can't list them."""
+        with self.lock:
+            tag_list = self.tag_lists.setdefault((host, repository), TagList())
+        with tag_list.lock:
+            if tag_list.listed is None or monotonic() - tag_list.listed >= self.config.tag_cache_ttl:
+                url = f'{registry_url(host)}/v2/{repository}/tags/list?n={TAGS_PAGE_SIZE}'
+                tag_list.pages = self.list_pages(url, host, repository, tag_list.pages)
+                tag_list.tags = frozenset(chain.from_iterable(tags for _, tags, _ in tag_list.pages.values()))
+                tag_list.listed = monotonic()
+            return tag_list.tags
+
+    def export(self):
+        """Return the cached tag lists, with their age in seconds, for the instance that replaces this one"""
+        with self.lock:
+            tag_lists = [(key, tag_list) for key, tag_list in self.tag_lists.items() if tag_list.listed is not None]
+        return [{'host': host, 'repository': repository, 'age': monotonic() - tag_list.listed,
+                 'pages': [[url, etag, list(tags), next_url] for url, (etag, tags, next_url) in tag_list.pages.items()]}
+                for (host, repository), tag_list in tag_lists]
+
+    def restore(self, exported, elapsed=0):
+        """Cache the tag lists `exported` by another instance `elapsed` seconds ago"""
+        with self.lock:
+            for entry in exported:
+                tag_list = self.tag_lists.setdefault((entry['host'], entry['repository']), TagList())
+                tag_list.pages = {url: (etag, tuple(tags), next_url) for url, etag, tags, next_url in entry['pages']}
+                tag_list.tags = frozenset(chain.from_iterable(tags for _, tags, _ in tag_list.pages.values()))
+                tag_list.listed = monotonic() - entry['age'] - elapsed
+
+    def list_pages(self, url, host, repository, cached_pages):
+        """Return the pages of a tag list, starting at `url`, by URL"""
+        breaker = registry_breaker(host, self.config)
+        pages = {}
+        while url and url not in pages:
+            if not breaker.allow():
+                raise PullError(host, CIRCUIT_OPEN)
+            etag = cached_pages.get(url, (None, None, None))[0]
+            try:
+                response = self.get(url, host, repository, {'If-None-Match': etag} if etag else {})
+                if response.status_code != 304:
+                    response.raise_for_status()
+            except RequestException as e:
+                error_class = classify_error(e)
+                if error_class in REGISTRY_ERRORS and breaker.failure():
+                    self.logger.error('Registry %s is failing, skipping its images for %.0fs', host,
+                                      breaker.retry_in)
+                raise PullError(host, error_class, e) from e
+            breaker.success()
+
+            if response.status_code == 304:
+                pages[url] = cached_pages[url]
+            else:
+                next_url = response.links.get('next', {}).get('url')
+                pages[url] = (response.headers.get('ETag'), tuple(response.json().get('tags') or []),
+                              urljoin(url, next_url) if next_url else None)
+            url = pages[url][2]
+        return pages
+
+    def get(self, url, host, repository, headers):
+        """GET `url`, answering the registry's authentication challenge once if there is one"""
+        authorization = self.authorizations.get((host, repository))
+        if authorization:
+            headers['Authorization'] = authorization
+        response = self.session.get(url, headers=headers, timeout=self.config.docker_timeout)
+        if response.status_code != 401:
+            return response
+
+        # No token yet, or it expired
+        authorization = self.authorize(response.headers.get('WWW-Authenticate', ''), repository)
+        if authorization is None:
+            return response
+        self.authorizations[(host, repository)] = headers['Authorization'] = authorization
+        return self.session.get(url, headers=headers, timeout=self.config.docker_timeout)
+
+    def authorize(self, challenge, repository):
+        """Return the Authorization header answering a registry's challenge"""
+        scheme, params = parse_challenge(challenge)
+        credentials = (self.config.repo_user, self.config.repo_pass) if self.config.auth_json else None
+        if scheme == 'basic' and credentials:
+            return 'Basic ' + b64encode(':'.join(credentials).encode()).decode()
+        if scheme != 'bearer' or 'realm' not in params:
+            return None
+
+        query = {'scope': f'repository:{repository}:pull'}
+        if 'service' in params:
+            query['service'] = params['service']
+        response = self.session.get(params['realm'], params=query, auth=credentials,
+                                    timeout=self.config.docker_timeout)
+        if response.status_code != 200:
+            return None
+        token = response.json()
+        token = token.get('token') or token.get('access_token')
+        return f'Bearer {token}' if token else None
+
+
+def tag_lister(config):
+    """Return the tag lister, whose cache is shared by all sockets"""
+    global _tag_lister
+    with _lock:
+        if _tag_lister is None:
+            _tag_lister = TagLister(config)
+        return _tag_lister
@@ -0,0 +1,210 @@
+"""
+Configuration reload
+
+On SIGHUP, and when the CONFIG_FILE changes, the configuration is parsed again and the options that changed are
+applied to the running process. The Config object is updated in place, and only what was built from a changed option
+is rebuilt: the docker clients, the sockets added or removed, the update jobs, the notifiers and the influxdb
+exporter. The monitored containers, their last checks, the work queues, the prefetched updates and the registry tag
+cache stay warm. The options that shape the process, e.g. WORKER_PROCESSES, are only applied by a restart.
+"""
+from os import environ, stat
+from logging import getLogger
+from threading import Lock
+
+from pyouroboros.config import Config, read_config_file
+
+# Seconds between the checks of the CONFIG_FILE for changes, and of a SIGHUP
+WATCH_INTERVAL = 5
+
+RESTART_OPTIONS = ['RUN_ONCE', 'DRY_RUN', 'SWARM', 'WORKER_PROCESSES', 'PULL_SOURCE', 'RECORD', 'REPLAY',
+                   'REPLAY_DELAYS', 'PROFILE', 'PROFILE_FORMAT', 'PROFILE_CPROFILE', 'LOG_FORMAT', 'LANGUAGE',
+                   'DATA_EXPORT', 'PROMETHEUS', 'PROMETHEUS_ADDR', 'PROMETHEUS_PORT', 'STATUS_ADDR', 'STATUS_PORT',
+                   'CONFIG_FILE']
+CLIENT_OPTIONS = ['DOCKER_TLS', 'DOCKER_TLS_VERIFY', 'DOCKER_TIMEOUT', 'DOCKER_POOL_SIZE', 'DOCKER_KEEPALIVE',
+                  'CHECK_WORKERS']
+SCHEDULE_OPTIONS = ['DOCKER_SOCKETS', 'INTERVAL', 'CRON', 'GRACE', 'TZ', 'CHECK_ENGINE', 'ROLLOUT_WAVE_SIZE',
+                    'ROLLOUT_CANARY', 'MAINTENANCE_WINDOW', 'MAINTENANCE_DURATION']
+WINDOW_OPTIONS = ['MAINTENANCE_WINDOW', 'MAINTENANCE_DURATION', 'TZ']
+REGISTRY_OPTIONS = ['REGISTRY_THRESHOLD', 'REGISTRY_BACKOFF', 'REGISTRY_MAX_BACKOFF']
+INFLUX_OPTIONS = ['INFLUX_URL', 'INFLUX_PORT', 'INFLUX_USERNAME', 'INFLUX_PASSWORD', 'INFLUX_DATABASE', 'INFLUX_SSL',
+                  'INFLUX_VERIFY_SSL']
+
+
+class Reloader(object):
+    """Applies a reloaded configuration to the container and service `modes` scheduled on `scheduler`"""
+
+    def __init__(self, scheduler, config, modes, window, job_ids, listener, data_manager, notification_manager,
+                 profiler, _):
+        self.scheduler = scheduler
+        self.config = config
+        # The list the StatusServer reads, sockets are added to and removed from it in place
+        self.modes = modes
+        self.window = window
+        self.job_ids = job_ids
+        self.listener = listener
+        self.data_manager = data_manager
+        self.notification_manager = notification_manager
+        self.profiler = profiler
+        self._ = _
+        self.logger = getLogger()
+        self.lock = Lock()
+        self.requested = False
+        self.stamp = None
+
+    def watch(self):
+        """Reload on SIGHUP and when the config file changes. Called from the main thread, which gets the signals."""
+        import signal
+
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.request)
+        self.stamp = self.file_stamp()
+        self.scheduler.add_job(self.poll, name=self._('Configuration reload'), trigger='interval',
+                               seconds=WATCH_INTERVAL, coalesce=True, max_instances=1)
+
+    def request(self, signum=None, frame=None):
+        # Only flagged here: the signal handler interrupts the main thread, which must not take the scheduler locks
+        self.requested = True
+
+    def file_stamp(self):
+        if not self.config.config_file:
+            return None
+        try:
+            stats = stat(self.config.config_file)
+        except OSError:
+            return None
+        return stats.st_mtime_ns, stats.st_size
+
+    def poll(self):
+        stamp = self.file_stamp()
+        if self.requested:
+            self.requested = False
+            self.stamp = stamp
+            self.reload('SIGHUP')
+        elif stamp != self.stamp:
+            self.stamp = stamp
+            self.reload(self.config.config_file)
+
+    def reload(self, reason):
+        """Parse the configuration again and apply the options that changed, return their names"""
+        with self.lock:
+            environment = environ
+            if self.config.config_file:
+                try:
+                    environment = {**environ, **read_config_file(self.config.config_file)}
+                except OSError as e:
+                    self.logger.error('Could not read the config file %s, keeping the configuration. Error: %s',
+                                      self.config.config_file, e)
+                    return []
+
+            config = Config(environment_vars=environment, cli_args=self.config.cli_args)
+            changed = [option for option in Config.options
+                       if getattr(config, option.lower()) != getattr(self.config, option.lower())]
+            restart = [option for option in changed if option in RESTART_OPTIONS]
+            if restart:
+                self.logger.warning('Restart ouroboros to apply the changes of %s', ', '.join(restart))
+            changed = [option for option in changed if option not in RESTART_OPTIONS]
+
+            for option in changed:
+                setattr(self.config, option.lower(), getattr(config, option.lower()))
+            self.config.auth_json = config.auth_json
+            # Parsing set the filter of the new config. The removed secrets stay masked, e.g. for the sockets that
+            # are dropped below.
+            self.config.config_blacklist(keep=self.config.filtered_strings)
+            if not changed:
+                self.logger.info('Reloaded the configuration on %s, nothing to apply', reason)
+                return []
+
+            self.apply(changed)
+            self.logger.info('Reloaded the configuration on %s, applied %s', reason, ', '.join(changed))
+            return changed
+
+    def apply(self, changed):
+        """Rebuild what was built from the `changed` options, the rest is read from the config by every cycle"""
+        if any(option in CLIENT_OPTIONS for option in changed):
+            for mode in self.modes:
+                mode.docker.reconnect()
+        if 'DOCKER_SOCKETS' in changed:
+            self.update_sockets()
+        for mode in self.modes:
+            mode.reconfigure(changed)
+
+        if any(option in REGISTRY_OPTIONS for option in changed):
+            from pyouroboros.registry import reconfigure_breakers
+
+            reconfigure_breakers(self.config)
+        if 'NOTIFIERS' in changed:
+            self.notification_manager.apprise = \
+                self.notification_manager.build_apprise() if self.config.notifiers else None
+        if any(option in INFLUX_OPTIONS for option in changed) and self.config.data_export == 'influxdb':
+            from pyouroboros.dataexporters import InfluxClient
+
+            self.data_manager.influx = InfluxClient(self.data_manager, self.config)
+        if 'LOG_LEVEL' in changed:
+            self.set_log_level()
+
+        if any(option in WINDOW_OPTIONS for option in changed):
+            from pyouroboros.ouroboros import maintenance_window
+
+            self.window = maintenance_window(self.config) if self.config.maintenance_window else None
+        if any(option in SCHEDULE_OPTIONS for option in changed):
+            self.reschedule()
+
+    def update_sockets(self):
+        """Connect to the sockets that were added and drop the ones that were removed, keeping the others"""
+        from pyouroboros.ouroboros import connect_sockets
+
+        sockets = self.config.docker_sockets
+        connected = [mode.socket for mode in self.modes]
+        removed = [mode for mode in self.modes if mode.socket not in sockets]
+        for mode in removed:
+            self.modes.remove(mode)
+        added = connect_sockets(self.scheduler, [socket for socket in sockets if socket not in connected],
+                                self.config, self.data_manager, self.notification_manager, self._)
+        self.modes.extend(added)
+        self.modes.sort(key=lambda mode: sockets.index(mode.socket))
+
+        if self.config.pull_source and self.config.pull_source not in sockets:
+            self.logger.warning('Pull source %s was removed, every socket pulls on its own', self.config.pull_source)
+            for mode in self.modes:
+                mode.distributor = None
+        elif self.config.pull_source:
+            distributor = next((mode.distributor for mode in self.modes if getattr(mode, 'distributor', None)), None)
+            for mode in added:
+                if mode.mode == 'container':
+                    mode.distributor = distributor
+        handoff = next((mode.handoff for mode in self.modes if getattr(mode, 'handoff', None)), None)
+        for mode in added:
+            if mode.mode == 'container':
+                mode.handoff = handoff
+        self.logger.info('Sockets added: %s, removed: %s', ', '.join(mode.socket for mode in added) or 'none',
+                         ', '.join(mode.socket for mode in removed) or 'none')
+
+    def reschedule(self):
+        """Replace the update jobs, with the schedule of the config and for the modes connected now"""
+        from apscheduler.jobstores.base import JobLookupError
+        from pyouroboros.ouroboros import schedule_modes
+
+        for job_id in self.job_ids:
+            try:
+                self.scheduler.remove_job(job_id)
+            except JobLookupError:
+                pass
+        self.scheduler.remove_listener(self.listener)
+        self.job_ids, self.listener = schedule_modes(self.scheduler, self.modes, self.window, self.config,
+                                                     self.data_manager, self.profiler, self._)
+
+    def next_run(self):
+        """Return when the next update cycle is due, None if none is scheduled"""
+        runs = [job.next_run_time for job in self.scheduler.get_jobs()
+                if job.id in self.job_ids and job.next_run_time is not None]
+        return min(runs) if runs else None
+
+    def set_log_level(self):
+        logger = getLogger()
+        try:
+            logger.setLevel(self.config.log_level.upper())
+        except ValueError:
+            self.logger.error('%s is not a log level, keeping %s', self.config.log_level, logger.level)
+            return
+        for handler in logger.handlers:
+            handler.setLevel(self.config.log_level.upper())
@@ -0,0 +1,112 @@
+"""
+Rollback of container updates
+
+Before a container is recreated, its previous image and configuration are retained for ROLLBACK_RETENTION
+seconds: the image stays on the host, the configuration is kept in a JSON file per socket under hooks/rollback.
+A rollback is then one local recreate, also from `ouroboros --rollback` in another process. Images the update would
+have removed with CLEANUP are removed once they are no longer retained.
+"""
+import re
+import json
+
+from os import replace
+from time import time
+from pathlib import Path
+from logging import getLogger
+from threading import Lock
+
+from pyouroboros.helpers import get_exec_dir
+
+ROLLBACK_DIR = get_exec_dir() + '/hooks/rollback'
+
+
+def split_reference(reference):
+    """Return the repository and tag of an image reference, None for the tag of a reference pinned to a digest"""
+    if '@' in reference:
+        return reference.split('@', 1)[0], None
+    if ':' in reference.split('/')[-1]:
+        repository, tag = reference.rsplit(':', 1)
+        return repository, tag
+    return reference, 'latest'
+
+
+def container_config(record):
+    """The retained configuration of a record, as create_container takes it. JSON made lists of its port tuples."""
+    config = dict(record['config'])
+    if config.get('ports'):
+        config['ports'] = [tuple(port) if isinstance(port, list) else port for port in config['ports']]
+    return config
+
+
+class RollbackStore(object):
+    """
+    The rollback records of the containers of a socket, by container name, and the images rolled back from.
+    Every call reads the file again, so that processes sharing it see each other's changes.
+    """
+
+    def __init__(self, socket):
+        self.path = Path(ROLLBACK_DIR, re.sub(r'[^A-Za-z0-9_.-]', '_', socket) + '.json')
+        self.lock = Lock()
+        self.logger = getLogger()
+
+    def read(self):
+        try:
+            with open(self.path) as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            state = {}
+        except (OSError, ValueError) as e:
+            self.logger.error('Could not read rollback records from %s. Error: %s', self.path, e)
+            state = {}
+        state.setdefault('records', {})
+        state.setdefault('rejected', {})
+        return state
+
+    def write(self, state):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temporary = self.path.with_suffix('.tmp')
+            with open(temporary, 'w') as file:
+                json.dump(state, file)
+            replace(temporary, self.path)
+        except OSError as e:
+            self.logger.error('Could not save rollback records to %s. Error: %s', self.path, e)
+
+    def retain(self, name, record):
+        """Keep the record of a container's update, replacing the one of its last update. Returns the latter."""
+        with self.lock:
+            state = self.read()
+            previous = state['records'].get(name)
+            state['records'][name] = dict(record, retained_at=time())
+            state['rejected'].pop(name, None)
+            self.write(state)
+            return previous
+
+    def get(self, name):
+        return self.read()['records'].get(name)
+
+    def names(self):
+        return list(self.read()['records'])
+
+    def rolled_back(self, name, image_id):
+        """Drop the record of a container rolled back from `image_id`, and remember not to update it to that image"""
+        with self.lock:
+            state = self.read()
+            state['records'].pop(name, None)
+            state['rejected'][name] = image_id
+            self.write(state)
+
+    def rejected(self, name):
+        return self.read()['rejected'].get(name)
+
+    def expire(self, retention):
+        """Drop and return the records retained longer than `retention` seconds"""
+        with self.lock:
+            state = self.read()
+            expired = {name: record for name, record in state['records'].items()
+                       if time() - record['retained_at'] >= retention}
+            if expired:
+                for name in expired:
+                    del state['records'][name]
+                self.write(state)
+            return expired
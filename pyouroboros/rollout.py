@@ -0,0 +1,45 @@
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Rollout(object):
+    """
+    Updates the sockets in waves: the canary socket on its own, then ROLLOUT_WAVE_SIZE sockets at a time, in
+    parallel. The containers a wave updates are watched for ROLLBACK_GRACE seconds, and the next wave only starts if
+    none of them failed. The images they failed with are not rolled out to any socket afterwards.
+    """
+
+    def __init__(self, config, modes, profiler=None):
+        self.config = config
+        self.logger = getLogger()
+        self.updates = {mode.socket: profiler.wrap(mode.update, mode.socket) if profiler else mode.update
+                        for mode in modes}
+        # Image IDs are content addressed, the same image has the same ID on every socket
+        self.rejected = set()
+        for mode in modes:
+            mode.rejected_images = self.rejected
+
+        canary = next((mode for mode in modes if mode.socket == config.rollout_canary), modes[0])
+        rest = [mode for mode in modes if mode is not canary]
+        size = config.rollout_wave_size
+        self.waves = [[canary]] + [rest[index:index + size] for index in range(0, len(rest), size)]
+
+    def update(self):
+        for number, wave in enumerate(self.waves, 1):
+            with ThreadPoolExecutor(max_workers=len(wave)) as executor:
+                futures = {mode.socket: executor.submit(self.updates[mode.socket]) for mode in wave}
+            for socket, future in futures.items():
+                if future.exception() is not None:
+                    self.logger.error('Update of %s failed. Error: %s', socket, future.exception(),
+                                      exc_info=future.exception())
+
+            failed = [(mode.socket, name, image_id) for mode in wave for name, image_id in mode.failed]
+            if failed:
+                self.rejected.update(image_id for _, _, image_id in failed)
+                self.logger.error('Halting the rollout after wave %d of %d, %s', number, len(self.waves),
+                                  ', '.join(f'{name} failed on {socket} with {image_id[7:19]}'
+                                            for socket, name, image_id in failed),
+                                  extra={'phase': 'rollout'})
+                return
+            self.logger.debug('Wave %d of %d (%s) passed', number, len(self.waves),
+                              ', '.join(mode.socket for mode in wave), extra={'phase': 'rollout'})
@@ -0,0 +1,100 @@
+import re
+
+# Label of the version constraint a container tracks, e.g. ~1.4
+TRACK_LABEL = 'com.ouroboros.track'
+# A version tag: up to three numbers, optionally prefixed with v, optionally followed by a variant, e.g. 1.25-alpine
+VERSION = re.compile(r'^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?(?:-([0-9A-Za-z][0-9A-Za-z._-]*))?$')
+COMPARATOR = re.compile(r'^(>=|<=|>|<|=|~|\^)?\s*v?(\d+|[x*])(?:\.(\d+|[x*]))?(?:\.(\d+|[x*]))?$')
+
+
+def parse_version(tag):
+    """Return the (major, minor, patch) numbers and the variant of a version tag, None if it is no version"""
+    match = VERSION.match(tag)
+    if match is None:
+        return None
+    major, minor, patch, variant = match.groups()
+    return (int(major), int(minor or 0), int(patch or 0)), variant or ''
+
+
+def parse_constraint(constraint):
+    """
+    Return the (operator, version) bounds of a constraint. A constraint is a comma separated list of
+    comparisons that must all hold, e.g. >=1.2,<2. Like npm:
+    ~1.4 allows patch versions (>=1.4.0,<1.5.0), ^1.4 allows minor versions (>=1.4.0,<2.0.0), 1.4, 1.4.x and
+    1.4.* allow what they leave open (>=1.4.0,<1.5.0) and * allows any version.
+    Raises ValueError for an invalid constraint.
+    """
+    bounds = []
+    for comparison in constraint.split(','):
+        comparison = comparison.strip()
+        match = COMPARATOR.match(comparison)
+        if match is None:
+            raise ValueError(f'invalid version constraint {comparison!r} in {constraint!r}')
+        operator, *parts = match.groups()
+        numbers = []
+        for part in parts:
+            if part is None or part in 'x*':
+                break
+            numbers.append(int(part))
+        if len(numbers) < len([part for part in parts if part is not None]) and operator not in (None, '='):
+            raise ValueError(f'wildcards are only allowed without an operator, not in {comparison!r}')
+        bounds.extend(expand(operator or '=', numbers, comparison))
+    return bounds
+
+
+def expand(operator, numbers, comparison):
+    """Return the bounds of one comparison, with the versions padded to three numbers"""
+    version = tuple(numbers + [0] * (3 - len(numbers)))
+    if operator in ['>', '>=', '<', '<=']:
+        return [(operator, version)]
+    if operator == '=' and len(numbers) == 3:
+        return [('=', version)]
+    if operator == '=':
+        # Only the numbers given are fixed
+        if not numbers:
+            return []
+        return [('>=', version), ('<', bump(numbers, len(numbers) - 1))]
+    if not numbers:
+        raise ValueError(f'{comparison!r} needs a version')
+    if operator == '~':
+        return [('>=', version), ('<', bump(numbers, 0 if len(numbers) == 1 else 1))]
+    # ^ fixes the first number that is not zero
+    position = next((index for index, number in enumerate(numbers) if number), len(numbers) - 1)
+    return [('>=', version), ('<', bump(numbers, position))]
+
+
+def bump(numbers, position):
+    bumped = list(numbers[:position]) + [numbers[position] + 1]
+    return tuple(bumped + [0] * (3 - len(bumped)))
+
+
+def satisfies(version, bounds):
+    checks = {'>': version.__gt__, '>=': version.__ge__, '<': version.__lt__, '<=': version.__le__,
+              '=': version.__eq__}
+    return all(checks[operator](bound) for operator, bound in bounds)
+
+
+def best_tag(tags, constraint, current):
+    """
+    Return the tag of the highest version matching `constraint`, in the style of the `current` tag: with the same
+    variant, and with a v prefix if it has one. Versions below the current one are not returned, tracking does not
+    downgrade. None if no tag matches.
+    """
+    bounds = parse_constraint(constraint)
+    current_version = parse_version(current)
+    variant = current_version[1] if current_version else ''
+    prefixed = current_version is not None and current.startswith('v')
+    best = None
+    for tag in tags:
+        version = parse_version(tag)
+        if version is None or version[1] != variant or tag.startswith('v') != prefixed:
+            continue
+        if not satisfies(version[0], bounds):
+            continue
+        if current_version and version[0] < current_version[0]:
+            continue
+        # Of equal versions, the most specific tag, e.g. 1.4.2 rather than 1.4
+        key = (version[0], tag.count('.'))
+        if best is None or key > best[0]:
+            best = (key, tag)
+    return best[1] if best else None
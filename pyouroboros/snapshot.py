@@ -0,0 +1,87 @@
+from pyouroboros.helpers import container_name
+
+# Only these labels are kept, the others are not read after listing
+LABEL_PREFIX = 'com.ouroboros.'
+
+
+def ouroboros_labels(labels):
+    return {key: value for key, value in (labels or {}).items() if key.startswith(LABEL_PREFIX)}
+
+
+class ContainerSnapshot(object):
+    """
+    The fields of a container that checks and updates read, built from its list summary or inspect data
+
+    Monitored containers are kept as snapshots between cycles. The full inspect data is fetched again when a
+    container is recreated.
+    """
+    __slots__ = ('id', 'name', 'image', 'image_id', 'labels', 'created', 'auto_remove')
+
+    def __init__(self, id, name, image, image_id, labels=None, created=None, auto_remove=None):
+        self.id = id
+        self.name = name
+        self.image = image
+        self.image_id = image_id
+        self.labels = labels or {}
+        self.created = created
+        self.auto_remove = auto_remove
+
+    @classmethod
+    def from_summary(cls, attrs):
+        """Snapshot of an entry of the container list. `auto_remove` is unknown until the container is inspected."""
+        return cls(attrs['Id'], container_name(attrs), attrs.get('Image'), attrs.get('ImageID'),
+                   ouroboros_labels(attrs.get('Labels')), attrs.get('Created'))
+
+    @classmethod
+    def from_inspect(cls, attrs):
+        return cls(attrs['Id'], attrs['Name'].lstrip('/'), attrs['Config']['Image'], attrs['Image'],
+                   ouroboros_labels(attrs['Config'].get('Labels')), attrs.get('Created'),
+                   bool(attrs['HostConfig'].get('AutoRemove')))
+
+    @property
+    def tags(self):
+        """The image reference as a tag list, empty if the image is untagged. The daemon lists the image ID instead
+        of the reference once the reference moved to another image."""
+        if not self.image or self.image.startswith('sha256:') or self.image == self.image_id:
+            return []
+        return [self.image]
+
+    @property
+    def short_id(self):
+        return self.id[:12]
+
+    def __repr__(self):
+        return f'<ContainerSnapshot: {self.short_id} {self.name}>'
+
+
+class ImageSnapshot(object):
+    """
+    The fields of an image that updates and notifications read. `reference` is the reference the image was pulled
+    as, if a container that tracks a version constraint moves to it from another tag.
+    """
+    __slots__ = ('id', 'tags', 'repo_digests', 'reference')
+
+    def __init__(self, id, tags=None, repo_digests=None, reference=None):
+        self.id = id
+        self.tags = tags or []
+        self.repo_digests = repo_digests or []
+        self.reference = reference
+
+    @classmethod
+    def from_inspect(cls, attrs):
+        return cls(attrs['Id'], [tag for tag in attrs.get('RepoTags') or [] if tag != '<none>:<none>'],
+                   attrs.get('RepoDigests'))
+
+    @classmethod
+    def from_image(cls, image, reference=None):
+        """Snapshot of a docker-py Image, or of the RegistryData a dry run resolves instead of pulling"""
+        return cls(image.id, getattr(image, 'tags', None), image.attrs.get('RepoDigests'), reference)
+
+    @property
+    def short_id(self):
+        if self.id.startswith('sha256:'):
+            return self.id[:17]
+        return self.id[:10]
+
+    def __repr__(self):
+        return f'<ImageSnapshot: {self.short_id}>'
@@ -0,0 +1,195 @@
+"""
+Status and inventory HTTP API
+
+With STATUS_PORT, ouroboros serves what it knows about the sockets it updates, from the state it keeps in memory
+between cycles: no request reaches a docker socket or a registry.
+
+    GET  /status                      the sockets, their health, last cycle and pending updates
+    GET  /containers?socket=&name=    the monitored containers, their current and latest images and last check
+    POST /check?container=NAME|ID     an immediate check of the containers with that name or ID prefix
+    POST /check?image=REFERENCE       an immediate check of the containers of that image
+    GET  /metrics                     the Prometheus metrics, if STATUS_PORT is the PROMETHEUS_PORT
+
+A check runs in the background, after the cycle of its socket that may be running, and updates what it finds
+like a cycle would.
+"""
+import json
+
+from time import time
+from logging import getLogger
+from threading import Thread
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pyouroboros.rollback import split_reference
+
+
+def timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat() if seconds else None
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        self.server.status.logger.debug('Status API: ' + format, *args)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        status = self.server.status
+        try:
+            if self.command == 'GET' and url.path == '/status':
+                return self.send_json(200, status.status())
+            if self.command == 'GET' and url.path == '/containers':
+                return self.send_json(200, status.containers(query.get('socket'), query.get('name')))
+            if self.command == 'POST' and url.path == '/check':
+                return self.send_json(*status.check(query.get('container'), query.get('image')))
+            if self.command == 'GET' and url.path == '/metrics' and status.metrics:
+                return self.send_metrics()
+        except Exception as e:
+            status.logger.exception('Status API request %s %s failed', self.command, self.path)
+            return self.send_json(500, {'error': str(e)})
+        self.send_json(404, {'error': f'No such endpoint: {self.command} {url.path}'})
+
+    def send_metrics(self):
+        from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+        body = generate_latest()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = dispatch
+
+
+class StatusServer(object):
+    """Serves the status of the container and service `modes` of this process"""
+
+    def __init__(self, config, modes, data_manager):
+        self.config = config
+        self.modes = modes
+        self.data_manager = data_manager
+        self.logger = getLogger()
+        # Serves the Prometheus metrics too, instead of the exporter's own server
+        self.metrics = config.data_export == 'prometheus' and config.status_port == config.prometheus_port
+        self.server = None
+
+    def start(self):
+        try:
+            self.server = ThreadingHTTPServer((self.config.status_addr, self.config.status_port), StatusHandler)
+        except OSError as e:
+            self.logger.error('Could not serve the status API on %s:%d. Error: %s', self.config.status_addr,
+                              self.config.status_port, e)
+            return
+        self.server.daemon_threads = True
+        self.server.status = self
+        Thread(target=self.server.serve_forever, name='status-api', daemon=True).start()
+        self.logger.info('Serving the status API on %s:%d', self.config.status_addr, self.config.status_port)
+
+    def status(self):
+        sockets = {}
+        for mode in self.modes:
+            sockets[mode.socket] = {
+                'mode': mode.mode,
+                'monitored': len(mode.monitored),
+                'pending_updates': len(getattr(mode, 'pending_updates', [])),
+                'prefetched_updates': len(getattr(mode, 'prefetched', None) or []),
+                'carried_over': len(getattr(mode, 'carried_over', [])),
+                'last_cycle': self.data_manager.cycles.get(mode.socket),
+                'health': self.data_manager.socket_health.get(mode.socket),
+                'maintenance_window': self.data_manager.windows.get(mode.socket)
+            }
+        return {'time': timestamp(time()), 'sockets': sockets}
+
+    def containers(self, socket=None, name=None):
+        containers = []
+        for mode in self.modes:
+            if socket and mode.socket != socket:
+                continue
+            if mode.mode == 'service':
+                containers.extend(self.service_status(mode, service) for service in list(mode.monitored)
+                                  if not name or service.name == name)
+                continue
+            # Copied, the update thread replaces them while this one reads
+            checks = dict(mode.checks)
+            updates = {container.id: ('pending', current_image)
+                       for container, current_image, _ in list(mode.pending_updates)}
+            updates.update({container.id: ('prefetched', current_image)
+                            for container, current_image, _ in list(mode.prefetched or [])})
+            for container in list(mode.monitored):
+                if not name or container.name == name:
+                    containers.append(self.container_status(mode, container, checks.get(container.name),
+                                                            updates.get(container.id)))
+        return {'containers': containers}
+
+    @staticmethod
+    def container_status(mode, container, check, update):
+        checked_at, latest_image, latest_digest = check or (None, None, None)
+        if latest_image and latest_image == container.image_id:
+            current_digest = latest_digest
+        elif update and update[1].repo_digests:
+            current_digest = update[1].repo_digests[0].split('@')[-1]
+        else:
+            current_digest = None
+        return {
+            'socket': mode.socket,
+            'id': container.id,
+            'name': container.name,
+            'image': container.image,
+            'current_image': container.image_id,
+            'current_digest': current_digest,
+            'latest_image': latest_image,
+            'latest_digest': latest_digest,
+            'checked_at': timestamp(checked_at),
+            'update_available': bool(latest_image and latest_image != container.image_id),
+            'update': update[0] if update else None
+        }
+
+    @staticmethod
+    def service_status(mode, service):
+        image = service.attrs['Spec']['TaskTemplate']['ContainerSpec']['Image']
+        return {'socket': mode.socket, 'id': service.id, 'name': service.name, 'image': image.split('@')[0],
+                'current_digest': image.split('@')[1] if '@' in image else None}
+
+    def check(self, container=None, image=None):
+        """Start a check of the matching containers, return the status code and payload of the response"""
+        if not container and not image:
+            return 400, {'error': 'Name a container (?container=NAME) or an image (?image=REFERENCE) to check'}
+        if any(mode.mode == 'service' for mode in self.modes):
+            return 400, {'error': 'Services are checked on their schedule only'}
+
+        matches = {}
+        for mode in self.modes:
+            for monitored in list(mode.monitored):
+                if container and (monitored.name == container or monitored.id.startswith(container)):
+                    matches.setdefault(mode, []).append(monitored)
+                elif image and monitored.image and image in [monitored.image, split_reference(monitored.image)[0]]:
+                    matches.setdefault(mode, []).append(monitored)
+        if not matches:
+            return 404, {'error': f'No monitored container matches {container or image}'}
+
+        for mode, candidates in matches.items():
+            Thread(target=self.run_check, args=(mode, candidates), name=f'check-{mode.socket}', daemon=True).start()
+        return 202, {'checking': [{'socket': mode.socket, 'name': candidate.name}
+                                  for mode, candidates in matches.items() for candidate in candidates]}
+
+    def run_check(self, mode, candidates):
+        self.logger.info('Checking %s on %s on request', ', '.join(candidate.name for candidate in candidates),
+                         mode.socket, extra={'socket': mode.socket, 'phase': 'check'})
+        try:
+            if mode.docker.healthy():
+                mode.update(candidates, targeted=True)
+                # The containers it updated were recreated under new IDs
+                mode.monitored = mode.monitor_filter()
+        except Exception:
+            self.logger.exception('Requested check on %s failed', mode.socket)
@@ -0,0 +1,40 @@
+"""
+Maintenance windows
+
+With MAINTENANCE_WINDOW, containers are only recreated inside the window: it opens on its cron schedule and stays
+open for MAINTENANCE_DURATION minutes. The update cycles outside the window still check and pull, they prefetch
+the updates. When the window opens, the update jobs run at once and apply the prefetched updates from local images,
+without checking them again.
+"""
+from datetime import datetime, timedelta
+
+
+class MaintenanceWindow(object):
+    """The open and close times of a maintenance window starting on a cron `trigger`"""
+
+    def __init__(self, trigger, duration, tz):
+        self.trigger = trigger
+        self.duration = duration
+        self.tz = tz
+        self.opened = None
+        # Opened before a restart
+        start = trigger.get_next_fire_time(None, self.now() - timedelta(seconds=duration))
+        if start is not None and start <= self.now():
+            self.opened = start
+
+    def now(self):
+        return datetime.now(self.tz)
+
+    def open(self):
+        self.opened = self.now()
+
+    @property
+    def is_open(self):
+        return self.opened is not None and self.now() < self.closes
+
+    @property
+    def closes(self):
+        return self.opened + timedelta(seconds=self.duration)
+
+    def next_open(self):
+        return self.trigger.get_next_fire_time(None, self.now())
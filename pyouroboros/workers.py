@@ -0,0 +1,202 @@
+"""
+Process per socket execution
+
+With WORKER_PROCESSES, the sockets are split into groups, and every group is updated by the scheduler of its own
+worker process. Workers report metrics, notifications and log records over one queue to the supervisor in the main
+process, which owns the DataManager, the NotificationManager and the log handlers, and restarts crashed workers.
+"""
+from os import getppid
+from copy import copy
+from time import sleep, monotonic
+from logging import getLogger
+from threading import Thread
+from multiprocessing import get_context
+
+from pyouroboros.logger import OuroborosQueueHandler
+from pyouroboros.notifiers import summarize
+from pyouroboros.circuitbreaker import CircuitBreaker
+
+# Seconds before a crashed worker is restarted, doubled for every crash that follows quickly
+RESTART_BACKOFF = 1
+RESTART_MAX_BACKOFF = 300
+# A worker that ran this long before crashing is restarted after RESTART_BACKOFF again
+STABLE_SECONDS = 600
+
+
+class WorkerDataManager(object):
+    """
+    DataManager of a worker process. It keeps the counters of its own sockets and sends every change to the
+    DataManager of the supervisor. Updated totals are sent as increments, so a restarted worker does not reset them.
+    """
+
+    def __init__(self, config, events):
+        self.config = config
+        self.events = events
+        self.enabled = True
+
+        self.monitored_containers = {}
+        self.total_updated = {}
+        self.sent_totals = {}
+
+    def send(self, method, *args):
+        increments = {socket: total - self.sent_totals.get(socket, 0) for socket, total in self.total_updated.items()
+                      if total != self.sent_totals.get(socket, 0)}
+        self.sent_totals.update(self.total_updated)
+        self.events.put(('data', method, args, dict(self.monitored_containers), increments))
+
+    def add(self, label, socket):
+        self.send('add', label, socket)
+
+    def set(self, socket):
+        self.send('set', socket)
+
+    def set_connections(self, socket, created, reused):
+        self.send('set_connections', socket, created, reused)
+
+    def set_health(self, socket, breaker, probe_seconds=None):
+        self.send('set_health', socket, breaker, probe_seconds)
+
+    def add_pull_error(self, socket, registry, error_class):
+        self.send('add_pull_error', socket, registry, error_class)
+
+    def add_pull_bytes(self, socket, registry, downloaded):
+        self.send('add_pull_bytes', socket, registry, downloaded)
+
+    def set_cycle(self, socket, seconds, carried_over):
+        self.send('set_cycle', socket, seconds, carried_over)
+
+    def add_cycle_overrun(self, socket, reason):
+        self.send('add_cycle_overrun', socket, reason)
+
+    def set_window(self, socket, seconds, window_seconds, applied):
+        self.send('set_window', socket, seconds, window_seconds, applied)
+
+    def save(self):
+        self.send('save')
+
+    def load(self):
+        self.send('load')
+
+
+class WorkerNotificationManager(object):
+    """NotificationManager of a worker process. Notifications are summarized and sent by the supervisor."""
+
+    def __init__(self, events):
+        self.events = events
+
+    def send(self, container_tuples=None, socket=None, kind='update', next_run=None, mode='container'):
+        self.events.put(('notify', {'container_tuples': summarize(container_tuples, mode), 'socket': socket,
+                                    'kind': kind, 'next_run': next_run, 'mode': mode}))
+
+
+class WorkerLogHandler(OuroborosQueueHandler):
+    """Hands the records of a worker process to the supervisor, which writes them"""
+
+    def enqueue(self, record):
+        self.queue.put_nowait(('log', record))
+
+
+def run_worker(config, events):
+    """Entry point of a worker process: update the sockets of `config` on a scheduler of its own"""
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from pyouroboros.ouroboros import schedule_sockets, translation
+    from pyouroboros.profiler import Profiler
+
+    logger = getLogger()
+    handler = WorkerLogHandler(events)
+    handler.setLevel(config.log_level.upper())
+    logger.setLevel(config.log_level.upper())
+    logger.addHandler(handler)
+    getLogger('apscheduler').setLevel(config.log_level.upper())
+    # Redact in the worker, like the handlers of the main process do
+    config.config_blacklist()
+
+    supervisor = getppid()
+    scheduler = BackgroundScheduler()
+    scheduler.start()
+    schedule_sockets(scheduler, config, WorkerDataManager(config, events), WorkerNotificationManager(events),
+                     Profiler(config) if config.profile else None, translation(config.language))
+
+    # Workers are daemonic, but a killed supervisor can't stop them
+    while scheduler.get_jobs() and getppid() == supervisor:
+        sleep(1)
+    scheduler.shutdown(wait=False)
+
+
+class Worker(object):
+    def __init__(self, index, sockets):
+        self.index = index
+        self.sockets = sockets
+        self.process = None
+        self.started = None
+        self.breaker = CircuitBreaker(f'worker {index}', backoff=RESTART_BACKOFF, max_backoff=RESTART_MAX_BACKOFF)
+
+
+class Supervisor(object):
+    """Starts a worker process per group of sockets, restarts the ones that exit and handles their reports"""
+
+    def __init__(self, config, data_manager, notification_manager):
+        self.config = config
+        self.data_manager = data_manager
+        self.notification_manager = notification_manager
+        self.logger = getLogger()
+        # Workers are started from a clean interpreter, not forked from the threads of this one
+        self.context = get_context('spawn')
+        self.events = self.context.Queue()
+
+        count = min(config.worker_processes, len(config.docker_sockets))
+        self.workers = [Worker(index, config.docker_sockets[index::count]) for index in range(count)]
+        for socket in config.docker_sockets:
+            self.data_manager.monitored_containers.setdefault(socket, 0)
+            self.data_manager.total_updated.setdefault(socket, 0)
+
+    def start(self):
+        Thread(target=self.dispatch, name='worker-events', daemon=True).start()
+        for worker in self.workers:
+            self.start_worker(worker)
+
+    def start_worker(self, worker):
+        config = copy(self.config)
+        config.docker_sockets = worker.sockets
+        # The environment was parsed already, and os.environ can't be pickled
+        config.environment_vars = {}
+        worker.process = self.context.Process(target=run_worker, args=(config, self.events),
+                                              name=f'ouroboros-worker-{worker.index}', daemon=True)
+        worker.process.start()
+        worker.started = monotonic()
+        self.logger.debug('Started worker %d (pid %d) for %s', worker.index, worker.process.pid,
+                          ', '.join(worker.sockets))
+
+    def watch(self):
+        """Restart the workers that exited, once their backoff has passed"""
+        for worker in self.workers:
+            if worker.process.is_alive():
+                continue
+            if worker.started is not None:
+                if monotonic() - worker.started >= STABLE_SECONDS:
+                    worker.breaker.success()
+                worker.breaker.failure()
+                worker.started = None
+                self.logger.error('Worker %d for %s exited with code %s, restarting it in %.0fs', worker.index,
+                                  ', '.join(worker.sockets), worker.process.exitcode, worker.breaker.retry_in)
+            elif worker.breaker.allow():
+                self.start_worker(worker)
+
+    def dispatch(self):
+        """Apply the reports of the workers, in the order each worker sent them"""
+        while True:
+            event = self.events.get()
+            try:
+                if event[0] == 'log':
+                    getLogger(event[1].name).handle(event[1])
+                elif event[0] == 'notify':
+                    self.notification_manager.send(**event[1])
+                elif event[0] == 'data':
+                    _, method, args, monitored, increments = event
+                    self.data_manager.monitored_containers.update(monitored)
+                    for socket, increment in increments.items():
+                        self.data_manager.total_updated[socket] = \
+                            self.data_manager.total_updated.get(socket, 0) + increment
+                    getattr(self.data_manager, method)(*args)
+            except Exception as e:
+                self.logger.error('Could not handle the %s report of a worker. Error: %s', event[0], e, exc_info=True)
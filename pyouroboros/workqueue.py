@@ -0,0 +1,56 @@
+from heapq import heappush, heappop
+from logging import getLogger
+
+PRIORITY_LABEL = 'com.ouroboros.priority'
+
+
+def parse_priorities(entries):
+    """Return the {name: priority} dict of `name=priority` entries, leaving out the invalid ones"""
+    priorities = {}
+    for entry in entries or []:
+        name, _, priority = entry.partition('=')
+        try:
+            priorities[name] = int(priority)
+        except ValueError:
+            getLogger().error('Priority of %s must be a number, e.g. %s=10. Ignoring it', name, name)
+    return priorities
+
+
+class WorkQueue(object):
+    """
+    Orders the containers of a socket for checking and updating, highest priority first
+
+    The priority of a container is its com.ouroboros.priority label, else its PRIORITIES entry, else 0. Containers
+    that a cycle did not get to age: their priority rises by one for every cycle they waited, and once they waited
+    `max_wait` cycles they go before all others, so that low priorities are not starved by a cycle budget.
+    """
+
+    def __init__(self, priorities, max_wait):
+        self.priorities = parse_priorities(priorities)
+        self.max_wait = max_wait
+        self.logger = getLogger()
+        # Cycles waited, by container ID
+        self.waited = {}
+
+    def priority(self, container):
+        label = container.labels.get(PRIORITY_LABEL)
+        if label is not None:
+            try:
+                return int(label)
+            except ValueError:
+                self.logger.debug('Ignoring the %s label of %s, it is not a number', PRIORITY_LABEL, container.name)
+        return self.priorities.get(container.name, 0)
+
+    def order(self, items, container=lambda item: item):
+        """Return `items` (containers, or tuples with their `container`) in queue order. Ties keep their order."""
+        heap = []
+        for index, item in enumerate(items):
+            waiting = container(item)
+            waited = self.waited.get(waiting.id, 0)
+            starving = bool(self.max_wait) and waited >= self.max_wait
+            heappush(heap, (not starving, -(self.priority(waiting) + waited), index, item))
+        return [heappop(heap)[-1] for _ in range(len(heap))]
+
+    def next_cycle(self, waiting_ids):
+        """The containers in `waiting_ids` wait another cycle, the others had their turn"""
+        self.waited = {container_id: self.waited.get(container_id, 0) + 1 for container_id in waiting_ids}
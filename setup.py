@@ -31,8 +31,9 @@ setup(
     classifiers=['Programming Language :: Python',
                  'Programming Language :: Python :: 3.6',
                  'Programming Language :: Python :: 3.7'],
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     scripts=['ouroboros'],
     install_requires=get_requirements(),
+    extras_require={'async': ['aiohttp>=3.8']},
     python_requires='>=3.6.2'
 )